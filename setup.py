@@ -33,11 +33,16 @@ setup(name="pipelinewise-target-snowflake",
           "certifi==2025.1.31",
       ],
       extras_require={
+          "zstd": [
+              'zstandard>=0.15,<1'
+          ],
           "test": [
               "pylint==2.12.*",
               'pytest==7.4.0',
               'pytest-cov==3.0.0',
-              "python-dotenv>=0.19,<1.1"
+              "python-dotenv>=0.19,<1.1",
+              'zstandard>=0.15,<1',
+              'moto[s3]>=4.2,<5'
           ]
       },
       entry_points="""
@@ -8,19 +8,24 @@ import os
 import sys
 import copy
 
-from typing import Dict, List, Optional
-from joblib import Parallel, delayed, parallel_backend
-from jsonschema import Draft7Validator, FormatChecker
+from typing import Dict, List, Optional, Tuple
+from joblib import Parallel, cpu_count, delayed, parallel_backend
 from singer import get_logger
 from datetime import datetime, timedelta
 from distutils.util import strtobool
 
 from target_snowflake.file_formats import csv
 from target_snowflake.file_formats import parquet
+from target_snowflake import compression as compressions
 from target_snowflake import stream_utils
+from target_snowflake import validation
 
+from target_snowflake.buffer_sizes import BufferSizes
 from target_snowflake.db_sync import DbSync
 from target_snowflake.file_format import FileFormatTypes
+from target_snowflake.flush_pipeline import FlushPipeline, DEFAULT_MAX_PENDING_FLUSHES
+from target_snowflake.stage_cleanup import StageCleanup
+from target_snowflake.archiver import Archiver, DEFAULT_ARCHIVE_THREADS
 from target_snowflake.exceptions import (
     RecordValidationException,
     UnexpectedValueTypeException,
@@ -36,6 +41,8 @@ DEFAULT_BATCH_SIZE_ROWS = 100000
 DEFAULT_PARALLELISM = 0  # 0 The number of threads used to flush tables
 # Don't use more than this number of threads by default when flushing streams in parallel
 DEFAULT_MAX_PARALLELISM = 16
+# Flush the biggest streams until the buffered size goes below this ratio of max_buffer_memory_mb
+BUFFER_MEMORY_LOW_WATERMARK = 0.5
 
 
 def add_metadata_columns_to_schema(schema_message):
@@ -87,7 +94,45 @@ def get_snowflake_statics(config):
     return table_cache, file_format_type
 
 
-# pylint: disable=too-many-locals,too-many-branches,too-many-statements,invalid-name
+def get_parallelism(config) -> int:
+    """Number of threads to use when flushing streams in the background
+
+    Params:
+        config: configuration dictionary
+
+    Returns:
+        Number of threads
+    """
+    parallelism = config.get("parallelism", DEFAULT_PARALLELISM)
+    max_parallelism = config.get("max_parallelism", DEFAULT_MAX_PARALLELISM)
+
+    # Parallelism 0 means auto parallelism, it's not greater than the value of max_parallelism
+    if parallelism == 0:
+        return max_parallelism
+
+    # Negative values are relative to the number of CPU cores, -1 is one thread for each core
+    if parallelism < 0:
+        return max(cpu_count() + 1 + parallelism, 1)
+
+    return parallelism
+
+
+def get_max_file_size(config) -> Optional[int]:
+    """Target size in bytes of the load files when a batch is split into multiple files
+
+    Params:
+        config: configuration dictionary
+
+    Returns:
+        Size in bytes or None if batches are loaded from a single file
+    """
+    load_file_max_size_mb = config.get('load_file_max_size_mb')
+    if not load_file_max_size_mb:
+        return None
+
+    return int(load_file_max_size_mb * 1024 * 1024)
+
+
 def persist_lines(config, lines, table_cache=None, file_format_type: FileFormatTypes = None) -> None:
     """Main loop to read and consume singer messages from stdin
 
@@ -101,20 +146,101 @@ def persist_lines(config, lines, table_cache=None, file_format_type: FileFormatT
         file_format_type: Optional FileFormatTypes value that defines which supported file format to use
                           to load data into Snowflake.
                           If not provided then it will be detected automatically
+    """
+    flush_pipeline = None
+    if config.get('pipelined_flush'):
+        # Full batches are loaded by background workers while the main loop keeps reading stdin
+        flush_pipeline = FlushPipeline(get_parallelism(config),
+                                       emit_state,
+                                       config.get('max_pending_flushes', DEFAULT_MAX_PENDING_FLUSHES))
+
+    stage_cleanup = None
+    if config.get('deferred_stage_cleanup'):
+        # Loaded files are deleted from the stage in batches instead of one by one after every load
+        stage_cleanup = StageCleanup()
+
+    archiver = None
+    if config.get('archive_load_files'):
+        # Load files are copied to the archive in the background while they are loaded
+        archiver = Archiver(config.get('archive_load_files_threads', DEFAULT_ARCHIVE_THREADS))
+
+    try:
+        _persist_lines(config, lines, table_cache, file_format_type, flush_pipeline, stage_cleanup, archiver)
+    except BaseException:
+        # A failing cleanup must not mask the error of the flush or load
+        try:
+            _stop_background_work(flush_pipeline, archiver, stage_cleanup)
+        except Exception:  # pylint: disable=broad-except
+            LOGGER.exception('Failed to stop the background work after a failed run')
+        raise
+
+    _stop_background_work(flush_pipeline, archiver, stage_cleanup)
+
+
+def _stop_background_work(flush_pipeline: Optional[FlushPipeline],
+                          archiver: Optional[Archiver],
+                          stage_cleanup: Optional[StageCleanup]) -> None:
+    """Stop the flush and archive workers and delete the queued files from the stage, every step runs
+    even if an earlier one fails"""
+    try:
+        if flush_pipeline:
+            flush_pipeline.shutdown()
+    finally:
+        try:
+            if archiver:
+                archiver.shutdown()
+        finally:
+            if stage_cleanup:
+                stage_cleanup.flush()
 
-    Returns:
-        tuple of retrieved items: table_cache, file_format_type
+
+def _new_records_buffer(config: Dict, db_sync: DbSync):
+    """Empty buffer of the records of a stream before flushing
+
+    Records of append only streams are written to parquet files in row groups as they arrive
+    if parquet_streaming_writer is enabled, every other stream is buffered in a dictionary by
+    primary key to keep only the latest version of each record in a batch.
+    """
+    if config.get('parquet_streaming_writer') \
+            and db_sync.file_format.file_format_type == FileFormatTypes.PARQUET \
+            and len(db_sync.stream_schema_message['key_properties']) == 0:
+        return parquet.StreamingRecords(db_sync.flatten_schema,
+                                        compression=compressions.get_compression(config),
+                                        dest_dir=config.get('temp_dir'),
+                                        compression_level=config.get('compression_level'),
+                                        max_file_size=get_max_file_size(config),
+                                        row_group_size=config.get('parquet_row_group_size'),
+                                        use_dictionary=config.get('parquet_use_dictionary', True))
+
+    return {}
+
+
+# pylint: disable=too-many-locals,too-many-branches,too-many-statements,invalid-name
+def _persist_lines(config, lines, table_cache, file_format_type, flush_pipeline: FlushPipeline = None,
+                   stage_cleanup: StageCleanup = None, archiver: Archiver = None) -> None:
+    """Consume singer messages, flush and load batches into Snowflake and emit the flushed states
+
+    If flush_pipeline is defined then batches are loaded in the background and the states are
+    emitted by the flush pipeline once the corresponding batches are loaded. If stage_cleanup
+    is defined then the loaded files are queued to delete them from the stage in batches. If archiver
+    is defined then the load files are archived in the background.
     """
     state = None
     flushed_state = None
     schemas = {}
     key_properties = {}
     validators = {}
+    decimal_paths = {}
+    datetime_fields = {}
     records_to_load = {}
     row_count = {}
     stream_to_sync = {}
     total_row_count = {}
     batch_size_rows = config.get('batch_size_rows', DEFAULT_BATCH_SIZE_ROWS)
+    batch_size_bytes = config.get('batch_size_bytes', None)
+    stream_batch_size_bytes = config.get('stream_batch_size_bytes', {})
+    buffer_sizes = BufferSizes()
+    max_buffer_memory_bytes = config.get('max_buffer_memory_mb', 0) * 1024 * 1024
     batch_wait_limit_seconds = config.get('batch_wait_limit_seconds', None)
     flush_timestamp = datetime.utcnow()
     archive_load_files = config.get('archive_load_files', False)
@@ -146,13 +272,14 @@ def persist_lines(config, lines, table_cache=None, file_format_type: FileFormatT
             stream = o['stream']
 
             stream_utils.adjust_timestamps_in_record(
-                o['record'], schemas[stream])
+                o['record'], schemas[stream], datetime_fields[stream])
 
             # Validate record
             if config.get('validate_records'):
                 try:
+                    # Floats are converted to Decimal only where the schema needs it, i.e. multipleOf
                     validators[stream].validate(
-                        stream_utils.float_to_decimal(o['record']))
+                        stream_utils.float_to_decimal_paths(o['record'], decimal_paths[stream]))
                 except Exception as ex:
                     if type(ex).__name__ == "InvalidOperation":
                         raise InvalidValidationOperationException(
@@ -162,25 +289,28 @@ def persist_lines(config, lines, table_cache=None, file_format_type: FileFormatT
                     raise RecordValidationException(f"Record does not pass schema validation. RECORD: {o['record']}") \
                         from ex
 
-            primary_key_string = stream_to_sync[stream].record_primary_key_string(
-                o['record'])
+            if config.get('add_metadata_columns') or config.get('hard_delete'):
+                record = stream_utils.add_metadata_values_to_record(o)
+            else:
+                record = o['record']
+
+            # Flatten the record once, the flattened record is used for the PK and to write the load file
+            flatten_record = stream_to_sync[stream].flattener.flatten(record)
+            primary_key_string = stream_to_sync[stream].primary_key_string(flatten_record)
             if not primary_key_string:
                 primary_key_string = f'RID-{total_row_count[stream]}'
 
-            if stream not in records_to_load:
-                records_to_load[stream] = {}
+            if stream not in records_to_load or not records_to_load[stream]:
+                records_to_load[stream] = _new_records_buffer(config, stream_to_sync[stream])
 
             # increment row count only when a new PK is encountered in the current batch
             if primary_key_string not in records_to_load[stream]:
                 row_count[stream] += 1
                 total_row_count[stream] += 1
+                buffer_sizes.add(stream, len(line))
 
             # append record
-            if config.get('add_metadata_columns') or config.get('hard_delete'):
-                records_to_load[stream][primary_key_string] = stream_utils.add_metadata_values_to_record(
-                    o)
-            else:
-                records_to_load[stream][primary_key_string] = o['record']
+            records_to_load[stream][primary_key_string] = flatten_record
 
             if archive_load_files and stream in archive_load_files_data:
                 # Keep track of min and max of the designated column
@@ -197,23 +327,42 @@ def persist_lines(config, lines, table_cache=None, file_format_type: FileFormatT
                     if max_value is None or max_value < incremental_key_value:
                         stream_archive_load_files_values['max'] = incremental_key_value
 
+            if flush_pipeline and max_buffer_memory_bytes and buffer_sizes.in_flight \
+                    and buffer_sizes.total > max_buffer_memory_bytes:
+                # Batches loading in the background count against the budget, wait for them
+                # before flushing the buffered streams
+                LOGGER.info("max_buffer_memory_mb (%s) exceeded, waiting for the batches in flight",
+                            config['max_buffer_memory_mb'])
+                flush_pipeline.wait_all()
+
             flush = False
+            filter_streams = [stream]
+            stream_max_bytes = stream_batch_size_bytes.get(stream, batch_size_bytes)
             if row_count[stream] >= batch_size_rows:
                 flush = True
                 LOGGER.info("Flush triggered by batch_size_rows (%s) reached in %s",
                             batch_size_rows, stream)
+            elif stream_max_bytes and buffer_sizes.get(stream) >= stream_max_bytes:
+                flush = True
+                LOGGER.info("Flush triggered by batch_size_bytes (%s) reached in %s",
+                            stream_max_bytes, stream)
             elif (batch_wait_limit_seconds and
                   datetime.utcnow() >= (flush_timestamp + timedelta(seconds=batch_wait_limit_seconds))):
                 flush = True
                 LOGGER.info("Flush triggered by batch_wait_limit_seconds (%s)",
                             batch_wait_limit_seconds)
+            elif max_buffer_memory_bytes and buffer_sizes.total > max_buffer_memory_bytes:
+                flush = True
+                # flush the biggest streams only, the small ones can keep buffering
+                filter_streams = buffer_sizes.largest_streams(
+                    int(max_buffer_memory_bytes * BUFFER_MEMORY_LOW_WATERMARK))
+                LOGGER.info("Flush triggered by max_buffer_memory_mb (%s) exceeded, flushing %s",
+                            config['max_buffer_memory_mb'], filter_streams)
 
             if flush:
                 # flush all streams, delete records if needed, reset counts and then emit current state
                 if config.get('flush_all_streams'):
                     filter_streams = None
-                else:
-                    filter_streams = [stream]
 
                 # Flush and return a new state dict with new positions only for the flushed streams
                 flushed_state = flush_streams(
@@ -224,12 +373,17 @@ def persist_lines(config, lines, table_cache=None, file_format_type: FileFormatT
                     state,
                     flushed_state,
                     archive_load_files_data,
-                    filter_streams=filter_streams)
+                    filter_streams=filter_streams,
+                    flush_pipeline=flush_pipeline,
+                    buffer_sizes=buffer_sizes,
+                    stage_cleanup=stage_cleanup,
+                    archiver=archiver)
 
                 flush_timestamp = datetime.utcnow()
 
-                # emit last encountered state
-                emit_state(copy.deepcopy(flushed_state))
+                # emit last encountered state, flush pipeline emits it once the batches are loaded
+                if not flush_pipeline:
+                    emit_state(copy.deepcopy(flushed_state))
 
         elif t == 'SCHEMA':
             if 'stream' not in o:
@@ -244,8 +398,10 @@ def persist_lines(config, lines, table_cache=None, file_format_type: FileFormatT
             if stream not in schemas or schemas[stream] != new_schema:
 
                 schemas[stream] = new_schema
-                validators[stream] = Draft7Validator(
-                    schemas[stream], format_checker=FormatChecker())
+                if config.get('validate_records'):
+                    validators[stream] = validation.get_validator(schemas[stream])
+                decimal_paths[stream] = stream_utils.get_decimal_paths(schemas[stream])
+                datetime_fields[stream] = stream_utils.get_datetime_fields(schemas[stream])
 
                 # flush records from previous stream SCHEMA
                 # if same stream has been encountered again, it means the schema might have been altered
@@ -263,10 +419,19 @@ def persist_lines(config, lines, table_cache=None, file_format_type: FileFormatT
                                                   state,
                                                   flushed_state,
                                                   archive_load_files_data,
-                                                  filter_streams=filter_streams)
+                                                  filter_streams=filter_streams,
+                                                  flush_pipeline=flush_pipeline,
+                                                  buffer_sizes=buffer_sizes,
+                                                  stage_cleanup=stage_cleanup,
+                                                  archiver=archiver)
 
-                    # emit latest encountered state
-                    emit_state(flushed_state)
+                    # emit latest encountered state, flush pipeline emits it once the batches are loaded
+                    if not flush_pipeline:
+                        emit_state(flushed_state)
+
+                # previous batches have to be loaded before altering the table to the new schema
+                if flush_pipeline:
+                    flush_pipeline.wait_for_stream(stream)
 
                 # key_properties key must be available in the SCHEMA message.
 
@@ -344,15 +509,23 @@ def persist_lines(config, lines, table_cache=None, file_format_type: FileFormatT
             if not flushed_state or sum(row_count.values()) == 0:
                 flushed_state = copy.deepcopy(state)
 
+            if flush_pipeline:
+                flush_pipeline.emit_completed_states()
+
         else:
             raise Exception(f"Unknown message type {o['type']} in message {o}")
 
+    if flush_pipeline:
+        # Every message is consumed, load the last batches after the pending ones like without the pipeline
+        flush_pipeline.wait_all()
+
     # if some bucket has records that need to be flushed but haven't reached batch size
     # then flush all buckets.
     if sum(row_count.values()) > 0:
         # flush all streams one last time, delete records if needed, reset counts and then emit current state
         flushed_state = flush_streams(records_to_load, row_count, stream_to_sync, config, state, flushed_state,
-                                      archive_load_files_data)
+                                      archive_load_files_data, buffer_sizes=buffer_sizes,
+                                      stage_cleanup=stage_cleanup, archiver=archiver)
 
     # emit latest state
     emit_state(copy.deepcopy(flushed_state))
@@ -367,7 +540,11 @@ def flush_streams(
         state,
         flushed_state,
         archive_load_files_data,
-        filter_streams=None):
+        filter_streams=None,
+        flush_pipeline: FlushPipeline = None,
+        buffer_sizes: BufferSizes = None,
+        stage_cleanup: StageCleanup = None,
+        archiver: Archiver = None):
     """
     Flushes all buckets and resets records count to 0 as well as empties records to load list
     :param streams: dictionary with records to load per stream
@@ -378,6 +555,11 @@ def flush_streams(
     :param flushed_state: dictionary containing updated states only when streams got flushed
     :param filter_streams: Keys of streams to flush from the streams dict. Default is every stream
     :param archive_load_files_data: dictionary of dictionaries containing archive load files data
+    :param flush_pipeline: Optional FlushPipeline to load the batches in the background. The returned state
+                           is emitted by the flush pipeline once the batches are loaded
+    :param buffer_sizes: Optional BufferSizes to reset for the flushed streams
+    :param stage_cleanup: Optional StageCleanup queue of the loaded files to delete from the stage in batches
+    :param archiver: Optional Archiver to copy the load files to the archive in the background
     :return: State dict with flushed positions
     """
     parallelism = config.get("parallelism", DEFAULT_PARALLELISM)
@@ -399,28 +581,53 @@ def flush_streams(
     if filter_streams:
         streams_to_flush = filter_streams
     else:
-        streams_to_flush = streams.keys()
+        streams_to_flush = list(streams.keys())
 
     can_use_snowpipe = _set_stream_snowpipe_usage(stream_to_sync, config)
 
-    # Single-host, thread-based parallelism
-    with parallel_backend('threading', n_jobs=parallelism):
-        Parallel()(delayed(load_stream_batch)(
-            stream=stream,
-            records=streams[stream],
-            row_count=row_count,
-            db_sync=stream_to_sync[stream],
-            no_compression=config.get('no_compression'),
-            delete_rows=config.get('hard_delete'),
-            temp_dir=config.get('temp_dir'),
-            archive_load_files=copy.copy(
+    def _load_stream_batch_args(stream, stream_row_count):
+        return {
+            'stream': stream,
+            'records': streams[stream],
+            'row_count': stream_row_count,
+            'db_sync': stream_to_sync[stream],
+            'compression': compressions.get_compression(config),
+            'compression_level': config.get('compression_level'),
+            'compression_threads': config.get('compression_threads', 1),
+            'max_file_size': get_max_file_size(config),
+            'streaming_upload': config.get('s3_streaming_upload', False),
+            'delete_rows': config.get('hard_delete'),
+            'temp_dir': config.get('temp_dir'),
+            'archive_load_files': copy.copy(
                 archive_load_files_data.get(stream, None)),
-            load_via_snowpipe=can_use_snowpipe[stream],
-        ) for stream in streams_to_flush)
+            'load_via_snowpipe': can_use_snowpipe[stream],
+            'stage_cleanup': stage_cleanup,
+            'archiver': archiver,
+            'purge_load_files': config.get('purge_load_files', False),
+        }
+
+    if flush_pipeline:
+        # Hand off the batches to the background workers, every batch gets its own row counter
+        # so the main loop can start buffering the next batch right away
+        futures = []
+        for stream in streams_to_flush:
+            futures.append(flush_pipeline.submit(stream,
+                                                 _load_stream_batch_in_flight,
+                                                 {'buffer_sizes': buffer_sizes,
+                                                  'in_flight_size': buffer_sizes.hand_off(stream) if buffer_sizes else 0,
+                                                  **_load_stream_batch_args(stream, {stream: row_count[stream]})}))
+            row_count[stream] = 0
+    else:
+        # Single-host, thread-based parallelism
+        with parallel_backend('threading', n_jobs=parallelism):
+            Parallel()(delayed(load_stream_batch)(**_load_stream_batch_args(stream, row_count))
+                       for stream in streams_to_flush)
 
     # reset flushed stream records to empty to avoid flushing same records
     for stream in streams_to_flush:
         streams[stream] = {}
+        if buffer_sizes:
+            buffer_sizes.reset(stream)
 
         # Update flushed streams
         if filter_streams:
@@ -441,10 +648,22 @@ def flush_streams(
             archive_load_files_data[stream]['min'] = None
             archive_load_files_data[stream]['max'] = None
 
+    if flush_pipeline:
+        flush_pipeline.checkpoint(futures, flushed_state)
+
     # Return with state message with flushed positions
     return flushed_state
 
 
+def _load_stream_batch_in_flight(buffer_sizes: Optional[BufferSizes], in_flight_size: int, **kwargs) -> None:
+    """Load a batch handed off to the flush pipeline, its size counts against the memory budget until it's loaded"""
+    try:
+        load_stream_batch(**kwargs)
+    finally:
+        if buffer_sizes:
+            buffer_sizes.release(in_flight_size)
+
+
 def _verify_snowpipe_usage(config):
     """ Verifies if the config satisfies the use snowpipe conditions.
 
@@ -493,12 +712,16 @@ def _set_stream_snowpipe_usage(stream_to_sync, config) -> dict:
 
 
 def load_stream_batch(stream, records, row_count, db_sync, no_compression=False, delete_rows=False,
-                      temp_dir=None, archive_load_files=None, load_via_snowpipe=False):
+                      temp_dir=None, archive_load_files=None, load_via_snowpipe=False, compression=None,
+                      compression_level=None, compression_threads=1, max_file_size=None, streaming_upload=False,
+                      stage_cleanup=None, purge_load_files=False, archiver=None):
     """Load one batch of the stream into target table"""
     # Load into snowflake
     if row_count[stream] > 0:
         flush_records(stream, records, db_sync, temp_dir,
-                      no_compression, archive_load_files, load_via_snowpipe)
+                      no_compression, archive_load_files, load_via_snowpipe, compression, compression_level,
+                      compression_threads, max_file_size, streaming_upload, stage_cleanup, purge_load_files,
+                      archiver)
 
         # Delete soft-deleted, flagged rows - where _sdc_deleted at is not null
         if delete_rows:
@@ -514,79 +737,157 @@ def flush_records(stream: str,
                   temp_dir: str = None,
                   no_compression: bool = False,
                   archive_load_files: Dict = None,
-                  load_via_snowpipe=False) -> None:
+                  load_via_snowpipe=False,
+                  compression: str = None,
+                  compression_level: int = None,
+                  compression_threads: int = 1,
+                  max_file_size: int = None,
+                  streaming_upload: bool = False,
+                  stage_cleanup: StageCleanup = None,
+                  purge_load_files: bool = False,
+                  archiver: Archiver = None) -> None:
     """
     Takes a list of record messages and loads it into the snowflake target table
 
     Args:
         stream: Name of the stream
-        records: List of dictionary, that represents multiple csv lines. Dict key is the column name, value is the
-                 column value
+        records: List of flattened records, that represents multiple csv lines. Dict key is the column name,
+                 value is the column value
         row_count:
         db_sync: A DbSync object
         temp_dir: Directory where intermediate temporary files will be created. (Default: OS specific temp directory)
         no_compression: Disable to use compressed files. (Default: False)
         archive_load_files: Data needed for archive load files. (Default: None)
+        load_via_snowpipe: Load the file with snowpipe. (Default: False)
+        compression: Compression codec of the load file, overrides no_compression. (Default: None)
+        compression_level: Compression level of the codec. (Default: None, the default level of the codec)
+        compression_threads: Number of threads compressing the load file. (Default: 1)
+        max_file_size: Split the batch into multiple files of this size in bytes. (Default: None, single file)
+        streaming_upload: Write the files straight to the external stage on S3 if the file format and
+                          the stage supports it, without local files. (Default: False)
+        stage_cleanup: Queue the loaded files to delete them from the stage in batches. (Default: None,
+                       the files are deleted one by one after loading them)
+        purge_load_files: Remove the loaded files from the stage by the COPY command. (Default: False)
+        archiver: Copy the load files to the archive in the background while loading them. (Default: None,
+                  the files are archived one by one after loading them)
 
     Returns:
         None
     """
-    # Generate file on disk in the required format
-    filepath = db_sync.file_format.formatter.records_to_file(records,
-                                                             db_sync.flatten_schema,
-                                                             compression=not no_compression,
-                                                             dest_dir=temp_dir,
-                                                             data_flattening_max_level=db_sync.data_flattening_max_level
-                                                             )
-
-    # Get file stats
+    # Generate file(s) on disk in the required format
+    records_to_file_args = {'compression': compression or not no_compression,
+                            'compression_level': compression_level,
+                            'compression_threads': compression_threads,
+                            'dest_dir': temp_dir,
+                            'data_flattening_max_level': db_sync.data_flattening_max_level,
+                            'flattened': True}
+    if db_sync.file_format.file_format_type == FileFormatTypes.PARQUET:
+        records_to_file_args.update(row_group_size=db_sync.connection_config.get('parquet_row_group_size'),
+                                    use_dictionary=db_sync.connection_config.get('parquet_use_dictionary', True))
+
     row_count = len(records)
-    size_bytes = os.path.getsize(filepath)
 
-    # Upload to s3 and load into Snowflake
-    s3_key = db_sync.put_to_stage(
-        filepath, stream, row_count, temp_dir=temp_dir, load_via_snowpipe=load_via_snowpipe)
-    if load_via_snowpipe:
-        db_sync.load_via_snowpipe(s3_key, stream)
+    if streaming_upload and not isinstance(records, parquet.StreamingRecords) and db_sync.can_stream_to_stage():
+        # Write the file(s) straight to the external stage, the upload overlaps with serialization
+        file_opener = db_sync.open_stage_files(stream, row_count)
+        s3_keys = db_sync.file_format.formatter.records_to_files(records,
+                                                                 db_sync.flatten_schema,
+                                                                 max_file_size=max_file_size,
+                                                                 file_opener=file_opener,
+                                                                 **records_to_file_args)
+        filepaths = []
+        size_bytes = file_opener.size_bytes
     else:
-        db_sync.load_file(s3_key, row_count, size_bytes)
+        if max_file_size or isinstance(records, parquet.StreamingRecords):
+            filepaths = db_sync.file_format.formatter.records_to_files(records,
+                                                                       db_sync.flatten_schema,
+                                                                       max_file_size=max_file_size,
+                                                                       **records_to_file_args)
+        else:
+            filepaths = [db_sync.file_format.formatter.records_to_file(records,
+                                                                       db_sync.flatten_schema,
+                                                                       **records_to_file_args)]
 
-    # Delete file from local disk
-    os.remove(filepath)
+        # Get file stats
+        size_bytes = sum(os.path.getsize(filepath) for filepath in filepaths)
 
-    if archive_load_files:
-        stream_name_parts = stream_utils.stream_name_to_dict(stream)
-        if 'schema_name' not in stream_name_parts or 'table_name' not in stream_name_parts:
-            raise Exception(
-                f"Failed to extract schema and table names from stream '{stream}'")
+        # Upload to s3
+        if len(filepaths) == 1:
+            s3_keys = [db_sync.put_to_stage(
+                filepaths[0], stream, row_count, temp_dir=temp_dir, load_via_snowpipe=load_via_snowpipe)]
+        else:
+            s3_keys = db_sync.put_files_to_stage(
+                filepaths, stream, row_count, temp_dir=temp_dir, load_via_snowpipe=load_via_snowpipe)
 
-        archive_schema = stream_name_parts['schema_name']
-        archive_table = stream_name_parts['table_name']
-        archive_tap = archive_load_files['tap']
+    # Copy the file(s) to the archive in the background, in parallel with loading them
+    archive_copies = _archive_copies(stream, s3_keys, archive_load_files) if archive_load_files else []
+    archive_futures = []
+    if archiver:
+        archive_futures = [archiver.submit(db_sync.copy_to_archive, *copy_args) for copy_args in archive_copies]
 
-        archive_metadata = {
-            'tap': archive_tap,
-            'schema': archive_schema,
-            'table': archive_table,
-            'archived-by': 'pipelinewise_target_snowflake'
-        }
+    # Load into Snowflake, every part is loaded in one statement by the common prefix of the keys
+    s3_key = s3_keys[0] if len(s3_keys) == 1 else os.path.commonprefix(s3_keys)
 
-        if 'column' in archive_load_files:
-            archive_metadata.update({
-                'incremental-key': archive_load_files['column'],
-                'incremental-key-min': str(archive_load_files['min']),
-                'incremental-key-max': str(archive_load_files['max'])
-            })
+    purged = False
+    if load_via_snowpipe:
+        db_sync.load_via_snowpipe(s3_key, stream, s3_keys=s3_keys if len(s3_keys) > 1 else None)
+    else:
+        purged = db_sync.load_file(s3_key, row_count, size_bytes, purge=purge_load_files)
 
-        # Use same file name as in import
-        archive_file = os.path.basename(s3_key)
-        archive_key = f"{archive_tap}/{archive_table}/{archive_file}"
+    # Delete file(s) from local disk
+    for filepath in filepaths:
+        os.remove(filepath)
 
-        db_sync.copy_to_archive(s3_key, archive_key, archive_metadata)
+    # The staged file(s) can be deleted only once they are archived
+    if archiver:
+        for archive_future in archive_futures:
+            archive_future.result()
+    else:
+        for copy_args in archive_copies:
+            db_sync.copy_to_archive(*copy_args)
+
+    # Delete file(s) from S3, unless they are purged by the COPY command already
+    if not load_via_snowpipe and not (purge_load_files and purged):
+        if stage_cleanup:
+            stage_cleanup.add(db_sync.upload_client, stream, s3_keys)
+        else:
+            for staged_s3_key in s3_keys:
+                db_sync.delete_from_stage(stream, staged_s3_key)
+
+
+def _archive_copies(stream: str, s3_keys: List[str], archive_load_files: Dict) -> List[Tuple[str, str, Dict]]:
+    """Source key, archive key and archive metadata of every load file of a batch to archive"""
+    stream_name_parts = stream_utils.stream_name_to_dict(stream)
+    if 'schema_name' not in stream_name_parts or 'table_name' not in stream_name_parts:
+        raise Exception(
+            f"Failed to extract schema and table names from stream '{stream}'")
+
+    archive_schema = stream_name_parts['schema_name']
+    archive_table = stream_name_parts['table_name']
+    archive_tap = archive_load_files['tap']
+
+    archive_metadata = {
+        'tap': archive_tap,
+        'schema': archive_schema,
+        'table': archive_table,
+        'archived-by': 'pipelinewise_target_snowflake'
+    }
+
+    if 'column' in archive_load_files:
+        archive_metadata.update({
+            'incremental-key': archive_load_files['column'],
+            'incremental-key-min': str(archive_load_files['min']),
+            'incremental-key-max': str(archive_load_files['max'])
+        })
+
+    # Use same file name as in import
+    archive_copies = []
+    for archived_s3_key in s3_keys:
+        archive_file = os.path.basename(archived_s3_key)
+        archive_key = f"{archive_tap}/{archive_table}/{archive_file}"
+        archive_copies.append((archived_s3_key, archive_key, archive_metadata))
 
-    # Delete file from S3
-    if not load_via_snowpipe:
-        db_sync.delete_from_stage(stream, s3_key)
+    return archive_copies
 
 
 def main():
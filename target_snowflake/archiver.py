@@ -0,0 +1,43 @@
+"""Background archiving of the load files"""
+import threading
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable
+
+# Number of threads copying load files to the archive location
+DEFAULT_ARCHIVE_THREADS = 8
+
+
+class Archiver:
+    """Copies load files to the archive location on a thread pool
+
+    The queue of the copies is bounded, submit blocks while every worker is busy and
+    the queue is full, so the archiving can't fall behind the loading without limits.
+    """
+
+    def __init__(self, max_workers: int = DEFAULT_ARCHIVE_THREADS, max_queued: int = None):
+        """
+        Params:
+            max_workers: Number of threads copying the files
+            max_queued: Max number of copies waiting for a free worker. (Default: max_workers)
+        """
+        max_workers = max(1, max_workers)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='archive')
+        self._slots = threading.BoundedSemaphore(max_workers + (max_queued if max_queued is not None
+                                                                else max_workers))
+
+    def submit(self, copy_fn: Callable, *args) -> Future:
+        """Copy a file in the background, blocks while the queue is full"""
+        self._slots.acquire()  # pylint: disable=consider-using-with
+        try:
+            future = self._executor.submit(copy_fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def shutdown(self) -> None:
+        """Wait for the submitted copies and stop the workers"""
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,71 @@
+"""Size accounting of the records buffered in memory before flushing"""
+import threading
+
+from typing import Dict, List
+
+
+class BufferSizes:
+    """Estimated number of bytes buffered per stream.
+
+    The size of a record is estimated from the length of the raw singer message
+    line, which is cheap to compute and proportional to the size of the load file.
+    Batches handed off to background flush workers stay in the total until they are
+    loaded, they are released by the workers.
+    """
+
+    def __init__(self):
+        self._sizes: Dict[str, int] = {}
+        self._total = 0
+        self._in_flight = 0
+        self._in_flight_lock = threading.Lock()
+
+    @property
+    def total(self) -> int:
+        """Estimated number of bytes buffered across every stream, including the batches in flight"""
+        return self._total + self._in_flight
+
+    @property
+    def in_flight(self) -> int:
+        """Estimated number of bytes of the batches handed off and not loaded yet"""
+        return self._in_flight
+
+    def hand_off(self, stream: str) -> int:
+        """Move the size of a flushed stream to the batches in flight, returns the size to release"""
+        size = self._sizes.get(stream, 0)
+        self.reset(stream)
+        with self._in_flight_lock:
+            self._in_flight += size
+
+        return size
+
+    def release(self, size: int) -> None:
+        """Remove the size of a loaded batch from the batches in flight"""
+        with self._in_flight_lock:
+            self._in_flight -= size
+
+    def add(self, stream: str, size: int) -> None:
+        """Account the size of a new record of a stream"""
+        self._sizes[stream] = self._sizes.get(stream, 0) + size
+        self._total += size
+
+    def reset(self, stream: str) -> None:
+        """Reset the size of a stream after its records are flushed"""
+        self._total -= self._sizes.get(stream, 0)
+        self._sizes[stream] = 0
+
+    def get(self, stream: str) -> int:
+        """Estimated number of bytes buffered for a stream"""
+        return self._sizes.get(stream, 0)
+
+    def largest_streams(self, max_remaining: int) -> List[str]:
+        """Biggest streams to flush to get the total size down to max_remaining bytes, the batches
+        in flight are part of the total but can't be selected"""
+        streams = []
+        remaining = self.total
+        for stream, size in sorted(self._sizes.items(), key=lambda item: item[1], reverse=True):
+            if remaining <= max_remaining or size == 0:
+                break
+            streams.append(stream)
+            remaining -= size
+
+        return streams
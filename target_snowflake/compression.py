@@ -0,0 +1,315 @@
+"""Compression codecs of the generated load files"""
+import gzip
+import os
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from tempfile import mkstemp
+from typing import BinaryIO, Callable, Deque, Dict, Iterator, List, Optional, Tuple, Union
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+GZIP = 'gzip'
+ZSTD = 'zstd'
+SNAPPY = 'snappy'
+LZ4 = 'lz4'
+NONE = 'none'
+
+# Codecs supported by the file format types. CSV files are compressed as a whole,
+# parquet files are compressed internally by pyarrow
+CSV_CODECS = [GZIP, ZSTD, NONE]
+PARQUET_CODECS = [GZIP, SNAPPY, ZSTD, LZ4, NONE]
+
+# Codecs by file format type, JSON files are compressed as a whole like CSV files
+FILE_FORMAT_CODECS = {
+    'csv': CSV_CODECS,
+    'json': CSV_CODECS,
+    'parquet': PARQUET_CODECS,
+}
+
+# Compression levels used when compression_level is not set
+DEFAULT_LEVELS = {
+    GZIP: 9,
+    ZSTD: 3,
+}
+
+# Valid compression_level ranges of the codecs, the other codecs have no levels
+LEVEL_RANGES = {
+    GZIP: (1, 9),
+    ZSTD: (1, 22),
+}
+
+# Size of the independently compressed gzip members when compressing with multiple threads
+PARALLEL_GZIP_CHUNK_SIZE = 4 * 1024 * 1024
+
+# File name suffixes of CSV files compressed as a whole
+CSV_SUFFIXES = {
+    GZIP: '.gz',
+    ZSTD: '.zst',
+    NONE: '',
+}
+
+# SOURCE_COMPRESSION options of the PUT command by file name suffix
+SOURCE_COMPRESSIONS = {
+    '.gz': 'GZIP',
+    '.zst': 'ZSTD',
+}
+
+
+def get_compression(config: Dict) -> str:
+    """Compression codec of the load files. no_compression takes precedence over compression"""
+    if config.get('no_compression'):
+        return NONE
+
+    return (config.get('compression') or GZIP).lower()
+
+
+def to_codec(compression: Union[bool, str]) -> str:
+    """Codec name of the compression argument of records_to_file. True means gzip, False means none"""
+    if isinstance(compression, str):
+        return compression.lower()
+
+    return GZIP if compression else NONE
+
+
+def validate_config(config: Dict, file_format_type: str = None) -> List[str]:
+    """
+    Validate the compression related config keys, returns the list of errors
+
+    Params:
+        config: Target config
+        file_format_type: Type of the file format, csv, json or parquet. The codec is validated
+                          against the codecs of the file format if set. (Default: None)
+    """
+    errors = []
+    codec = get_compression(config)
+    if codec not in PARQUET_CODECS:
+        errors.append(f"Invalid compression '{config.get('compression')}'. "
+                      f"Supported codecs: CSV: {CSV_CODECS}, Parquet: {PARQUET_CODECS}")
+    elif file_format_type in FILE_FORMAT_CODECS and codec not in FILE_FORMAT_CODECS[file_format_type]:
+        errors.append(f"Not supported compression for {file_format_type.upper()} files: '{codec}'. "
+                      f"Supported codecs: {FILE_FORMAT_CODECS[file_format_type]}")
+    elif codec == ZSTD and zstandard is None:
+        errors.append("zstd compression requires the zstandard package. "
+                      "Install it by pip install pipelinewise-target-snowflake[zstd]")
+
+    compression_level = config.get('compression_level')
+    if compression_level is not None:
+        if not isinstance(compression_level, int) or isinstance(compression_level, bool):
+            errors.append(f"Invalid compression_level '{compression_level}', it needs to be an integer")
+        elif codec in PARQUET_CODECS and codec not in LEVEL_RANGES:
+            errors.append(f"compression_level is not supported by '{codec}' compression. "
+                          f"Codecs with compression levels: {list(LEVEL_RANGES)}")
+        elif codec in LEVEL_RANGES and not LEVEL_RANGES[codec][0] <= compression_level <= LEVEL_RANGES[codec][1]:
+            errors.append(f"Invalid compression_level '{compression_level}' for '{codec}' compression, "
+                          f"it needs to be between {LEVEL_RANGES[codec][0]} and {LEVEL_RANGES[codec][1]}")
+
+    compression_threads = config.get('compression_threads')
+    if compression_threads is not None and (not isinstance(compression_threads, int) or compression_threads < 1):
+        errors.append(f"Invalid compression_threads '{compression_threads}', it needs to be a positive integer")
+
+    return errors
+
+
+def get_level(codec: str, compression_level: Optional[int] = None) -> Optional[int]:
+    """Compression level of a codec, default level of the codec if not set"""
+    if compression_level is not None:
+        return compression_level
+
+    return DEFAULT_LEVELS.get(codec)
+
+
+# pylint: disable=too-many-instance-attributes
+class ParallelGzipFile:
+    """
+    Write only file object compressing chunks of the written data on a thread pool
+
+    Every chunk is compressed into an independent gzip member and the members are written
+    in order, which is a valid multi-member gzip file. zlib releases the GIL so the chunks
+    are compressed on multiple cores.
+    """
+
+    def __init__(self,
+                 fileobj,
+                 compresslevel: int = 9,
+                 threads: int = 2,
+                 chunk_size: int = None):
+        self._fileobj = fileobj
+        self._compresslevel = compresslevel
+        self._chunk_size = chunk_size or PARALLEL_GZIP_CHUNK_SIZE
+        self._max_pending = threads * 2
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='gzip')
+        self._pending: Deque = deque()
+        self._buffer: List[bytes] = []
+        self._buffer_size = 0
+        self.closed = False
+
+    def write(self, data: bytes) -> int:
+        """Buffer the data and compress it in the background once a full chunk is buffered"""
+        self._buffer.append(data)
+        self._buffer_size += len(data)
+        if self._buffer_size >= self._chunk_size:
+            self._submit_buffer()
+
+        return len(data)
+
+    def _submit_buffer(self) -> None:
+        chunk = b''.join(self._buffer)
+        self._buffer = []
+        self._buffer_size = 0
+
+        # Write the finished members to keep the memory used by pending chunks bounded
+        while len(self._pending) >= self._max_pending:
+            self._fileobj.write(self._pending.popleft().result())
+
+        self._pending.append(self._executor.submit(gzip.compress, chunk, self._compresslevel))
+
+    def close(self) -> None:
+        """Compress the remaining data and write every pending member in order"""
+        if self.closed:
+            return
+
+        try:
+            if self._buffer_size:
+                self._submit_buffer()
+            while self._pending:
+                self._fileobj.write(self._pending.popleft().result())
+        finally:
+            self._executor.shutdown(wait=True)
+            self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def open_compressed_file(fileobj, codec: str, compression_level: Optional[int] = None, threads: int = 1):
+    """
+    Wrap a binary file object to compress everything written into it
+
+    Args:
+        fileobj: An open binary file object
+        codec: One of CSV_CODECS
+        compression_level: Optional compression level. (Default: the default level of the codec)
+        threads: Number of threads compressing the data. (Default: 1)
+
+    Returns:
+        Writeable file object that needs to be closed to flush the compressed data
+    """
+    level = get_level(codec, compression_level)
+    threads = threads or 1
+
+    if codec == GZIP:
+        if threads > 1:
+            return ParallelGzipFile(fileobj, compresslevel=level, threads=threads)
+        return gzip.GzipFile(mode='wb', fileobj=fileobj, compresslevel=level)
+    if codec == ZSTD:
+        if zstandard is None:
+            raise ImportError('zstd compression requires the zstandard package')
+        # zstandard compresses on multiple threads natively, 0 means single threaded
+        return zstandard.ZstdCompressor(level=level, threads=threads if threads > 1 else 0) \
+            .stream_writer(fileobj, closefd=False)
+
+    raise ValueError(f'Not supported compression codec for whole files: {codec}')
+
+
+def local_file_opener(prefix: str, dest_dir: str = None) -> Callable[[str], Tuple[str, BinaryIO]]:
+    """
+    File opener of write_chunks_to_files creating temporary files
+
+    The first file gets a unique base name from mkstemp, the next files of the same opener
+    share the base name, i.e. <base>_0000.csv.gz, <base>_0001.csv.gz, ...
+    """
+    base_filename = None
+
+    def open_file(file_suffix: str) -> Tuple[str, BinaryIO]:
+        nonlocal base_filename
+        if base_filename is None:
+            if dest_dir:
+                os.makedirs(dest_dir, exist_ok=True)
+            filedesc, filename = mkstemp(suffix=file_suffix, prefix=prefix, dir=dest_dir)
+            base_filename = filename[:-len(file_suffix)]
+        else:
+            filename = f'{base_filename}{file_suffix}'
+            filedesc = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+
+        return filename, open(filedesc, 'wb')
+
+    return open_file
+
+
+# pylint: disable=too-many-arguments,too-many-locals
+def write_chunks_to_files(chunks: Iterator[bytes],
+                          suffix: str,
+                          prefix: str,
+                          codec: str,
+                          dest_dir: str = None,
+                          compression_level: Optional[int] = None,
+                          threads: int = 1,
+                          max_file_size: Optional[int] = None,
+                          file_opener: Callable[[str], Tuple[str, BinaryIO]] = None) -> List[str]:
+    """
+    Write chunks of encoded lines to one or more files compressed as a whole
+
+    A new file is started once the written, compressed size of the current file reaches
+    max_file_size. The files are named <base>_0000<suffix>, <base>_0001<suffix>, ... so they
+    can be loaded by their common prefix.
+
+    Args:
+        chunks: Encoded lines, a chunk is never split between files
+        suffix: File name suffix without the suffix of the codec, i.e. .csv
+        prefix: File name prefix
+        codec: One of CSV_CODECS
+        dest_dir: Directory where the files will be generated. (Default: OS specific temp directory)
+        compression_level: Optional compression level. (Default: the default level of the codec)
+        threads: Number of threads compressing the data. (Default: 1)
+        max_file_size: Target size of a file in bytes. (Default: None, a single file without part number)
+        file_opener: Callable opening the file of a file name suffix, returns the name and a binary file
+                     object with tell(). (Default: temporary files in dest_dir)
+
+    Returns:
+        List of names of the generated files, absolute paths of the temporary files by default
+    """
+    if file_opener is None:
+        file_opener = local_file_opener(prefix, dest_dir)
+
+    file_suffix = f'{suffix}{CSV_SUFFIXES[codec]}'
+
+    chunk = next(chunks, None)
+    filenames = []
+    while True:
+        part_suffix = f'_{len(filenames):04d}{file_suffix}' if max_file_size else file_suffix
+        filename, outfile = file_opener(part_suffix)
+
+        # Using compressed or plain file object
+        with outfile:
+            if codec == NONE:
+                writer = nullcontext(outfile)
+            else:
+                writer = open_compressed_file(outfile, codec, compression_level, threads)
+
+            with writer as out:
+                while chunk is not None:
+                    out.write(chunk)
+                    chunk = next(chunks, None)
+                    if max_file_size and outfile.tell() >= max_file_size:
+                        break
+
+        filenames.append(filename)
+        if chunk is None:
+            return filenames
+
+
+def put_compression_option(filename: str) -> str:
+    """SOURCE_COMPRESSION option of the PUT command for a load file, detected from its suffix"""
+    for suffix, source_compression in SOURCE_COMPRESSIONS.items():
+        if filename.endswith(suffix):
+            return f'SOURCE_COMPRESSION={source_compression}'
+
+    return ''
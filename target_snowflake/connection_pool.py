@@ -0,0 +1,197 @@
+"""Process wide pool of reusable Snowflake connections"""
+import atexit
+import threading
+import time
+
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Tuple
+
+import snowflake.connector
+
+from singer import get_logger
+from snowflake.connector import SnowflakeConnection
+
+LOGGER = get_logger('target_snowflake')
+
+# Max number of idle connections kept open for the same connection parameters
+DEFAULT_POOL_SIZE = 16
+
+# Max number of idle connections kept open for all connection parameters together
+DEFAULT_MAX_IDLE_CONNECTIONS = 64
+
+# Idle connections are closed and evicted from the pool after this many seconds
+DEFAULT_IDLE_TIMEOUT_SECONDS = 600
+
+# Idle connections are pinged before reusing them if they were not used for this many seconds
+HEALTH_CHECK_AFTER_SECONDS = 60
+
+
+def pool_key(connection_params: Dict) -> Tuple:
+    """Generate a hashable pool key from snowflake.connector.connect parameters.
+
+    Session parameters are part of the key, connections with different QUERY_TAG
+    or other session settings are never shared.
+    """
+    return tuple(sorted(
+        (name, tuple(sorted(value.items())) if isinstance(value, dict) else value)
+        for name, value in connection_params.items()
+    ))
+
+
+class ConnectionPool:
+    """Thread safe pool of open Snowflake connections grouped by connection parameters.
+
+    A connection is checked out exclusively by the calling thread and returned to
+    the pool when the thread is done with it. Idle connections are health checked
+    before reuse and evicted once they are idle longer than the idle timeout, the
+    idle connections of every connection parameters are evicted on every checkout.
+    The least recently used idle connections are closed once the pool holds more
+    than max_idle_connections.
+    """
+
+    def __init__(self, max_idle_connections: int = DEFAULT_MAX_IDLE_CONNECTIONS):
+        self.max_idle_connections = max(0, max_idle_connections)
+        self._lock = threading.Lock()
+        self._idle_connections: Dict[Tuple, List[Tuple[SnowflakeConnection, float]]] = {}
+
+    @contextmanager
+    def connection(self,
+                   connection_params: Dict,
+                   pool_size: int = DEFAULT_POOL_SIZE,
+                   idle_timeout: int = DEFAULT_IDLE_TIMEOUT_SECONDS) -> Iterator[SnowflakeConnection]:
+        """Check out a connection from the pool, or open a new one if no healthy idle connection available
+
+        Params:
+            connection_params: Keyword arguments of snowflake.connector.connect
+            pool_size: Max number of idle connections to keep for the same connection parameters.
+                       0 disables pooling and closes the connection after use
+            idle_timeout: Seconds after an idle connection is closed instead of reused
+
+        Returns:
+            Context manager that yields an open SnowflakeConnection
+        """
+        key = pool_key(connection_params)
+        connection = self._checkout(key, idle_timeout)
+        if connection is None:
+            connection = snowflake.connector.connect(**connection_params)
+
+        try:
+            yield connection
+        except BaseException:
+            self._release_failed(key, connection, pool_size)
+            raise
+
+        self._checkin(key, connection, pool_size)
+
+    def close_all(self) -> None:
+        """Close every idle connection in the pool"""
+        with self._lock:
+            idle_connections = [c for connections in self._idle_connections.values() for c, _ in connections]
+            self._idle_connections = {}
+
+        for connection in idle_connections:
+            self._close(connection)
+
+    def _checkout(self, key: Tuple, idle_timeout: int):
+        """Take the most recently used healthy idle connection from the pool"""
+        for expired_connection in self._evict_expired(idle_timeout):
+            self._close(expired_connection)
+
+        while True:
+            with self._lock:
+                connections = self._idle_connections.get(key)
+                if not connections:
+                    return None
+                connection, last_used = connections.pop()
+                if not connections:
+                    del self._idle_connections[key]
+
+            idle_seconds = time.monotonic() - last_used
+            if idle_seconds > idle_timeout:
+                self._close(connection)
+            elif self._is_healthy(connection, idle_seconds):
+                return connection
+
+    def _checkin(self, key: Tuple, connection: SnowflakeConnection, pool_size: int) -> None:
+        """Return a connection to the pool or close it if the pool is full"""
+        if pool_size <= 0 or connection.is_closed():
+            self._close(connection)
+            return
+
+        evicted = []
+        with self._lock:
+            connections = self._idle_connections.setdefault(key, [])
+            connections.append((connection, time.monotonic()))
+            while len(connections) > pool_size:
+                evicted.append(connections.pop(0)[0])
+
+            idle_count = sum(len(idle) for idle in self._idle_connections.values())
+            while idle_count > self.max_idle_connections:
+                evicted.append(self._pop_least_recently_used())
+                idle_count -= 1
+
+        for evicted_connection in evicted:
+            self._close(evicted_connection)
+
+    def _evict_expired(self, idle_timeout: int) -> List[SnowflakeConnection]:
+        """Remove the connections idle longer than the idle timeout from the pool, for every key"""
+        now = time.monotonic()
+        expired = []
+        with self._lock:
+            for key in list(self._idle_connections):
+                # Connections are appended when they are returned, the least recently used ones are first
+                connections = self._idle_connections[key]
+                while connections and now - connections[0][1] > idle_timeout:
+                    expired.append(connections.pop(0)[0])
+                if not connections:
+                    del self._idle_connections[key]
+
+        return expired
+
+    def _pop_least_recently_used(self) -> SnowflakeConnection:
+        """Remove the least recently used idle connection of any key from the pool, the lock must be held"""
+        key = min(self._idle_connections, key=lambda k: self._idle_connections[k][0][1])
+        connection = self._idle_connections[key].pop(0)[0]
+        if not self._idle_connections[key]:
+            del self._idle_connections[key]
+
+        return connection
+
+    def _release_failed(self, key: Tuple, connection: SnowflakeConnection, pool_size: int) -> None:
+        """Roll back any open transaction of a connection that raised an exception and return it to the pool"""
+        try:
+            connection.rollback()
+        except Exception:
+            self._close(connection)
+            return
+
+        self._checkin(key, connection, pool_size)
+
+    @staticmethod
+    def _is_healthy(connection: SnowflakeConnection, idle_seconds: float) -> bool:
+        """Check if an idle connection can be reused. Long idle connections are pinged"""
+        if connection.is_closed():
+            return False
+
+        if idle_seconds > HEALTH_CHECK_AFTER_SECONDS:
+            try:
+                with connection.cursor() as cur:
+                    cur.execute('SELECT 1')
+            except Exception as exc:
+                LOGGER.debug('Discarding unhealthy pooled connection: %s', exc)
+                ConnectionPool._close(connection)
+                return False
+
+        return True
+
+    @staticmethod
+    def _close(connection: SnowflakeConnection) -> None:
+        try:
+            connection.close()
+        except Exception as exc:
+            LOGGER.debug('Failed to close pooled connection: %s', exc)
+
+
+# Connections are shared by every DbSync instance of the process
+POOL = ConnectionPool()
+atexit.register(POOL.close_all)
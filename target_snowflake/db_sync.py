@@ -4,14 +4,18 @@ import snowflake.connector
 import re
 import time
 
+from functools import lru_cache
 from typing import List, Dict, Union, Tuple, Set
 from singer import get_logger
+from target_snowflake import compression
+from target_snowflake import connection_pool
 from target_snowflake import flattening
 from target_snowflake import stream_utils
 from target_snowflake.file_format import FileFormat, FileFormatTypes
 
 from target_snowflake.exceptions import TooManyRecordsException, PrimaryKeyNotFoundException
-from target_snowflake.upload_clients.s3_upload_client import S3UploadClient
+from target_snowflake.upload_clients.s3_upload_client import S3UploadClient, UPLOAD_CLIENTS, \
+    MIN_MULTIPART_CHUNKSIZE_MB
 from target_snowflake.upload_clients.snowflake_upload_client import SnowflakeUploadClient
 
 from snowflake.connector.errors import ProgrammingError
@@ -79,6 +83,31 @@ def validate_config(config):
         errors.append(
             'Archive load files option can be used only with external s3 stages. Please define s3_bucket.')
 
+    # Archived files are copied from the stage after loading them, they can't be purged by the COPY command
+    if archive_load_files and config.get('purge_load_files', False):
+        errors.append('Purge load files option can not be used with archive load files.')
+
+    # Check S3 multipart upload settings, S3 rejects the parts of multipart uploads smaller than 5 MB
+    for key, min_value in [('s3_multipart_threshold_mb', 1),
+                           ('s3_multipart_chunksize_mb', MIN_MULTIPART_CHUNKSIZE_MB),
+                           ('s3_max_concurrency', 1)]:
+        value = config.get(key)
+        if value is not None and (not isinstance(value, int) or value < min_value):
+            errors.append(f"Invalid {key} '{value}', it needs to be an integer of at least {min_value}")
+
+    # PARALLEL option of the PUT commands, snowflake accepts 1 to 99 threads
+    put_parallel = config.get('put_parallel')
+    if put_parallel is not None and (not isinstance(put_parallel, int) or not 1 <= put_parallel <= 99):
+        errors.append(f"Invalid put_parallel '{put_parallel}', it needs to be an integer between 1 and 99")
+
+    archive_load_files_threads = config.get('archive_load_files_threads')
+    if archive_load_files_threads is not None and \
+            (not isinstance(archive_load_files_threads, int) or archive_load_files_threads < 1):
+        errors.append(f"Invalid archive_load_files_threads '{archive_load_files_threads}', "
+                      "it needs to be a positive integer")
+
+    errors.extend(compression.validate_config(config))
+
     return errors
 
 
@@ -138,6 +167,32 @@ def column_clause(name, schema_property):
     return f'{safe_column_name(name)} {column_type(schema_property)}'
 
 
+@lru_cache(maxsize=None)
+def load_private_key(key_path: str,
+                     password: str = None,
+                     key_encoding: Encoding = Encoding.PEM,
+                     encoding: str = None) -> Union[bytes, str]:
+    """
+    Load and serialize private key from file. The result is cached, the key file is read only once per process
+
+    key_path:      Path of the PEM private key file
+    password:      Password of the encrypted private key or None
+    key_encoding:  The encoding of the private key. PEM or DER
+    encoding:      The encoding of the private key. utf-8 or None
+
+    Returns:
+        The private key in bytes or string format
+    """
+    with open(key_path, 'rb') as pem_in:
+        private_key_obj = load_pem_private_key(
+            pem_in.read(), password=password, backend=default_backend())
+
+    private_key_raw = private_key_obj.private_bytes(
+        key_encoding, PrivateFormat.PKCS8, NoEncryption())
+
+    return private_key_raw.decode(encoding) if encoding else private_key_raw
+
+
 def primary_column_names(stream_schema_message):
     """Generate list of SQL friendly PK column names"""
     return [safe_column_name(p) for p in stream_schema_message['key_properties']]
@@ -230,6 +285,13 @@ class DbSync:
         self.file_format = FileFormat(
             self.connection_config['file_format'], self.query, file_format_type)
 
+        # Codecs depend on the file format type, it's known only after detecting the file format
+        config_errors = compression.validate_config(self.connection_config, self.file_format.file_format_type.value)
+        if len(config_errors) > 0:
+            self.logger.error('Invalid configuration:\n   * %s',
+                              '\n   * '.join(config_errors))
+            sys.exit(1)
+
         if not self.connection_config.get('stage') and self.file_format.file_format_type == FileFormatTypes.PARQUET:
             self.logger.error("Table stages with Parquet file format is not supported. "
                               "Use named stages with Parquet file format or table stages with CSV files format")
@@ -298,9 +360,14 @@ class DbSync:
                 'data_flattening_max_level', 0)
             self.flatten_schema = flattening.flatten_schema(stream_schema_message['schema'],
                                                             max_level=self.data_flattening_max_level)
+            # Nested objects and arrays are JSON encoded, if needed, once by the file formatters
+            self.flattener = flattening.RecordFlattener(self.flatten_schema,
+                                                        max_level=self.data_flattening_max_level,
+                                                        dump_json=False)
 
+        # S3 upload clients are shared by the DbSync instances of every stream
         if connection_config.get('s3_bucket', None):
-            self.upload_client = S3UploadClient(connection_config)
+            self.upload_client = UPLOAD_CLIENTS.get(connection_config)
         # Use table stage
         else:
             self.upload_client = SnowflakeUploadClient(connection_config, self)
@@ -360,17 +427,18 @@ class DbSync:
                         "private_key_path", "./rsa_key.p8")
         password = self.connection_config.get(
                         "private_key_password", None)
-        with open(key_path, 'rb') as pem_in:
-            private_key_obj = load_pem_private_key(
-                pem_in.read(), password=password, backend=default_backend())
-        
-        private_key_raw = private_key_obj.private_bytes(
-            key_encoding, PrivateFormat.PKCS8, NoEncryption())
-        
-        return private_key_raw.decode(encoding) if encoding else private_key_raw
+
+        return load_private_key(key_path, password, key_encoding, encoding)
 
     def open_connection(self):
-        """Open snowflake connection"""
+        """Check out a snowflake connection from the process wide connection pool
+
+        Connections are pooled by their connection and session parameters, so every
+        connection keeps the QUERY_TAG of the stream that opened it.
+
+        Returns:
+            Context manager that yields an open snowflake connection
+        """
         stream = None
         if self.stream_schema_message:
             stream = self.stream_schema_message['stream']
@@ -397,8 +465,11 @@ class DbSync:
             }
         )
 
-        return snowflake.connector.connect(
-            **connection_dict,   
+        return connection_pool.POOL.connection(
+            connection_dict,
+            pool_size=self.connection_config.get('connection_pool_size', connection_pool.DEFAULT_POOL_SIZE),
+            idle_timeout=self.connection_config.get('connection_pool_idle_timeout',
+                                                    connection_pool.DEFAULT_IDLE_TIMEOUT_SECONDS)
         )
 
     def query(self, query: Union[str, List[str]], params: Dict = None, max_records=0) -> List[Dict]:
@@ -443,6 +514,11 @@ class DbSync:
 
                     result = cur.fetchall()
 
+                # Pooled connections are reused, never leave the transaction open
+                if isinstance(query, list):
+                    self.logger.debug('Committing Transaction')
+                    cur.execute("COMMIT")
+
         return result
 
     def table_name(self, stream_name, is_temporary, without_schema=False):
@@ -466,8 +542,12 @@ class DbSync:
         """Generate a unique PK string in the record"""
         if len(self.stream_schema_message['key_properties']) == 0:
             return None
-        flatten = flattening.flatten_record(
-            record, self.flatten_schema, max_level=self.data_flattening_max_level)
+        return self.primary_key_string(self.flattener.flatten(record))
+
+    def primary_key_string(self, flatten):
+        """Generate a unique PK string in the already flattened record"""
+        if len(self.stream_schema_message['key_properties']) == 0:
+            return None
         key_props = []
         for key_prop in self.stream_schema_message['key_properties']:
             if key_prop not in flatten or flatten[key_prop] is None:
@@ -497,6 +577,23 @@ class DbSync:
         s3_key_prefix = self._generate_s3_key_prefix(stream, load_via_snowpipe)
         return self.upload_client.upload_file(file, stream, temp_dir=temp_dir, s3_key_prefix=s3_key_prefix)
 
+    def put_files_to_stage(self, files, stream, count, temp_dir=None, load_via_snowpipe=False):
+        """Upload the parts of a load file to stage, the keys share a common prefix"""
+        self.logger.info("Uploading %s rows to stage in %s files", count, len(files))
+        s3_key_prefix = self._generate_s3_key_prefix(stream, load_via_snowpipe)
+        return self.upload_client.upload_files(files, stream, temp_dir=temp_dir, s3_key_prefix=s3_key_prefix)
+
+    def can_stream_to_stage(self) -> bool:
+        """Load files can be written straight to the external stage on S3, without local files"""
+        return bool(self.connection_config.get('s3_streaming_upload')) \
+            and isinstance(self.upload_client, S3UploadClient) \
+            and self.file_format.file_format_type in (FileFormatTypes.CSV, FileFormatTypes.JSON)
+
+    def open_stage_files(self, stream, count):
+        """File opener of the formatters writing the load files of a batch straight to the external stage"""
+        self.logger.info("Streaming %s rows to stage", count)
+        return self.upload_client.open_streaming_files(stream)
+
     def delete_from_stage(self, stream, s3_key):
         """Delete file from snowflake stage"""
         self.upload_client.delete_object(stream, s3_key)
@@ -544,8 +641,14 @@ class DbSync:
         table_name = self.table_name(stream, False, without_schema=True)
         return f"{self.schema_name}.%{table_name}"
 
-    def load_file(self, s3_key, count, size_bytes):
-        """Load a supported file type from snowflake stage into target table"""
+    def load_file(self, s3_key, count, size_bytes, purge=False) -> bool:
+        """Load a supported file type from snowflake stage into target table
+
+        purge: Remove the loaded files from the stage by the COPY command. MERGE commands don't purge
+
+        Returns:
+            True if the loaded files are removed from the stage by snowflake
+        """
         bucket = self.connection_config.get('s3_bucket')
         stage = self.connection_config.get('stage')
         if stage and bucket:
@@ -567,6 +670,7 @@ class DbSync:
 
         inserts = 0
         updates = 0
+        purged = False
 
         # Insert or Update with MERGE command if primary key defined
         if len(self.stream_schema_message['key_properties']) > 0:
@@ -590,10 +694,12 @@ class DbSync:
                     self._load_file_copy(
                         s3_key=s3_key,
                         stream=stream,
-                        columns_with_trans=columns_with_trans
+                        columns_with_trans=columns_with_trans,
+                        purge=purge
                     ),
                     0,
                 )
+                purged = purge
             except Exception as ex:
                 self.logger.error(
                     'Error while executing COPY query for table "%s" in stream "%s"',
@@ -607,6 +713,8 @@ class DbSync:
             json.dumps({'inserts': inserts, 'updates': updates, 'size_bytes': size_bytes})
         )
 
+        return purged
+
     def _load_file_merge(self, s3_key, stream, columns_with_trans) -> Tuple[int, int]:
         # MERGE does insert and update
         inserts = 0
@@ -630,8 +738,11 @@ class DbSync:
                     updates = results[0].get('number of rows updated', 0)
         return inserts, updates
 
-    def load_via_snowpipe(self, s3_key, stream): #pylint: disable=too-many-locals
-        """ Performs data transfer from the stage to snowflake using snowpipe. """
+    def load_via_snowpipe(self, s3_key, stream, s3_keys=None): #pylint: disable=too-many-locals
+        """ Performs data transfer from the stage to snowflake using snowpipe.
+
+        s3_keys: Optional list of every staged file to ingest when a batch is split into multiple files
+        """
 
         def _generate_pipe_name(dbname, schema_table_name):
             stripped_db_name = dbname.replace('"', '')
@@ -720,7 +831,7 @@ class DbSync:
                                              private_key=private_key_text)
 
         # List of files, but wrapped into a class
-        staged_file_list = [StagedFile(s3_key, None)]
+        staged_file_list = [StagedFile(key, None) for key in (s3_keys or [s3_key])]
 
         # ingest files using snowpipe
         retries = self.connection_config.get('max_retry', 5)
@@ -761,7 +872,7 @@ class DbSync:
                 self.logger.debug('waiting for snowpipe to transfer data...')
                 time.sleep(next(wait_time))
 
-    def _load_file_copy(self, s3_key, stream, columns_with_trans) -> int:
+    def _load_file_copy(self, s3_key, stream, columns_with_trans, purge=False) -> int:
         # COPY does insert only
         inserts = 0
         with self.open_connection() as connection:
@@ -772,7 +883,8 @@ class DbSync:
                     s3_key=s3_key,
                     file_format_name=self.connection_config['file_format'],
                     columns=columns_with_trans,
-                    on_error=self.snowpipe_on_error
+                    on_error=self.snowpipe_on_error,
+                    purge=purge
                 )
                 self.logger.debug('Running query: %s', copy_sql)
                 cur.execute(copy_sql)
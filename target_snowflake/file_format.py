@@ -4,6 +4,7 @@ from types import ModuleType
 from typing import Callable
 
 import target_snowflake.file_formats
+import target_snowflake.file_formats.jsonl
 from target_snowflake.exceptions import FileFormatNotFoundException, InvalidFileFormatException
 
 # Supported types for file formats.
@@ -13,6 +14,7 @@ class FileFormatTypes(str, Enum):
 
     CSV = 'csv'
     PARQUET = 'parquet'
+    JSON = 'json'
 
     @staticmethod
     def list():
@@ -52,6 +54,8 @@ class FileFormat:
             formatter = target_snowflake.file_formats.csv
         elif file_format_type == FileFormatTypes.PARQUET:
             formatter = target_snowflake.file_formats.parquet
+        elif file_format_type == FileFormatTypes.JSON:
+            formatter = target_snowflake.file_formats.jsonl
         else:
             raise InvalidFileFormatException(f"Not supported file format: '{file_format_type}")
 
@@ -1,12 +1,23 @@
 """CSV file format functions"""
-import gzip
 import json
-import os
+import math
 
-from typing import Callable, Dict, List
-from tempfile import mkstemp
+from json.encoder import encode_basestring
+from typing import BinaryIO, Callable, Dict, Iterator, List, Tuple, Union
 
+from target_snowflake import compression as compressions
 from target_snowflake import flattening
+from target_snowflake.exceptions import InvalidFileFormatException
+
+# Number of CSV lines joined and written to the output file in one go
+WRITE_CHUNK_ROWS = 10000
+
+# Same output as json.dumps(value) without creating an encoder for every value. Nested values are
+# ASCII encoded like the JSON texts of the flattener
+_encode_json = json.JSONEncoder().encode
+
+# Cell of a None value in the columns typed exactly ['null', 'object', 'array'], a JSON null
+JSON_NULL_CELL = '"null"'
 
 
 def create_copy_sql(table_name: str,
@@ -14,16 +25,18 @@ def create_copy_sql(table_name: str,
                     s3_key: str,
                     file_format_name: str,
                     columns: List,
-                    on_error: str = None
-                    ):
+                    on_error: str = None,
+                    purge: bool = False):
     """Generate a CSV compatible snowflake COPY INTO command"""
     p_columns = ', '.join([c['name'] for c in columns])
     on_error_statement = f"ON_ERROR = {on_error}" if on_error else ""
+    purge_statement = " PURGE = TRUE" if purge else ""
 
     return f"COPY INTO {table_name} ({p_columns}) " \
            f"FROM '@{stage_name}/{s3_key}' " \
            f"FILE_FORMAT = (format_name='{file_format_name}')" \
-           f"{on_error_statement}"
+           f"{on_error_statement}" \
+           f"{purge_statement}"
 
 
 def create_merge_sql(table_name: str,
@@ -51,7 +64,8 @@ def create_merge_sql(table_name: str,
 
 def record_to_csv_line(record: dict,
                        schema: dict,
-                       data_flattening_max_level: int = 0) -> str:
+                       data_flattening_max_level: int = 0,
+                       flattener: flattening.RecordFlattener = None) -> str:
     """
     Transforms a record message to a CSV line
 
@@ -59,19 +73,188 @@ def record_to_csv_line(record: dict,
         record: Dictionary that represents a csv line. Dict key is column name, value is the column value
         schema: JSONSchema of the record
         data_flattening_max_level: Max level of auto flattening if a record message has nested objects. (Default: 0)
+        flattener: Optional RecordFlattener of the schema to reuse the computed column names
 
     Returns:
         string of csv line
     """
-    flatten_record = flattening.flatten_record(record, schema, max_level=data_flattening_max_level)
+    if flattener is None:
+        flattener = flattening.RecordFlattener(schema, max_level=data_flattening_max_level, dump_json=False)
+
+    return CsvRowEncoder(schema).encode(flattener.flatten(record))
+
+
+def _encode_value(value) -> str:
+    """
+    Encode a value of any type to a CSV cell. Empty string if None or empty
+
+    Nested objects and arrays are not JSON encoded by the flattener, they are quoted JSON texts
+    in any column, like in VARIANT columns.
+    """
+    if isinstance(value, (dict, list)):
+        return _encode_variant(value)
+    if value == 0 or value:
+        return json.dumps(value, ensure_ascii=False)
+
+    return ''
+
+
+def _encode_variant(value) -> str:
+    """
+    Encode a value of a VARIANT column to a quoted CSV cell of its JSON text
+
+    The value is JSON encoded once, the JSON text is only escaped for the ESCAPE='\\'
+    FIELD_OPTIONALLY_ENCLOSED_BY='"' file format and parsed by parse_json when loading.
+    Strings are already JSON texts, they are only escaped and parsed as they are.
+    """
+    if value.__class__ is str:
+        return encode_basestring(value) if value else ''
+
+    return _encode_json_variant(value)
+
+
+def _encode_json_variant(value) -> str:
+    """
+    Encode any value of a column typed exactly ['null', 'object', 'array'] to a quoted CSV cell of its JSON text
+
+    Strings are JSON encoded as well and loaded as VARIANT strings by parse_json, like the values json
+    dumped by flatten_record in these columns.
+    """
+    return '"' + _encode_json(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _is_json_dump_column(column_schema: Dict) -> bool:
+    """Every value of the column is JSON encoded, see flattening._should_json_dump_value"""
+    column_types = column_schema.get('type', [])
+    return not isinstance(column_types, str) and set(column_types) == {'null', 'object', 'array'}
+
+
+def _encode_string(value) -> str:
+    if value.__class__ is str:
+        return encode_basestring(value) if value else ''
+
+    return _encode_value(value)
+
+
+def _encode_integer(value) -> str:
+    if value.__class__ is int:
+        return int.__repr__(value)
+
+    return _encode_value(value)
+
+
+def _encode_number(value) -> str:
+    if value.__class__ is float and math.isfinite(value):
+        return float.__repr__(value)
+
+    return _encode_integer(value)
+
+
+def _encode_boolean(value) -> str:
+    if value is True:
+        return 'true'
+    if value is False:
+        return 'false'
+
+    return _encode_value(value)
+
+
+# pylint: disable=too-many-return-statements
+def _column_encoder(column_schema: Dict) -> Callable:
+    """
+    Find the encoder of a flattened schema property
+
+    Every encoder produces the same output as json.dumps but takes a shortcut for the expected type
+    and falls back to json.dumps for any other value. VARIANT columns are quoted JSON texts.
+    """
+    column_types = column_schema.get('type', [])
+    if isinstance(column_types, str):
+        column_types = [column_types]
 
-    return ','.join(
-        [
-            json.dumps(flatten_record[column], ensure_ascii=False) if column in flatten_record and (
-                    flatten_record[column] == 0 or flatten_record[column]) else ''
-            for column in schema
+    if 'anyOf' in column_schema:
+        return _encode_value
+    if _is_json_dump_column(column_schema):
+        return _encode_json_variant
+    if 'object' in column_types or 'array' in column_types:
+        return _encode_variant
+    if 'string' in column_types:
+        return _encode_string
+    if 'number' in column_types:
+        return _encode_number
+    if 'integer' in column_types:
+        return _encode_integer
+    if 'boolean' in column_types:
+        return _encode_boolean
+
+    return _encode_value
+
+
+# pylint: disable=too-few-public-methods
+class CsvRowEncoder:
+    """
+    Transforms flattened records to CSV lines using a specialized encoder for every column
+
+    The column encoders are selected once from the flattened schema instead of calling
+    json.dumps on every value. None values of the columns typed exactly ['null', 'object', 'array']
+    are JSON nulls, missing values are empty cells.
+    """
+
+    def __init__(self, schema: Dict):
+        self.columns = list(schema)
+        self.encoders = [_column_encoder(schema[column]) for column in self.columns]
+        self.json_null_columns = [(index, column) for index, column in enumerate(self.columns)
+                                  if _is_json_dump_column(schema[column])]
+
+    def encode(self, flatten_record: Dict) -> str:
+        """Transforms a flattened record to a CSV line"""
+        get = flatten_record.get
+        cells = [
+            encoder(value) if value is not None else ''
+            for encoder, value in zip(self.encoders, [get(column) for column in self.columns])
         ]
-    )
+        for index, column in self.json_null_columns:
+            if not cells[index] and column in flatten_record:
+                cells[index] = JSON_NULL_CELL
+
+        return ','.join(cells)
+
+
+# pylint: disable=unused-argument
+def flattened_record_to_csv_line(flatten_record: dict,
+                                 schema: dict,
+                                 data_flattening_max_level: int = 0) -> str:
+    """
+    Transforms an already flattened record to a CSV line
+
+    Args:
+        flatten_record: Flattened record. Dict key is column name, value is the column value. Nested objects
+                        and arrays are not JSON encoded
+        schema: Flattened JSONSchema of the record
+        data_flattening_max_level: Not used, the record is already flattened
+
+    Returns:
+        string of csv line
+    """
+    return CsvRowEncoder(schema).encode(flatten_record)
+
+
+def _csv_chunks(records: Dict,
+                schema: Dict,
+                record_to_csv_line_transformer: Callable,
+                data_flattening_max_level: int = 0) -> Iterator[bytes]:
+    """Generate encoded CSV lines of the records in chunks of WRITE_CHUNK_ROWS lines"""
+    csv_lines = []
+    for record in records.values():
+        csv_lines.append(record_to_csv_line_transformer(record, schema, data_flattening_max_level))
+
+        if len(csv_lines) >= WRITE_CHUNK_ROWS:
+            csv_lines.append('')
+            yield '\n'.join(csv_lines).encode('UTF-8')
+            csv_lines = []
+
+    if csv_lines:
+        csv_lines.append('')
+        yield '\n'.join(csv_lines).encode('UTF-8')
 
 
 def write_records_to_file(outfile,
@@ -92,18 +275,22 @@ def write_records_to_file(outfile,
     Returns:
         None
     """
-    for record in records.values():
-        csv_line = record_to_csv_line_transformer(record, schema, data_flattening_max_level)
-        outfile.write(bytes(csv_line + '\n', 'UTF-8'))
+    for chunk in _csv_chunks(records, schema, record_to_csv_line_transformer, data_flattening_max_level):
+        outfile.write(chunk)
 
 
+# pylint: disable=too-many-arguments
 def records_to_file(records: Dict,
                     schema: Dict,
                     suffix: str = 'csv',
                     prefix: str = 'batch_',
-                    compression: bool = False,
+                    compression: Union[bool, str] = False,
                     dest_dir: str = None,
-                    data_flattening_max_level: int = 0):
+                    data_flattening_max_level: int = 0,
+                    flattener: flattening.RecordFlattener = None,
+                    flattened: bool = False,
+                    compression_level: int = None,
+                    compression_threads: int = 1):
     """
     Transforms a list of dictionaries with records messages to a CSV file
 
@@ -112,30 +299,78 @@ def records_to_file(records: Dict,
         schema: JSONSchema of the records
         suffix: Generated filename suffix
         prefix: Generated filename prefix
-        compression: Gzip compression enabled or not (Default: False)
+        compression: Compression codec, gzip, zstd or none. True means gzip (Default: False)
         dest_dir: Directory where the CSV file will be generated. (Default: OS specificy temp directory)
         data_flattening_max_level: Max level of auto flattening if a record message has nested objects. (Default: 0)
+        flattener: Optional RecordFlattener of the schema. (Default: a new one for the given schema)
+        flattened: Records are already flattened. (Default: False)
+        compression_level: Compression level of the codec. (Default: 9 for gzip, 3 for zstd)
+        compression_threads: Number of threads compressing the file. (Default: 1)
 
     Returns:
         Absolute path of the generated CSV file
     """
-    if dest_dir:
-        os.makedirs(dest_dir, exist_ok=True)
+    return records_to_files(records, schema, suffix, prefix, compression, dest_dir, data_flattening_max_level,
+                            flattener, flattened, compression_level, compression_threads)[0]
 
-    if compression:
-        file_suffix = f'.{suffix}.gz'
-    else:
-        file_suffix = f'.{suffix}'
 
-    filedesc, filename = mkstemp(suffix=file_suffix, prefix=prefix, dir=dest_dir)
+# pylint: disable=too-many-arguments,too-many-locals
+def records_to_files(records: Dict,
+                     schema: Dict,
+                     suffix: str = 'csv',
+                     prefix: str = 'batch_',
+                     compression: Union[bool, str] = False,
+                     dest_dir: str = None,
+                     data_flattening_max_level: int = 0,
+                     flattener: flattening.RecordFlattener = None,
+                     flattened: bool = False,
+                     compression_level: int = None,
+                     compression_threads: int = 1,
+                     max_file_size: int = None,
+                     file_opener: Callable[[str], Tuple[str, BinaryIO]] = None) -> List[str]:
+    """
+    Transforms a list of dictionaries with records messages to one or more CSV files
+
+    A new file is started once the written, compressed size of the current file reaches
+    max_file_size. The files are named <base>_0000.csv.gz, <base>_0001.csv.gz, ... so they
+    can be loaded by their common prefix.
 
-    # Using gzip or plain file object
-    if compression:
-        with open(filedesc, 'wb') as outfile:
-            with gzip.GzipFile(filename=filename, mode='wb',fileobj=outfile) as gzipfile:
-                write_records_to_file(gzipfile, records, schema, record_to_csv_line, data_flattening_max_level)
+    Args:
+        records: List of dictionaries that represents a batch of singer record messages
+        schema: JSONSchema of the records
+        suffix: Generated filename suffix
+        prefix: Generated filename prefix
+        compression: Compression codec, gzip, zstd or none. True means gzip (Default: False)
+        dest_dir: Directory where the CSV files will be generated. (Default: OS specificy temp directory)
+        data_flattening_max_level: Max level of auto flattening if a record message has nested objects. (Default: 0)
+        flattener: Optional RecordFlattener of the schema. (Default: a new one for the given schema)
+        flattened: Records are already flattened. (Default: False)
+        compression_level: Compression level of the codec. (Default: 9 for gzip, 3 for zstd)
+        compression_threads: Number of threads compressing the files. (Default: 1)
+        max_file_size: Target size of a file in bytes. (Default: None, a single file without part number)
+        file_opener: Optional callable opening the files by their file name suffix, i.e. to write the files
+                     straight to S3. (Default: temporary files in dest_dir)
+
+    Returns:
+        List of absolute paths of the generated CSV files, or the names returned by file_opener
+    """
+    row_encoder = CsvRowEncoder(schema)
+    if flattened:
+        def record_to_csv_line_transformer(flatten_record, *_):
+            return row_encoder.encode(flatten_record)
     else:
-        with open(filedesc, 'wb') as outfile:
-            write_records_to_file(outfile, records, schema, record_to_csv_line, data_flattening_max_level)
+        if flattener is None:
+            flattener = flattening.RecordFlattener(schema, max_level=data_flattening_max_level, dump_json=False)
+
+        def record_to_csv_line_transformer(record, *_):
+            return row_encoder.encode(flattener.flatten(record))
+
+    codec = compressions.to_codec(compression)
+
+    if codec not in compressions.CSV_CODECS:
+        raise InvalidFileFormatException(
+            f"Not supported compression for CSV files: '{codec}'. Supported codecs: {compressions.CSV_CODECS}")
 
-    return filename
+    chunks = _csv_chunks(records, schema, record_to_csv_line_transformer, data_flattening_max_level)
+    return compressions.write_chunks_to_files(chunks, f'.{suffix}', prefix, codec, dest_dir,
+                                              compression_level, compression_threads, max_file_size, file_opener)
@@ -0,0 +1,179 @@
+"""Newline delimited JSON file format functions"""
+import json
+
+from typing import BinaryIO, Callable, Dict, Iterator, List, Tuple, Union
+
+from target_snowflake import compression as compressions
+from target_snowflake import flattening
+from target_snowflake.exceptions import InvalidFileFormatException
+
+# Number of JSON lines joined and written to the output file in one go
+WRITE_CHUNK_ROWS = 10000
+
+# Same output as json.dumps(value, ensure_ascii=False) without creating an encoder for every record
+_encode_record = json.JSONEncoder(ensure_ascii=False).encode
+
+
+def _source_column(column: Dict) -> str:
+    """
+    Select expression of a column of the staged JSON file
+
+    Objects and arrays are native JSON values in the file, so they don't need parse_json
+    """
+    element = f"$1:{column['json_element_name']}"
+    if column['trans'] == 'parse_json':
+        return element
+
+    return f"{column['trans']}({element})"
+
+
+def create_copy_sql(table_name: str,
+                    stage_name: str,
+                    s3_key: str,
+                    file_format_name: str,
+                    columns: List,
+                    on_error: str = None,
+                    purge: bool = False):
+    """Generate a JSON compatible snowflake COPY INTO command"""
+    p_target_columns = ', '.join([c['name'] for c in columns])
+    p_source_columns = ', '.join([f"{_source_column(c)} {c['name']}" for c in columns])
+    on_error_statement = f"ON_ERROR = {on_error}" if on_error else ""
+    purge_statement = " PURGE = TRUE" if purge else ""
+
+    return f"COPY INTO {table_name} ({p_target_columns}) " \
+           f"FROM (SELECT {p_source_columns} FROM '@{stage_name}/{s3_key}') " \
+           f"FILE_FORMAT = (format_name='{file_format_name}')" \
+           f"{on_error_statement}" \
+           f"{purge_statement}"
+
+
+def create_merge_sql(table_name: str,
+                     stage_name: str,
+                     s3_key: str,
+                     file_format_name: str,
+                     columns: List,
+                     pk_merge_condition: str) -> str:
+    """Generate a JSON compatible snowflake MERGE INTO command"""
+    p_source_columns = ', '.join([f"{_source_column(c)} {c['name']}" for c in columns])
+    p_update = ', '.join([f"{c['name']}=s.{c['name']}" for c in columns])
+    p_insert_cols = ', '.join([c['name'] for c in columns])
+    p_insert_values = ', '.join([f"s.{c['name']}" for c in columns])
+
+    return f"MERGE INTO {table_name} t USING (" \
+           f"SELECT {p_source_columns} " \
+           f"FROM '@{stage_name}/{s3_key}' " \
+           f"(FILE_FORMAT => '{file_format_name}')) s " \
+           f"ON {pk_merge_condition} " \
+           f"WHEN MATCHED THEN UPDATE SET {p_update} " \
+           "WHEN NOT MATCHED THEN " \
+           f"INSERT ({p_insert_cols}) " \
+           f"VALUES ({p_insert_values})"
+
+
+def _jsonl_chunks(flatten_records: Iterator[Dict]) -> Iterator[bytes]:
+    """Generate encoded JSON lines of the records in chunks of WRITE_CHUNK_ROWS lines"""
+    json_lines = []
+    for flatten_record in flatten_records:
+        json_lines.append(_encode_record(flatten_record))
+
+        if len(json_lines) >= WRITE_CHUNK_ROWS:
+            json_lines.append('')
+            yield '\n'.join(json_lines).encode('UTF-8')
+            json_lines = []
+
+    if json_lines:
+        json_lines.append('')
+        yield '\n'.join(json_lines).encode('UTF-8')
+
+
+# pylint: disable=too-many-arguments
+def records_to_file(records: Dict,
+                    schema: Dict,
+                    suffix: str = 'json',
+                    prefix: str = 'batch_',
+                    compression: Union[bool, str] = False,
+                    dest_dir: str = None,
+                    data_flattening_max_level: int = 0,
+                    flattener: flattening.RecordFlattener = None,
+                    flattened: bool = False,
+                    compression_level: int = None,
+                    compression_threads: int = 1):
+    """
+    Transforms a list of dictionaries with records messages to a newline delimited JSON file
+
+    Args:
+        records: List of dictionaries that represents a batch of singer record messages
+        schema: JSONSchema of the records
+        suffix: Generated filename suffix
+        prefix: Generated filename prefix
+        compression: Compression codec, gzip, zstd or none. True means gzip (Default: False)
+        dest_dir: Directory where the JSON file will be generated. (Default: OS specificy temp directory)
+        data_flattening_max_level: Max level of auto flattening if a record message has nested objects. (Default: 0)
+        flattener: Optional RecordFlattener of the schema. (Default: a new one for the given schema)
+        flattened: Records are already flattened. (Default: False)
+        compression_level: Compression level of the codec. (Default: 9 for gzip, 3 for zstd)
+        compression_threads: Number of threads compressing the file. (Default: 1)
+
+    Returns:
+        Absolute path of the generated JSON file
+    """
+    return records_to_files(records, schema, suffix, prefix, compression, dest_dir, data_flattening_max_level,
+                            flattener, flattened, compression_level, compression_threads)[0]
+
+
+# pylint: disable=too-many-arguments
+def records_to_files(records: Dict,
+                     schema: Dict,
+                     suffix: str = 'json',
+                     prefix: str = 'batch_',
+                     compression: Union[bool, str] = False,
+                     dest_dir: str = None,
+                     data_flattening_max_level: int = 0,
+                     flattener: flattening.RecordFlattener = None,
+                     flattened: bool = False,
+                     compression_level: int = None,
+                     compression_threads: int = 1,
+                     max_file_size: int = None,
+                     file_opener: Callable[[str], Tuple[str, BinaryIO]] = None) -> List[str]:
+    """
+    Transforms a list of dictionaries with records messages to one or more newline delimited JSON files
+
+    Every flattened record is one JSON object on its own line. Nested objects and arrays are kept
+    as JSON values, they are not encoded to strings. A new file is started once the written,
+    compressed size of the current file reaches max_file_size.
+
+    Args:
+        records: List of dictionaries that represents a batch of singer record messages
+        schema: JSONSchema of the records
+        suffix: Generated filename suffix
+        prefix: Generated filename prefix
+        compression: Compression codec, gzip, zstd or none. True means gzip (Default: False)
+        dest_dir: Directory where the JSON files will be generated. (Default: OS specificy temp directory)
+        data_flattening_max_level: Max level of auto flattening if a record message has nested objects. (Default: 0)
+        flattener: Optional RecordFlattener of the schema. (Default: a new one for the given schema)
+        flattened: Records are already flattened. (Default: False)
+        compression_level: Compression level of the codec. (Default: 9 for gzip, 3 for zstd)
+        compression_threads: Number of threads compressing the files. (Default: 1)
+        max_file_size: Target size of a file in bytes. (Default: None, a single file without part number)
+        file_opener: Optional callable opening the files by their file name suffix, i.e. to write the files
+                     straight to S3. (Default: temporary files in dest_dir)
+
+    Returns:
+        List of absolute paths of the generated JSON files, or the names returned by file_opener
+    """
+    if flattened:
+        flatten_records = records.values()
+    else:
+        if flattener is None:
+            flattener = flattening.RecordFlattener(schema, max_level=data_flattening_max_level, dump_json=False)
+        flatten_records = (flattener.flatten(record) for record in records.values())
+
+    codec = compressions.to_codec(compression)
+
+    if codec not in compressions.CSV_CODECS:
+        raise InvalidFileFormatException(
+            f"Not supported compression for JSON files: '{codec}'. Supported codecs: {compressions.CSV_CODECS}")
+
+    return compressions.write_chunks_to_files(_jsonl_chunks(flatten_records), f'.{suffix}', prefix, codec,
+                                              dest_dir, compression_level, compression_threads, max_file_size,
+                                              file_opener)
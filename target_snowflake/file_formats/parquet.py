@@ -1,11 +1,53 @@
 """Parquet file format functions"""
+import json
+import math
 import os
-import pandas
+import pyarrow
+import pyarrow.compute
+import pyarrow.parquet
 
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple, Union
 from tempfile import mkstemp
 
+from target_snowflake import compression as compressions
 from target_snowflake import flattening
+from target_snowflake.exceptions import InvalidFileFormatException
+
+# Arrow types of the columns by flattened schema property, date and time values stay strings
+VARIANT = 'variant'
+TIMESTAMP = 'timestamp'
+NUMBER = 'number'
+INTEGER = 'integer'
+BOOLEAN = 'boolean'
+STRING = 'string'
+
+# UTC designators and offsets are stripped before parsing date-time values as naive timestamps,
+# snowflake ignores the offsets of the date-time strings loaded into TIMESTAMP_NTZ columns as well
+OFFSET_SUFFIX_PATTERN = r'(Z|[+-]\d{2}:?\d{2})$'
+
+# Rows of a row group written by StreamingRecords if parquet_row_group_size is not set
+DEFAULT_STREAMING_ROW_GROUP_SIZE = 10000
+
+# Errors of building an arrow array from values that don't fit its type
+ARROW_CONVERSION_ERRORS = (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError, pyarrow.ArrowNotImplementedError,
+                           OverflowError, TypeError)
+
+# Same output as json.dumps(value, ensure_ascii=False) without creating an encoder for every value
+_encode_variant = json.JSONEncoder(ensure_ascii=False).encode
+
+
+def source_column(column: Dict) -> str:
+    """
+    Select expression of a column of the staged parquet file
+
+    Columns of JSON objects and arrays are native nested columns, or JSON strings if the values
+    don't fit a nested parquet type, only the JSON strings are parsed.
+    """
+    element = f"$1:{column['json_element_name']}"
+    if column['trans'] == 'parse_json':
+        return f"IFF(IS_VARCHAR({element}), PARSE_JSON({element}::VARCHAR), {element})"
+
+    return f"{column['trans']}({element})"
 
 
 def create_copy_sql(table_name: str,
@@ -13,17 +55,32 @@ def create_copy_sql(table_name: str,
                     s3_key: str,
                     file_format_name: str,
                     columns: List,
-                    on_error: str = None):
-    """Generate a Parquet compatible snowflake COPY INTO command"""
-    p_target_columns = ', '.join([c['name'] for c in columns])
-    p_source_columns = ', '.join([f"{c['trans']}($1:{c['json_element_name']}) {c['name']}"
-                                  for i, c in enumerate(columns)])
+                    on_error: str = None,
+                    purge: bool = False):
+    """
+    Generate a Parquet compatible snowflake COPY INTO command
+
+    Typed parquet columns are loaded by MATCH_BY_COLUMN_NAME if no column needs a transformation
+    """
     on_error_statement = f"ON_ERROR = {on_error}" if on_error else ""
+    purge_statement = " PURGE = TRUE" if purge else ""
+
+    if not any(c['trans'] for c in columns):
+        return f"COPY INTO {table_name} " \
+               f"FROM '@{stage_name}/{s3_key}' " \
+               f"FILE_FORMAT = (format_name='{file_format_name}') " \
+               "MATCH_BY_COLUMN_NAME = CASE_INSENSITIVE" \
+               f"{' ' + on_error_statement if on_error_statement else ''}" \
+               f"{purge_statement}"
+
+    p_target_columns = ', '.join([c['name'] for c in columns])
+    p_source_columns = ', '.join([f"{source_column(c)} {c['name']}" for c in columns])
 
     return f"COPY INTO {table_name} ({p_target_columns}) " \
            f"FROM (SELECT {p_source_columns} FROM '@{stage_name}/{s3_key}') " \
            f"FILE_FORMAT = (format_name='{file_format_name}')" \
-           f"{on_error_statement}"
+           f"{on_error_statement}" \
+           f"{purge_statement}"
 
 
 def create_merge_sql(table_name: str,
@@ -33,8 +90,7 @@ def create_merge_sql(table_name: str,
                      columns: List,
                      pk_merge_condition: str) -> str:
     """Generate a Parquet compatible snowflake MERGE INTO command"""
-    p_source_columns = ', '.join([f"{c['trans']}($1:{c['json_element_name']}) {c['name']}"
-                                  for i, c in enumerate(columns)])
+    p_source_columns = ', '.join([f"{source_column(c)} {c['name']}" for c in columns])
     p_update = ', '.join([f"{c['name']}=s.{c['name']}" for c in columns])
     p_insert_cols = ', '.join([c['name'] for c in columns])
     p_insert_values = ', '.join([f"s.{c['name']}" for c in columns])
@@ -50,63 +106,411 @@ def create_merge_sql(table_name: str,
            f"VALUES ({p_insert_values})"
 
 
-def records_to_dataframe(records: Dict,
-                         schema: Dict,
-                         data_flattening_max_level: int = 0) -> pandas.DataFrame:
+# pylint: disable=too-many-arguments
+def records_to_file(records: Dict,
+                    schema: Dict,
+                    suffix: str = 'parquet',
+                    prefix: str = 'batch_',
+                    compression: Union[bool, str] = False,
+                    dest_dir: str = None,
+                    data_flattening_max_level: int = 0,
+                    flattener: flattening.RecordFlattener = None,
+                    flattened: bool = False,
+                    compression_level: int = None,
+                    compression_threads: int = 1,
+                    row_group_size: int = None,
+                    use_dictionary: bool = True):
     """
-    Transforms a list of record messages into pandas dataframe with flattened records
+    Transforms a list of dictionaries with records messages to a parquet file
 
     Args:
         records: List of dictionaries that represents a batch of singer record messages
+        schema: JSONSchema of the records
+        suffix: Generated filename suffix
+        prefix: Generated filename prefix
+        compression: Compression codec, gzip, snappy, zstd, lz4 or none. True means gzip (Default: False)
+        dest_dir: Directory where the parquet file will be generated. (Default: OS specificy temp directory)
         data_flattening_max_level: Max level of auto flattening if a record message has nested objects. (Default: 0)
+        flattener: Optional RecordFlattener of the schema. (Default: a new one for the given schema)
+        flattened: Records are already flattened. (Default: False)
+        compression_level: Compression level of the codec. (Default: the pyarrow default of the codec)
+        compression_threads: Not used, pyarrow compresses the column chunks in its own thread pool
+        row_group_size: Max number of rows in a row group. (Default: None, the pyarrow default)
+        use_dictionary: Use dictionary encoding of the columns. (Default: True)
 
     Returns:
-        Pandas dataframe
+        Absolute path of the generated parquet file
     """
-    flattened_records = []
+    return records_to_files(records, schema, suffix, prefix, compression, dest_dir, data_flattening_max_level,
+                            flattener, flattened, compression_level, compression_threads,
+                            row_group_size=row_group_size, use_dictionary=use_dictionary)[0]
 
-    for record in records.values():
-        flatten_record = flattening.flatten_record(record, schema, max_level=data_flattening_max_level)
-        flattened_records.append(flatten_record)
 
-    return pandas.DataFrame(data=flattened_records)
+# pylint: disable=too-many-return-statements
+def column_kind(column_schema: Dict) -> str:
+    """Kind of the arrow array to build for a flattened schema property"""
+    column_types = column_schema.get('type', [])
+    if isinstance(column_types, str):
+        column_types = [column_types]
 
+    if 'anyOf' in column_schema or 'object' in column_types or 'array' in column_types:
+        return VARIANT
+    if column_schema.get('format') == 'date-time':
+        return TIMESTAMP
+    if column_schema.get('format') in ('date', 'time', 'binary') or 'string' in column_types:
+        return STRING
+    if 'number' in column_types:
+        return NUMBER
+    if 'integer' in column_types:
+        return INTEGER
+    if 'boolean' in column_types:
+        return BOOLEAN
 
-def records_to_file(records: Dict,
-                    schema: Dict,
-                    suffix: str = 'parquet',
-                    prefix: str = 'batch_',
-                    compression: bool = False,
-                    dest_dir: str = None,
-                    data_flattening_max_level: int = 0):
+    return STRING
+
+
+def _timestamp_array(values: List) -> pyarrow.Array:
+    """Naive timestamps of the local date and time if every value is an ISO-8601 date-time, strings otherwise"""
+    strings = pyarrow.array(values, type=pyarrow.string())
+    try:
+        # The compute functions are generated when pyarrow.compute is imported
+        # pylint: disable=no-member
+        naive_strings = pyarrow.compute.replace_substring_regex(strings, OFFSET_SUFFIX_PATTERN, '')
+        return pyarrow.compute.cast(naive_strings, pyarrow.timestamp('us'))
+    except pyarrow.ArrowInvalid:
+        return strings
+
+
+def _has_empty_struct(data_type: pyarrow.DataType) -> bool:
+    """Parquet can't store struct types without fields, like the type inferred from empty objects"""
+    if pyarrow.types.is_struct(data_type):
+        return data_type.num_fields == 0 or any(_has_empty_struct(field.type) for field in data_type)
+    if pyarrow.types.is_list(data_type):
+        return _has_empty_struct(data_type.value_type)
+
+    return False
+
+
+def _is_same_json(value, other) -> bool:
+    """Equal values of the same types, 1 and 1.0 are equal in python but not the same JSON"""
+    if value.__class__ is not other.__class__:
+        return False
+    if isinstance(value, dict):
+        return value.keys() == other.keys() and all(_is_same_json(item, other[key]) for key, item in value.items())
+    if isinstance(value, list):
+        return len(value) == len(other) and all(map(_is_same_json, value, other))
+
+    return value == other
+
+
+def _variant_array(values: List) -> pyarrow.Array:
     """
-    Transforms a list of dictionaries with records messages to a parquet file
+    Native nested struct or list array of JSON objects or arrays, JSON strings if they don't fit one
+
+    Objects with different keys or values of different types don't fit a nested type, struct arrays
+    would add the missing keys as nulls and integers would be cast to floats next to floats, so the
+    nested array is used only if it gives back every value with the same types. Strings are already
+    JSON texts, they are parsed as they are.
+    """
+    try:
+        array = pyarrow.array(values)
+        if (pyarrow.types.is_struct(array.type) or pyarrow.types.is_list(array.type)) \
+                and not _has_empty_struct(array.type) and _is_same_json(array.to_pylist(), values):
+            return array
+    except ARROW_CONVERSION_ERRORS:
+        pass
+
+    return _json_string_array(values)
+
+
+def _json_string_array(values: List) -> pyarrow.Array:
+    """String array of the values, strings are kept as they are and any other value is JSON encoded"""
+    return pyarrow.array([value if value is None or value.__class__ is str else _encode_variant(value)
+                          for value in values], type=pyarrow.string())
+
+
+def _integer_array(values: List) -> pyarrow.Array:
+    """int64 array, inferring the type first and casting safely rejects floats with a fraction part"""
+    return pyarrow.array(values).cast(pyarrow.int64())
+
+
+def to_arrow_array(values: List, column_schema: Dict) -> pyarrow.Array:
+    """
+    Build a typed arrow array of the values of a column
+
+    A single value that doesn't fit the type of the column, like 1.5 in an integer column or an integer
+    bigger than 64 bits, makes the whole column a string array of the JSON encoded values. Snowflake
+    casts the strings to the type of the table column when loading, like the values of CSV files.
+
+    Args:
+        values: Values of the column, None for missing values
+        column_schema: Flattened schema property of the column
+
+    Returns:
+        Arrow array of int64, float64, bool, timestamp or string type. Objects and arrays are nested
+        struct or list arrays, or JSON strings if they don't fit one.
+    """
+    try:
+        return _typed_array(values, column_kind(column_schema))
+    except ARROW_CONVERSION_ERRORS:
+        return _json_string_array(values)
+
+
+def _typed_array(values: List, kind: str) -> pyarrow.Array:
+    """Arrow array of a kind of column, raises one of ARROW_CONVERSION_ERRORS if a value doesn't fit"""
+    if kind == VARIANT:
+        return _variant_array(values)
+    if kind == TIMESTAMP:
+        return _timestamp_array(values)
+    if kind == NUMBER:
+        return pyarrow.array(values, type=pyarrow.float64())
+    if kind == INTEGER:
+        return _integer_array(values)
+    if kind == BOOLEAN:
+        return pyarrow.array(values, type=pyarrow.bool_())
+
+    return pyarrow.array(values, type=pyarrow.string())
+
+
+def records_to_table(records: Dict,
+                     schema: Dict,
+                     data_flattening_max_level: int = 0,
+                     flattener: flattening.RecordFlattener = None,
+                     flattened: bool = False) -> pyarrow.Table:
+    """
+    Transforms a list of record messages into an arrow table with a typed column for every schema property
+
+    Args:
+        records: List of dictionaries that represents a batch of singer record messages
+        schema: Flattened JSONSchema of the records
+        data_flattening_max_level: Max level of auto flattening if a record message has nested objects. (Default: 0)
+        flattener: Optional RecordFlattener of the schema. (Default: a new one for the given schema)
+        flattened: Records are already flattened. (Default: False)
+
+    Returns:
+        Arrow table
+    """
+    if flattened:
+        flattened_records = list(records.values())
+    else:
+        if flattener is None:
+            flattener = flattening.RecordFlattener(schema, max_level=data_flattening_max_level, dump_json=False)
+        flattened_records = [flattener.flatten(record) for record in records.values()]
+
+    arrays = [to_arrow_array([record.get(column) for record in flattened_records], column_schema)
+              for column, column_schema in schema.items()]
+
+    return pyarrow.Table.from_arrays(arrays, names=list(schema))
+
+
+# pylint: disable=unused-argument,too-many-arguments,too-many-locals
+def records_to_files(records: Dict,
+                     schema: Dict,
+                     suffix: str = 'parquet',
+                     prefix: str = 'batch_',
+                     compression: Union[bool, str] = False,
+                     dest_dir: str = None,
+                     data_flattening_max_level: int = 0,
+                     flattener: flattening.RecordFlattener = None,
+                     flattened: bool = False,
+                     compression_level: int = None,
+                     compression_threads: int = 1,
+                     max_file_size: int = None,
+                     row_group_size: int = None,
+                     use_dictionary: bool = True) -> List[str]:
+    """
+    Transforms a list of dictionaries with records messages to one or more parquet files
+
+    The rows are split evenly between the files by the in-memory size of the arrow table, so the
+    compressed files are usually smaller than max_file_size. The files are named
+    <base>_0000.parquet, <base>_0001.parquet, ... so they can be loaded by their common prefix.
 
     Args:
         records: List of dictionaries that represents a batch of singer record messages
         schema: JSONSchema of the records
         suffix: Generated filename suffix
         prefix: Generated filename prefix
-        compression: Gzip compression enabled or not (Default: False)
-        dest_dir: Directory where the parquet file will be generated. (Default: OS specificy temp directory)
+        compression: Compression codec, gzip, snappy, zstd, lz4 or none. True means gzip (Default: False)
+        dest_dir: Directory where the parquet files will be generated. (Default: OS specificy temp directory)
         data_flattening_max_level: Max level of auto flattening if a record message has nested objects. (Default: 0)
+        flattener: Optional RecordFlattener of the schema. (Default: a new one for the given schema)
+        flattened: Records are already flattened. (Default: False)
+        compression_level: Compression level of the codec. (Default: the pyarrow default of the codec)
+        compression_threads: Not used, pyarrow compresses the column chunks in its own thread pool
+        max_file_size: Target size of a file in bytes. (Default: None, a single file without part number)
+        row_group_size: Max number of rows in a row group. (Default: None, the pyarrow default)
+        use_dictionary: Use dictionary encoding of the columns. (Default: True)
 
     Returns:
-        Absolute path of the generated parquet file
+        List of absolute paths of the generated parquet files
     """
+    if isinstance(records, StreamingRecords):
+        return records.close()
+
     if dest_dir:
         os.makedirs(dest_dir, exist_ok=True)
 
-    if compression:
+    parquet_compression, file_suffix = _compression_and_file_suffix(compression, suffix)
+    compression_level = _compression_level(parquet_compression, compression_level)
+
+    table = records_to_table(records, schema, data_flattening_max_level, flattener, flattened)
+
+    def write_table(table_part: pyarrow.Table, filename: str) -> None:
+        pyarrow.parquet.write_table(table_part,
+                                    filename,
+                                    compression=parquet_compression,
+                                    compression_level=compression_level,
+                                    row_group_size=row_group_size,
+                                    use_dictionary=use_dictionary)
+
+    if not max_file_size:
+        filedesc, filename = mkstemp(suffix=file_suffix, prefix=prefix, dir=dest_dir)
+        os.close(filedesc)
+        write_table(table, filename)
+        return [filename]
+
+    n_files = max(1, math.ceil(table.nbytes / max_file_size))
+    rows_per_file = max(1, math.ceil(table.num_rows / n_files))
+
+    base_filename = None
+    filenames = []
+    for start in range(0, max(table.num_rows, 1), rows_per_file):
+        base_filename, filename = _create_part_file(base_filename, len(filenames), file_suffix, prefix, dest_dir)
+        write_table(table.slice(start, rows_per_file), filename)
+        filenames.append(filename)
+
+    return filenames
+
+
+def _compression_and_file_suffix(compression: Union[bool, str], suffix: str) -> Tuple[str, str]:
+    """pyarrow compression and file name suffix of a compression codec"""
+    codec = compressions.to_codec(compression)
+
+    if codec not in compressions.PARQUET_CODECS:
+        raise InvalidFileFormatException(
+            f"Not supported compression for parquet files: '{codec}'. "
+            f"Supported codecs: {compressions.PARQUET_CODECS}")
+
+    # Parquet files are compressed internally, gzip keeps the .gz suffix for backward compatibility
+    if codec == compressions.GZIP:
         file_suffix = f'.{suffix}.gz'
-        parquet_compression='gzip'
     else:
         file_suffix = f'.{suffix}'
-        parquet_compression = None
 
-    filename = mkstemp(suffix=file_suffix, prefix=prefix, dir=dest_dir)[1]
+    return (codec if codec != compressions.NONE else 'none'), file_suffix
+
+
+def _compression_level(parquet_compression: str, compression_level: Optional[int]) -> Optional[int]:
+    """Compression level passed to pyarrow, None for codecs without compression levels"""
+    if parquet_compression not in compressions.LEVEL_RANGES:
+        return None
+
+    return compression_level
+
+
+def _create_part_file(base_filename: Optional[str],
+                      part: int,
+                      file_suffix: str,
+                      prefix: str,
+                      dest_dir: str = None) -> Tuple[str, str]:
+    """Create the empty file of a part named <base>_<part>.<suffix>, the base is generated for the first part"""
+    if base_filename is None:
+        first_file_suffix = f'_{part:04d}{file_suffix}'
+        filedesc, filename = mkstemp(suffix=first_file_suffix, prefix=prefix, dir=dest_dir)
+        os.close(filedesc)
+        return filename[:-len(first_file_suffix)], filename
+
+    filename = f'{base_filename}_{part:04d}{file_suffix}'
+    os.close(os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600))
+    return base_filename, filename
+
+
+# pylint: disable=too-many-instance-attributes
+class StreamingRecords:
+    """
+    Buffer of the flattened records of an append only stream, written to parquet files in row groups
+
+    It's used instead of the dictionary of records in records_to_load, so only one row group of
+    records is kept in memory. Keys are not stored, it's used only for streams without key
+    properties where every record has a unique key. A new file is started when a row group doesn't
+    fit the arrow schema of the current file or the file reached max_file_size.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self,
+                 schema: Dict,
+                 suffix: str = 'parquet',
+                 prefix: str = 'batch_',
+                 compression: Union[bool, str] = False,
+                 dest_dir: str = None,
+                 compression_level: int = None,
+                 max_file_size: int = None,
+                 row_group_size: int = None,
+                 use_dictionary: bool = True):
+        if dest_dir:
+            os.makedirs(dest_dir, exist_ok=True)
+
+        self.schema = schema
+        self.prefix = prefix
+        self.dest_dir = dest_dir
+        self.max_file_size = max_file_size
+        self.row_group_size = row_group_size or DEFAULT_STREAMING_ROW_GROUP_SIZE
+        self.use_dictionary = use_dictionary
+        self.parquet_compression, self.file_suffix = _compression_and_file_suffix(compression, suffix)
+        self.compression_level = _compression_level(self.parquet_compression, compression_level)
+        self.filenames: List[str] = []
+        self._base_filename = None
+        self._writer: Optional[pyarrow.parquet.ParquetWriter] = None
+        self._rows: List[Dict] = []
+        self._count = 0
+
+    def __setitem__(self, key: str, flatten_record: Dict) -> None:
+        self._rows.append(flatten_record)
+        self._count += 1
+        if len(self._rows) >= self.row_group_size:
+            self._write_row_group()
+
+    def __contains__(self, key: str) -> bool:
+        return False
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _write_row_group(self) -> None:
+        table = records_to_table(dict(enumerate(self._rows)), self.schema, flattened=True)
+        self._rows = []
+
+        if self._writer is not None:
+            file_size = os.path.getsize(self.filenames[-1])
+            if self.max_file_size and file_size >= self.max_file_size:
+                self._close_writer()
+            else:
+                try:
+                    table = table.cast(self._writer.schema)
+                except (pyarrow.ArrowInvalid, pyarrow.ArrowNotImplementedError):
+                    self._close_writer()
+
+        if self._writer is None:
+            self._base_filename, filename = _create_part_file(self._base_filename, len(self.filenames),
+                                                              self.file_suffix, self.prefix, self.dest_dir)
+            self.filenames.append(filename)
+            self._writer = pyarrow.parquet.ParquetWriter(filename,
+                                                         table.schema,
+                                                         compression=self.parquet_compression,
+                                                         compression_level=self.compression_level,
+                                                         use_dictionary=self.use_dictionary)
+
+        self._writer.write_table(table, row_group_size=self.row_group_size)
+
+    def _close_writer(self) -> None:
+        self._writer.close()
+        self._writer = None
 
-    dataframe = records_to_dataframe(records, schema, data_flattening_max_level)
-    dataframe.to_parquet(filename, compression=parquet_compression)
+    def close(self) -> List[str]:
+        """Write the remaining records and return the list of absolute paths of the generated parquet files"""
+        if self._rows or not self.filenames:
+            self._write_row_group()
+        if self._writer is not None:
+            self._close_writer()
 
-    return filename
+        return self.filenames
@@ -111,3 +111,94 @@ def flatten_record(d, schema=None, parent_key=None, sep='__', level=0, max_level
             items.append((new_key, json.dumps(v) if _should_json_dump_value(k, v, schema) else v))
 
     return dict(items)
+
+
+# Max number of column names cached by a RecordFlattener without a flatten schema
+MAX_CACHED_COLUMN_NAMES = 10000
+
+
+# pylint: disable=too-few-public-methods
+class RecordFlattener:
+    """Flattens the records of a stream like flatten_record, with column names computed once
+
+    The column name of a key only depends on its parent keys and the separator, so
+    the result of flatten_key is cached per parent path. Only the columns of the flatten
+    schema are cached, or up to MAX_CACHED_COLUMN_NAMES names without a schema, so records
+    with arbitrary keys don't grow the cache without limits. Keys whose values have to be
+    json dumped according to the flatten schema are also computed once.
+    """
+
+    def __init__(self, schema=None, max_level=0, sep='__', dump_json=True):
+        """
+        Params:
+            schema: Flatten schema of the stream as returned by flatten_schema
+            max_level: Max level of auto flattening if a record message has nested objects
+            sep: Separator of the nested keys in the flattened column names
+            dump_json: Json dump the not flattened objects and arrays. If False they are kept as
+                       python objects for file formats with nested types
+        """
+        self.schema = schema
+        self.max_level = max_level
+        self.sep = sep
+        self.dump_json = dump_json
+        self._json_dump_keys = frozenset(
+            key for key, value in (schema or {}).items()
+            if 'type' in value and set(value['type']) == {'null', 'object', 'array'}) if dump_json else frozenset()
+        # Column names by parent path and key
+        self._column_names = {(): {}}
+        self._cached_count = 0
+
+    def flatten(self, record):
+        """Flatten a record to a dictionary of column names and values"""
+        if self.max_level == 0:
+            return self._flatten_top_level(record)
+
+        flattened = {}
+        self._flatten(record, (), 0, flattened)
+        return flattened
+
+    def _flatten_top_level(self, record):
+        column_names = self._column_names[()]
+        json_dump_keys = self._json_dump_keys
+        dump_json = self.dump_json
+        flattened = {}
+        for key, value in record.items():
+            column_name = column_names.get(key)
+            if column_name is None:
+                column_name = self._cache_column_name((), key)
+
+            if (dump_json and isinstance(value, (dict, list))) or key in json_dump_keys:
+                value = json.dumps(value)
+
+            flattened[column_name] = value
+
+        return flattened
+
+    def _flatten(self, d, parent_path, level, flattened):
+        column_names = self._column_names.get(parent_path, {})
+
+        for key, value in d.items():
+            if isinstance(value, collections.abc.MutableMapping) and level < self.max_level:
+                self._flatten(value, parent_path + (key,), level + 1, flattened)
+                continue
+
+            column_name = column_names.get(key)
+            if column_name is None:
+                column_name = self._cache_column_name(parent_path, key)
+
+            if (self.dump_json and isinstance(value, (dict, list))) or key in self._json_dump_keys:
+                value = json.dumps(value)
+
+            flattened[column_name] = value
+
+    def _cache_column_name(self, parent_path, key):
+        """Compute the column name of a key, cached if it's a column of the schema or below the limit"""
+        column_name = flatten_key(key, list(parent_path), self.sep)
+        if self.schema is not None and column_name not in self.schema:
+            return column_name
+        if self.schema is None and self._cached_count >= MAX_CACHED_COLUMN_NAMES:
+            return column_name
+
+        self._column_names.setdefault(parent_path, {})[key] = column_name
+        self._cached_count += 1
+        return column_name
@@ -0,0 +1,98 @@
+"""Background loading of stream batches while the main loop keeps consuming singer messages"""
+import copy
+
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+# Max number of flushes loading in the background before the main loop waits for the oldest one
+DEFAULT_MAX_PENDING_FLUSHES = 1
+
+
+class FlushPipeline:
+    """Hands off full batches to background flush workers.
+
+    Batches of the same stream are loaded in the order they were submitted. The
+    state registered with a checkpoint is emitted only after every batch of the
+    checkpoint and every earlier checkpoint is loaded successfully.
+    """
+
+    def __init__(self,
+                 max_workers: int,
+                 emit_state_fn: Callable[[Optional[Dict]], None],
+                 max_pending_flushes: int = DEFAULT_MAX_PENDING_FLUSHES):
+        """
+        Params:
+            max_workers: Number of threads loading batches in the background
+            emit_state_fn: Function to emit a state once the corresponding batches are loaded
+            max_pending_flushes: Max number of checkpoints in progress. Registering a new checkpoint
+                                 blocks until the number of pending checkpoints goes below this limit
+        """
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix='flush')
+        self._emit_state = emit_state_fn
+        self._max_pending_flushes = max(1, max_pending_flushes)
+        self._last_batch: Dict[str, Future] = {}
+        self._in_flight: List[Future] = []
+        self._pending: Deque[Tuple[List[Future], Optional[Dict]]] = deque()
+
+    def submit(self, stream: str, load_fn: Callable, kwargs: Optional[Dict] = None) -> Future:
+        """Load a batch of a stream in the background, after every previously submitted batch of the stream
+
+        Params:
+            stream: Name of the stream
+            load_fn: Function that loads the batch
+            kwargs: Keyword arguments of load_fn
+        """
+        future = self._executor.submit(self._load_in_order, self._last_batch.get(stream), load_fn, kwargs)
+        self._last_batch[stream] = future
+        self._in_flight = [f for f in self._in_flight if not f.done()] + [future]
+        return future
+
+    def checkpoint(self, futures: List[Future], state: Optional[Dict]) -> None:
+        """Emit the state once the futures completed. Blocks while too many checkpoints are pending"""
+        self._pending.append((futures, copy.deepcopy(state)))
+        self.emit_completed_states()
+
+        while len(self._pending) > self._max_pending_flushes:
+            self._emit_oldest_state()
+
+    def emit_completed_states(self) -> None:
+        """Emit the states of every completed checkpoint without blocking"""
+        while self._pending and all(future.done() for future in self._pending[0][0]):
+            self._emit_oldest_state()
+
+    def wait_for_stream(self, stream: str) -> None:
+        """Wait until every submitted batch of a stream is loaded"""
+        future = self._last_batch.get(stream)
+        if future is not None:
+            future.result()
+        self.emit_completed_states()
+
+    def wait_all(self) -> None:
+        """Wait until every submitted batch is loaded and emit the pending states"""
+        while self._pending:
+            self._emit_oldest_state()
+
+        for future in self._last_batch.values():
+            future.result()
+
+    def shutdown(self) -> None:
+        """Cancel the batches that are not loading yet and wait for the running ones"""
+        for future in self._in_flight:
+            future.cancel()
+        self._executor.shutdown(wait=True)
+
+    def _emit_oldest_state(self) -> None:
+        futures, state = self._pending.popleft()
+        for future in futures:
+            # Re-raises the exception of a failed flush in the main thread
+            future.result()
+        self._emit_state(state)
+
+    @staticmethod
+    def _load_in_order(previous_batch: Optional[Future], load_fn: Callable, kwargs: Dict) -> None:
+        # Submission order guarantees that the previous batch is already running or done,
+        # waiting for it cannot block on a batch that is still in the executor queue
+        if previous_batch is not None:
+            previous_batch.result()
+        load_fn(**(kwargs or {}))
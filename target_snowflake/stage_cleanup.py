@@ -0,0 +1,45 @@
+"""Batched removal of the loaded files from the stages"""
+import threading
+
+from typing import Dict, List, Tuple
+
+from target_snowflake.upload_clients.base_upload_client import BaseUploadClient
+
+# Max number of keys deleted by one request, S3 delete_objects accepts up to 1000 keys
+DEFAULT_BATCH_SIZE = 1000
+
+
+class StageCleanup:
+    """Thread safe queue of the loaded files to delete from the stages in batches
+
+    Keys are grouped by upload client and stream. A full batch is deleted right away by the
+    flush worker that queued its last key, the remaining keys are deleted by flush() at the
+    end of the run.
+    """
+
+    def __init__(self, batch_size: int = DEFAULT_BATCH_SIZE):
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._keys: Dict[Tuple[BaseUploadClient, str], List[str]] = {}
+
+    def add(self, upload_client: BaseUploadClient, stream: str, keys: List[str]) -> None:
+        """Queue loaded files to delete, deletes the full batches of the stream"""
+        batches = []
+        with self._lock:
+            queued_keys = self._keys.setdefault((upload_client, stream), [])
+            queued_keys.extend(keys)
+            while len(queued_keys) >= self.batch_size:
+                batches.append(queued_keys[:self.batch_size])
+                del queued_keys[:self.batch_size]
+
+        for batch in batches:
+            upload_client.delete_objects(stream, batch)
+
+    def flush(self) -> None:
+        """Delete every queued file"""
+        with self._lock:
+            queued, self._keys = self._keys, {}
+
+        for (upload_client, stream), keys in queued.items():
+            for start in range(0, len(keys), self.batch_size):
+                upload_client.delete_objects(stream, keys[start:start + self.batch_size])
@@ -1,5 +1,7 @@
 """Schema and singer message funtionalities"""
-from typing import Dict, List
+import re
+
+from typing import Dict, Iterator, List
 
 from datetime import datetime
 from dateutil import parser
@@ -18,6 +20,14 @@ MAX_TIMESTAMP = '9999-12-31 23:59:59.999999'
 # max time supported in SF, used to reset all invalid times that are beyond this value
 MAX_TIME = '23:59:59.999999'
 
+DATETIME_FORMATS = {'date-time', 'time', 'date'}
+
+# Strict ISO-8601 date, date-time and time strings
+ISO_DATETIME_RE = re.compile(r'(\d{4})-(\d{2})-(\d{2})'
+                             r'(?:[T ](\d{2}):(\d{2})(?::(\d{2})(?:\.(\d{1,9}))?)?'
+                             r'(?:Z|[+-](?:[01]\d|2[0-3]):?[0-5]\d)?)?$')
+ISO_TIME_RE = re.compile(r'(\d{2}):(\d{2})(?::(\d{2})(?:\.(\d{1,9}))?)?$')
+
 
 def get_schema_names_from_config(config: Dict) -> List:
     """Get list of target schema name from config"""
@@ -35,41 +45,84 @@ def get_schema_names_from_config(config: Dict) -> List:
     return schema_names
 
 
-def adjust_timestamps_in_record(record: Dict, schema: Dict) -> None:
+def get_datetime_fields(schema: Dict) -> Dict[str, str]:
+    """
+    Find the properties of type date/datetime/time in a schema
+
+    Args:
+        schema: json schema that has types of each property
+
+    Returns:
+        Dictionary of property names and their date, date-time or time format
+    """
+    datetime_fields = {}
+    for key, property_schema in schema.get('properties', {}).items():
+        if 'anyOf' in property_schema:
+            type_dicts = property_schema['anyOf']
+        else:
+            type_dicts = [property_schema]
+
+        for type_dict in type_dicts:
+            if 'string' in type_dict.get('type', []) and type_dict.get('format', None) in DATETIME_FORMATS:
+                datetime_fields[key] = type_dict['format']
+                break
+
+    return datetime_fields
+
+
+def _is_iso_datetime(value: str) -> bool:
+    """Strict and fast ISO-8601 check, every string accepted here is parsed by dateutil as well"""
+    match = ISO_DATETIME_RE.match(value)
+    if match:
+        year, month, day, hour, minute, second, fraction = match.groups()
+    else:
+        match = ISO_TIME_RE.match(value)
+        if not match:
+            return False
+        year, month, day = 2000, 1, 1
+        hour, minute, second, fraction = match.groups()
+
+    try:
+        datetime(int(year), int(month), int(day), int(hour or 0), int(minute or 0), int(second or 0),
+                 int((fraction or '0')[:6].ljust(6, '0')))
+    except ValueError:
+        return False
+
+    return True
+
+
+def adjust_timestamps_in_record(record: Dict, schema: Dict, datetime_fields: Dict[str, str] = None) -> None:
     """
     Goes through every field that is of type date/datetime/time and if its value is out of range,
     resets it to MAX value accordingly
     Args:
         record: record containing properties and values
         schema: json schema that has types of each property
+        datetime_fields: Optional result of get_datetime_fields for the schema. Computed if not provided
     """
+    if datetime_fields is None:
+        datetime_fields = get_datetime_fields(schema)
+
+    for key, _format in datetime_fields.items():
+        value = record.get(key)
+        if value is None:
+            continue
 
-    # creating this internal function to avoid duplicating code and too many nested blocks.
-    def reset_new_value(record: Dict, key: str, _format: str):
-        if not isinstance(record[key], str):
+        if not isinstance(value, str):
             raise UnexpectedValueTypeException(
-                f'Value {record[key]} of key "{key}" is not a string.')
+                f'Value {value} of key "{key}" is not a string.')
+
+        # Fall back to the slow but lenient dateutil parser only if the value is not strict ISO-8601
+        if _is_iso_datetime(value):
+            continue
 
         try:
-            parser.parse(record[key])
+            parser.parse(value)
         except ParserError:
             LOGGER.warning('Parsing the %s "%s" in key "%s" has failed, thus defaulting to max '
-                           'acceptable value of %s in Snowflake', _format, record[key], key, _format)
+                           'acceptable value of %s in Snowflake', _format, value, key, _format)
             record[key] = MAX_TIMESTAMP if _format != 'time' else MAX_TIME
 
-    # traverse the schema looking for properties of some date type
-    for key, value in record.items():
-        if value is not None and key in schema['properties']:
-            if 'anyOf' in schema['properties'][key]:
-                for type_dict in schema['properties'][key]['anyOf']:
-                    if 'string' in type_dict['type'] and type_dict.get('format', None) in {'date-time', 'time', 'date'}:
-                        reset_new_value(record, key, type_dict['format'])
-                        break
-            else:
-                if 'string' in schema['properties'][key]['type'] and \
-                        schema['properties'][key].get('format', None) in {'date-time', 'time', 'date'}:
-                    reset_new_value(record, key, schema['properties'][key]['format'])
-
 
 def float_to_decimal(value):
     """Walk the given data structure and turn all instances of float into double."""
@@ -82,6 +135,143 @@ def float_to_decimal(value):
     return value
 
 
+def _is_decimal_keyword(schema: Dict) -> bool:
+    """Check if the keywords of a schema compare numbers that have to be Decimal to validate precisely"""
+    if 'multipleOf' in schema:
+        return True
+
+    for keyword in ['enum', 'const', 'minimum', 'maximum', 'exclusiveMinimum', 'exclusiveMaximum']:
+        if keyword in schema and _contains_fractional_number(schema[keyword]):
+            return True
+
+    return False
+
+
+def _contains_fractional_number(value) -> bool:
+    if isinstance(value, (float, Decimal)):
+        return True
+    if isinstance(value, list):
+        return any(_contains_fractional_number(child) for child in value)
+    if isinstance(value, dict):
+        return any(_contains_fractional_number(child) for child in value.values())
+    return False
+
+
+def _resolve_ref(root: Dict, ref: str):
+    if not ref.startswith('#'):
+        return None
+
+    resolved = root
+    for part in [p for p in ref[1:].split('/') if p]:
+        if not isinstance(resolved, dict) or part not in resolved:
+            return None
+        resolved = resolved[part]
+
+    return resolved
+
+
+def _needs_decimal(schema, root: Dict, seen_refs: set) -> bool:
+    """Check if any part of a schema, including the referenced definitions, needs Decimal values"""
+    if isinstance(schema, list):
+        return any(_needs_decimal(child, root, seen_refs) for child in schema)
+    if not isinstance(schema, dict):
+        return False
+    if _is_decimal_keyword(schema):
+        return True
+
+    ref = schema.get('$ref')
+    if isinstance(ref, str) and ref not in seen_refs:
+        seen_refs.add(ref)
+        resolved = _resolve_ref(root, ref)
+        # Unknown references are assumed to need Decimal values
+        if resolved is None or _needs_decimal(resolved, root, seen_refs):
+            return True
+
+    return any(_needs_decimal(subschema, root, seen_refs) for subschema in _subschemas(schema))
+
+
+def _subschemas(schema: Dict) -> Iterator:
+    """Generate the subschemas of a schema, lists of subschemas are not unpacked"""
+    for keyword, value in schema.items():
+        if keyword in ['properties', 'patternProperties', 'dependencies'] and isinstance(value, dict):
+            yield list(value.values())
+        elif keyword in ['items', 'additionalItems', 'additionalProperties', 'anyOf', 'allOf', 'oneOf', 'not',
+                         'if', 'then', 'else', 'contains', 'propertyNames']:
+            yield value
+
+
+# Key of the array items in the tree returned by get_decimal_paths
+DECIMAL_PATH_ITEMS = object()
+
+
+def get_decimal_paths(schema: Dict, root: Dict = None):
+    """
+    Find the values of the records that have to be converted to Decimal for validation, i.e.
+    numbers validated by multipleOf.
+
+    Args:
+        schema: JSON schema of the records
+        root: Root schema to resolve references. (Default: schema)
+
+    Returns:
+        None if no value has to be converted, True if the whole value has to be converted,
+        or a dictionary of the property names, and DECIMAL_PATH_ITEMS for array items,
+        with the paths to convert in the nested values
+    """
+    if root is None:
+        root = schema
+
+    if not isinstance(schema, dict) or not _needs_decimal(schema, root, set()):
+        return None
+
+    # The whole value is converted if its own keywords need Decimal values or
+    # the affected parts are not addressable by property names or array items
+    if _is_decimal_keyword(schema) or '$ref' in schema or isinstance(schema.get('items'), list) or any(
+            keyword in schema for keyword in ['additionalItems', 'anyOf', 'allOf', 'oneOf', 'not', 'if', 'then',
+                                              'else', 'contains', 'dependencies', 'patternProperties']) or \
+            isinstance(schema.get('additionalProperties'), dict):
+        return True
+
+    paths = {}
+    for name, property_schema in schema.get('properties', {}).items():
+        property_paths = get_decimal_paths(property_schema, root)
+        if property_paths is not None:
+            paths[name] = property_paths
+
+    items_paths = get_decimal_paths(schema.get('items'), root)
+    if items_paths is not None:
+        paths[DECIMAL_PATH_ITEMS] = items_paths
+
+    return paths or True
+
+
+def float_to_decimal_paths(value, paths):
+    """
+    Turn float values into Decimal only at the paths returned by get_decimal_paths.
+    The given value is not modified, only the containers on the converted paths are copied.
+    """
+    if paths is None:
+        return value
+    if paths is True:
+        return float_to_decimal(value)
+
+    if isinstance(value, dict):
+        converted = None
+        for key, key_paths in paths.items():
+            if key is not DECIMAL_PATH_ITEMS and key in value:
+                new_value = float_to_decimal_paths(value[key], key_paths)
+                if new_value is not value[key]:
+                    if converted is None:
+                        converted = dict(value)
+                    converted[key] = new_value
+        return value if converted is None else converted
+
+    if isinstance(value, list) and DECIMAL_PATH_ITEMS in paths:
+        return [float_to_decimal_paths(child, paths[DECIMAL_PATH_ITEMS]) for child in value]
+
+    return value
+
+
 def add_metadata_values_to_record(record_message):
     """Populate metadata _sdc columns from incoming record message
     The location of the required attributes are fixed in the stream
@@ -2,6 +2,8 @@
 Base class for upload clients
 """
 from abc import ABC, abstractmethod
+from typing import List
+
 from singer import get_logger
 
 
@@ -19,12 +21,25 @@ class BaseUploadClient(ABC):
         Upload file
         """
 
+    def upload_files(self, files: List[str], stream: str, temp_dir: str = None, s3_key_prefix=None) -> List[str]:
+        """
+        Upload the parts of a load file. The keys of the parts share a common prefix
+        """
+        return [self.upload_file(file, stream, temp_dir=temp_dir, s3_key_prefix=s3_key_prefix) for file in files]
+
     @abstractmethod
     def delete_object(self, stream: str, key: str) -> None:
         """
         Delete object
         """
 
+    def delete_objects(self, stream: str, keys: List[str]) -> None:
+        """
+        Delete objects, one by one by default
+        """
+        for key in keys:
+            self.delete_object(stream, key)
+
     @abstractmethod
     def copy_object(self, copy_source: str, target_bucket: str, target_key: str, target_metadata: dict) -> None:
         """
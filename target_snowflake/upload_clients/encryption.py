@@ -0,0 +1,126 @@
+"""
+Streaming client side encryption of the files uploaded to S3
+"""
+import base64
+import os
+
+from typing import BinaryIO
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+BLOCK_SIZE = algorithms.AES.block_size // 8
+
+# Size of the chunks read from the source file when encrypting a file
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class StreamEncryptor:
+    """
+    Encrypts a stream of data in chunks, in the same format as SnowflakeEncryptionUtil.encrypt_file
+
+    The data is encrypted by AES-CBC with a random file key and PKCS7 padding. The file key is
+    encrypted by the master key, it's sent with the iv in the x-amz-key and x-amz-iv metadata
+    of the S3 object. Snowflake decrypts the file with the master key of the stage.
+    """
+
+    def __init__(self, master_key: str):
+        decoded_key = base64.standard_b64decode(master_key)
+        file_key = os.urandom(len(decoded_key))
+        iv_data = os.urandom(BLOCK_SIZE)
+        backend = default_backend()
+
+        key_padder = padding.PKCS7(algorithms.AES.block_size).padder()
+        key_encryptor = Cipher(algorithms.AES(decoded_key), modes.ECB(), backend=backend).encryptor()
+        encrypted_file_key = key_encryptor.update(key_padder.update(file_key) + key_padder.finalize()) \
+            + key_encryptor.finalize()
+
+        self.metadata = {
+            'x-amz-key': base64.b64encode(encrypted_file_key).decode('utf-8'),
+            'x-amz-iv': base64.b64encode(iv_data).decode('utf-8'),
+        }
+        self._padder = padding.PKCS7(algorithms.AES.block_size).padder()
+        self._encryptor = Cipher(algorithms.AES(file_key), modes.CBC(iv_data), backend=backend).encryptor()
+
+    def update(self, data: bytes) -> bytes:
+        """Encrypt the next chunk of the data, returns the encrypted full blocks"""
+        return self._encryptor.update(self._padder.update(data))
+
+    def finalize(self) -> bytes:
+        """Encrypt the padded last block"""
+        return self._encryptor.update(self._padder.finalize()) + self._encryptor.finalize()
+
+
+def encrypted_size(size: int) -> int:
+    """Size of the encrypted data of a given size, the padding adds a full block to aligned data"""
+    return (size // BLOCK_SIZE + 1) * BLOCK_SIZE
+
+
+# pylint: disable=too-few-public-methods
+class EncryptingReader:
+    """Readable file object returning the encrypted content of a source file object"""
+
+    def __init__(self, src: BinaryIO, encryptor: StreamEncryptor):
+        self._src = src
+        self._encryptor = encryptor
+        self._buffer = b''
+        self._finalized = False
+
+    def read(self, size: int = -1) -> bytes:
+        """Read up to size bytes of encrypted data, everything if size is negative"""
+        while not self._finalized and (size < 0 or len(self._buffer) < size):
+            chunk = self._src.read(READ_CHUNK_SIZE if size < 0 else max(size, READ_CHUNK_SIZE))
+            if chunk:
+                self._buffer += self._encryptor.update(chunk)
+            else:
+                self._buffer += self._encryptor.finalize()
+                self._finalized = True
+
+        if size < 0:
+            data, self._buffer = self._buffer, b''
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+
+        return data
+
+
+class EncryptingWriter:
+    """Write only file object encrypting the written data into another file object"""
+
+    def __init__(self, out: BinaryIO, encryptor: StreamEncryptor):
+        self._out = out
+        self._encryptor = encryptor
+        self.closed = False
+
+    def write(self, data: bytes) -> int:
+        """Encrypt the data and write the encrypted full blocks"""
+        self._out.write(self._encryptor.update(data))
+        return len(data)
+
+    def tell(self) -> int:
+        """Number of encrypted bytes written"""
+        return self._out.tell()
+
+    def flush(self) -> None:
+        """Only full blocks can be encrypted, nothing to flush"""
+
+    def close(self) -> None:
+        """Write the last encrypted block and close the output file object"""
+        if self.closed:
+            return
+
+        self._out.write(self._encryptor.finalize())
+        self._out.close()
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Let the output file object handle the error, i.e. abort the multipart upload
+            self.closed = True
+            self._out.__exit__(exc_type, exc_value, traceback)
@@ -2,13 +2,37 @@
 S3 Upload Client
 """
 import os
+import threading
+import time
+import uuid
 import boto3
 import datetime
 
-from snowflake.connector.encryption_util import SnowflakeEncryptionUtil
-from snowflake.connector.storage_client import SnowflakeFileEncryptionMaterial
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Deque, Dict, List, Tuple
+
+from boto3.s3.transfer import TransferConfig
 
 from .base_upload_client import BaseUploadClient
+from .encryption import EncryptingReader, EncryptingWriter, StreamEncryptor, encrypted_size
+
+# Multipart upload settings used when not defined in the config, same as the boto3 defaults
+DEFAULT_MULTIPART_THRESHOLD_MB = 8
+DEFAULT_MULTIPART_CHUNKSIZE_MB = 8
+DEFAULT_MAX_CONCURRENCY = 10
+
+MB = 1024 * 1024
+
+# S3 rejects the parts of a multipart upload smaller than 5 MiB, except the last part
+MIN_MULTIPART_CHUNKSIZE_MB = 5
+
+# Max number of keys of one delete_objects request
+DELETE_OBJECTS_MAX_KEYS = 1000
+
+# Config keys used by the S3 upload client, besides the aws_ and s3_ prefixed keys
+UPLOAD_CONFIG_KEYS = ['client_side_encryption_master_key', 'archive_load_files']
+
 
 class S3UploadClient(BaseUploadClient):
     """S3 Upload Client class"""
@@ -16,6 +40,9 @@ class S3UploadClient(BaseUploadClient):
     def __init__(self, connection_config):
         super().__init__(connection_config)
         self.s3_client = self._create_s3_client()
+        self.transfer_config = self._create_transfer_config()
+        # Metadata of the uploaded files by S3 key, to copy them to the archive without a head_object
+        self._uploaded_metadata: Dict[str, Dict] = {}
 
     def _create_s3_client(self, config=None):
         if not config:
@@ -43,64 +70,341 @@ class S3UploadClient(BaseUploadClient):
                                   region_name=config.get('s3_region_name'),
                                   endpoint_url=config.get('s3_endpoint_url'))
 
-    def upload_file(self, file, stream, temp_dir=None, s3_key_prefix=None):
+    def _create_transfer_config(self, config=None) -> TransferConfig:
+        """Multipart upload settings shared by every upload of the client"""
+        if not config:
+            config = self.connection_config
+
+        max_concurrency = config.get('s3_max_concurrency') or DEFAULT_MAX_CONCURRENCY
+        return TransferConfig(
+            multipart_threshold=(config.get('s3_multipart_threshold_mb') or DEFAULT_MULTIPART_THRESHOLD_MB) * MB,
+            multipart_chunksize=(config.get('s3_multipart_chunksize_mb') or DEFAULT_MULTIPART_CHUNKSIZE_MB) * MB,
+            max_concurrency=max_concurrency,
+            use_threads=max_concurrency > 1)
+
+    def _upload(self, file, bucket, s3_key, extra_args=None, encryptor: StreamEncryptor = None) -> None:
+        """
+        Upload a local file with the shared transfer config and log the throughput
+
+        If an encryptor is given the file is encrypted in chunks while it's read by the upload,
+        without writing an encrypted copy of the file to disk.
+        """
+        size_bytes = os.path.getsize(file)
+        start = time.perf_counter()
+        if encryptor is None:
+            self.s3_client.upload_file(file, bucket, s3_key, ExtraArgs=extra_args, Config=self.transfer_config)
+        else:
+            size_bytes = encrypted_size(size_bytes)
+            with open(file, 'rb') as src:
+                self.s3_client.upload_fileobj(EncryptingReader(src, encryptor), bucket, s3_key,
+                                              ExtraArgs=extra_args, Config=self.transfer_config)
+        elapsed = time.perf_counter() - start
+
+        self.logger.info('Uploaded %s to S3: %d bytes in %.3f seconds, %.2f MB/s', s3_key, size_bytes, elapsed,
+                         size_bytes / MB / elapsed if elapsed > 0 else 0)
+
+    def remember_metadata(self, s3_key: str, metadata: Dict) -> None:
+        """Keep the metadata of an uploaded file if it's going to be archived"""
+        if self.connection_config.get('archive_load_files'):
+            self._uploaded_metadata[s3_key] = dict(metadata)
+
+    def generate_s3_key(self, stream, file, timestamp=None) -> str:
+        """Key of a load file in the S3 bucket"""
+        s3_key_prefix = self.connection_config.get('s3_key_prefix', '')
+        if timestamp is None:
+            timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+
+        return f"{s3_key_prefix}pipelinewise_{stream}_{timestamp}_{os.path.basename(file)}"
+
+    def upload_file(self, file, stream, temp_dir=None, s3_key_prefix=None, timestamp=None):
         """Upload file to an external snowflake stage on s3"""
         # Generating key in S3 bucket
         bucket = self.connection_config['s3_bucket']
         s3_acl = self.connection_config.get('s3_acl')
-        s3_key_prefix = self.connection_config.get('s3_key_prefix', '')
-        timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
-
-        s3_key = f"{s3_key_prefix}pipelinewise_{stream}_{timestamp}_{os.path.basename(file)}"
+        s3_key = self.generate_s3_key(stream, file, timestamp)
         self.logger.info('Target S3 bucket: %s, local file: %s, S3 key: %s', bucket, file, s3_key)
 
         # Encrypt csv if client side encryption enabled
         master_key = self.connection_config.get('client_side_encryption_master_key', '')
         if master_key != '':
-            # Encrypt the file
-            encryption_material = SnowflakeFileEncryptionMaterial(
-                query_stage_master_key=master_key,
-                query_id='',
-                smk_id=0
-            )
-            encryption_metadata, encrypted_file = SnowflakeEncryptionUtil.encrypt_file(
-                encryption_material,
-                file,
-                tmp_dir=temp_dir
-            )
+            encryptor = StreamEncryptor(master_key)
 
             # Upload to s3
             extra_args = {'ACL': s3_acl} if s3_acl else {}
 
             # Send key and iv in the metadata, that will be required to decrypt and upload the encrypted file
-            extra_args['Metadata'] = {
-                'x-amz-key': encryption_metadata.key,
-                'x-amz-iv': encryption_metadata.iv
-            }
-            self.s3_client.upload_file(encrypted_file, bucket, s3_key, ExtraArgs=extra_args)
+            extra_args['Metadata'] = dict(encryptor.metadata)
 
-            # Remove the uploaded encrypted file
-            os.remove(encrypted_file)
+            # The file is encrypted in chunks while uploading it
+            self._upload(file, bucket, s3_key, extra_args, encryptor=encryptor)
+            self.remember_metadata(s3_key, extra_args['Metadata'])
 
         # Upload to S3 without encrypting
         else:
             extra_args = {'ACL': s3_acl} if s3_acl else None
-            self.s3_client.upload_file(file, bucket, s3_key, ExtraArgs=extra_args)
+            self._upload(file, bucket, s3_key, extra_args)
+            self.remember_metadata(s3_key, {})
 
         return s3_key
 
+    def upload_files(self, files, stream, temp_dir=None, s3_key_prefix=None):
+        """Upload the parts of a load file with the same timestamp in their keys"""
+        timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        return [self.upload_file(file, stream, temp_dir=temp_dir, s3_key_prefix=s3_key_prefix, timestamp=timestamp)
+                for file in files]
+
+    def open_streaming_files(self, stream: str, prefix: str = 'batch_') -> 'S3StreamingFiles':
+        """File opener of the formatters writing the load files of a batch straight to S3"""
+        return S3StreamingFiles(self, stream, prefix=prefix)
+
     def delete_object(self, stream: str, key: str) -> None:
         """Delete object from an external snowflake stage on S3"""
         self.logger.info('Deleting %s from external snowflake stage on S3', key)
         bucket = self.connection_config['s3_bucket']
         self.s3_client.delete_object(Bucket=bucket, Key=key)
 
+    def delete_objects(self, stream: str, keys: List[str]) -> None:
+        """Delete objects from an external snowflake stage on S3 in batches of up to 1000 keys"""
+        self.logger.info('Deleting %d objects from external snowflake stage on S3', len(keys))
+        bucket = self.connection_config['s3_bucket']
+        for start in range(0, len(keys), DELETE_OBJECTS_MAX_KEYS):
+            response = self.s3_client.delete_objects(
+                Bucket=bucket,
+                Delete={'Objects': [{'Key': key} for key in keys[start:start + DELETE_OBJECTS_MAX_KEYS]],
+                        'Quiet': True})
+            for error in response.get('Errors', []):
+                self.logger.warning('Failed to delete %s from S3: %s', error.get('Key'), error.get('Message'))
+
     def copy_object(self, copy_source: str, target_bucket: str, target_key: str, target_metadata: dict) -> None:
         """Copy object to another location on S3"""
         self.logger.info('Copying %s to %s/%s', copy_source, target_bucket, target_key)
         source_bucket, source_key = copy_source.split("/", 1)
-        metadata = self.s3_client.head_object(Bucket=source_bucket, Key=source_key).get('Metadata', {})
+
+        # Metadata written by the upload of the file is known without reading it back from S3
+        metadata = self._uploaded_metadata.pop(source_key, None)
+        if metadata is None:
+            metadata = self.s3_client.head_object(Bucket=source_bucket, Key=source_key).get('Metadata', {})
         metadata.update(target_metadata)
         # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.copy_object
         self.s3_client.copy_object(CopySource=copy_source, Bucket=target_bucket, Key=target_key,
                                    Metadata=metadata, MetadataDirective="REPLACE")
+
+
+# pylint: disable=too-many-instance-attributes
+class S3MultipartWriter:
+    """
+    Write only file object uploading the written data to S3 in the parts of a multipart upload
+
+    A part is uploaded in the background once part_size bytes are buffered, so uploading overlaps
+    with writing the data. Data smaller than one part is uploaded by a single put_object at close.
+    The upload is aborted if the writer is used as a context manager and an exception is raised.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self,
+                 s3_client,
+                 bucket: str,
+                 key: str,
+                 part_size: int = DEFAULT_MULTIPART_CHUNKSIZE_MB * MB,
+                 max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+                 extra_args: Dict = None):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, MIN_MULTIPART_CHUNKSIZE_MB * MB)
+        self.extra_args = extra_args or {}
+        self.closed = False
+        self._max_concurrency = max_concurrency
+        self._executor = None
+        self._upload_id = None
+        self._parts: List[Dict] = []
+        self._pending: Deque = deque()
+        self._buffer: List[bytes] = []
+        self._buffer_size = 0
+        self._size = 0
+
+    def write(self, data: bytes) -> int:
+        """Buffer the data and upload a part once a full part is buffered"""
+        self._buffer.append(data)
+        self._buffer_size += len(data)
+        self._size += len(data)
+        if self._buffer_size >= self.part_size:
+            self._submit_part()
+
+        return len(data)
+
+    def tell(self) -> int:
+        """Number of bytes written"""
+        return self._size
+
+    def flush(self) -> None:
+        """Parts are uploaded when they are full, nothing to flush"""
+
+    def _submit_part(self) -> None:
+        body = b''.join(self._buffer)
+        self._buffer = []
+        self._buffer_size = 0
+
+        if self._upload_id is None:
+            self._upload_id = self.s3_client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key, **self.extra_args)['UploadId']
+            self._executor = ThreadPoolExecutor(max_workers=self._max_concurrency, thread_name_prefix='s3-part')
+
+        # Wait for the uploaded parts to keep the memory used by pending parts bounded
+        while len(self._pending) >= self._max_concurrency:
+            self._parts.append(self._pending.popleft().result())
+
+        part_number = len(self._parts) + len(self._pending) + 1
+        self._pending.append(self._executor.submit(self._upload_part, part_number, body))
+
+    def _upload_part(self, part_number: int, body: bytes) -> Dict:
+        response = self.s3_client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                                              PartNumber=part_number, Body=body)
+        return {'ETag': response['ETag'], 'PartNumber': part_number}
+
+    def close(self) -> None:
+        """Upload the remaining data and complete the multipart upload, aborts the upload if it fails"""
+        if self.closed:
+            return
+
+        try:
+            if self._upload_id is None:
+                self.s3_client.put_object(Bucket=self.bucket, Key=self.key, Body=b''.join(self._buffer),
+                                          **self.extra_args)
+            else:
+                if self._buffer_size:
+                    self._submit_part()
+                while self._pending:
+                    self._parts.append(self._pending.popleft().result())
+                self.s3_client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                                                         MultipartUpload={'Parts': self._parts})
+        except BaseException:
+            # The uploaded parts of a failed upload are stored and billed by S3 until the upload is aborted
+            self.abort()
+            raise
+        finally:
+            self._shutdown()
+
+    def abort(self) -> None:
+        """Abort the multipart upload, the uploaded parts are deleted"""
+        if self.closed:
+            return
+
+        try:
+            for future in self._pending:
+                future.cancel()
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+            if self._upload_id is not None:
+                self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+        finally:
+            self._shutdown()
+
+    def _shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+        self._buffer = []
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class S3StreamingFiles:
+    """
+    Opener of the load files of a batch written straight to S3 by the formatters instead of local files
+
+    Every opened file is a S3MultipartWriter, wrapped by an EncryptingWriter if client side encryption
+    is enabled. The keys of the files share the same timestamp and base name, like the keys of the
+    local files uploaded by S3UploadClient.upload_files.
+    """
+
+    def __init__(self, upload_client: S3UploadClient, stream: str, prefix: str = 'batch_'):
+        self.upload_client = upload_client
+        self.stream = stream
+        self.base_name = f'{prefix}{uuid.uuid4().hex[:8]}'
+        self.timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        self.s3_keys: List[str] = []
+        self._writers: List[S3MultipartWriter] = []
+
+    def __call__(self, file_suffix: str) -> Tuple[str, BinaryIO]:
+        """Open the next file of the batch, returns its S3 key and the writer"""
+        config = self.upload_client.connection_config
+        s3_key = self.upload_client.generate_s3_key(self.stream, f'{self.base_name}{file_suffix}', self.timestamp)
+        s3_acl = config.get('s3_acl')
+        extra_args = {'ACL': s3_acl} if s3_acl else {}
+
+        # Key and iv are generated up front, so the metadata is known before the first part is uploaded
+        master_key = config.get('client_side_encryption_master_key', '')
+        encryptor = StreamEncryptor(master_key) if master_key != '' else None
+        if encryptor is not None:
+            extra_args['Metadata'] = dict(encryptor.metadata)
+
+        writer = S3MultipartWriter(self.upload_client.s3_client,
+                                   config['s3_bucket'],
+                                   s3_key,
+                                   part_size=self.upload_client.transfer_config.multipart_chunksize,
+                                   max_concurrency=self.upload_client.transfer_config.max_concurrency,
+                                   extra_args=extra_args)
+        self.upload_client.remember_metadata(s3_key, extra_args.get('Metadata', {}))
+        self.upload_client.logger.info('Streaming load file to S3 bucket: %s, S3 key: %s', config['s3_bucket'], s3_key)
+
+        self.s3_keys.append(s3_key)
+        self._writers.append(writer)
+        if encryptor is not None:
+            return s3_key, EncryptingWriter(writer, encryptor)
+
+        return s3_key, writer
+
+    @property
+    def size_bytes(self) -> int:
+        """Number of bytes written to every file"""
+        return sum(writer.tell() for writer in self._writers)
+
+
+def upload_client_key(connection_config: Dict) -> Tuple:
+    """Generate a hashable key from the config keys used by the S3 upload client"""
+    return tuple(sorted(
+        (name, value) for name, value in connection_config.items()
+        if name.startswith(('aws_', 's3_')) or name in UPLOAD_CONFIG_KEYS
+    ))
+
+
+class S3UploadClientRegistry:
+    """
+    Thread safe registry of S3 upload clients shared by every DbSync instance with the same S3 config
+
+    Creating a boto3 session loads the botocore service models, which is slow and takes
+    a few MB of memory, so it's done only once per S3 config instead of once per stream.
+    boto3 clients are thread safe, the shared client is used by the parallel flush workers.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._upload_clients: Dict[Tuple, S3UploadClient] = {}
+
+    def get(self, connection_config: Dict) -> S3UploadClient:
+        """Get the upload client of the S3 config, or create it if it doesn't exist yet"""
+        key = upload_client_key(connection_config)
+        with self._lock:
+            upload_client = self._upload_clients.get(key)
+            if upload_client is None:
+                upload_client = S3UploadClient(connection_config)
+                self._upload_clients[key] = upload_client
+
+        return upload_client
+
+    def clear(self) -> None:
+        """Remove every upload client from the registry"""
+        with self._lock:
+            self._upload_clients = {}
+
+
+# Upload clients are shared by every DbSync instance of the process
+UPLOAD_CLIENTS = S3UploadClientRegistry()
@@ -2,9 +2,20 @@
 Snowflake Upload Client
 """
 import os
+import time
 
+from typing import List
+
+import snowflake.connector
+
+from target_snowflake import compression
 from .base_upload_client import BaseUploadClient
 
+# Number of threads uploading the files of a PUT command when not defined in the config, same as snowflake
+DEFAULT_PUT_PARALLEL = 4
+
+MB = 1024 * 1024
+
 
 class SnowflakeUploadClient(BaseUploadClient):
     """Snowflake Upload Client class"""
@@ -15,21 +26,51 @@ class SnowflakeUploadClient(BaseUploadClient):
 
     def upload_file(self, file, stream, temp_dir = None, s3_key_prefix=None):
         """Upload file to an internal snowflake stage"""
-        # Generating key in S3 bucket
-        key = os.path.basename(file)
+        self._put(file, stream)
+        return os.path.basename(file)
+
+    def upload_files(self, files, stream, temp_dir=None, s3_key_prefix=None) -> List[str]:
+        """Upload the parts of a load file to an internal snowflake stage by one wildcard PUT command"""
+        if len(files) == 1 or len({os.path.dirname(file) for file in files}) > 1:
+            return super().upload_files(files, stream, temp_dir=temp_dir, s3_key_prefix=s3_key_prefix)
+
+        # Every part of the load file and nothing else matches <common prefix>*<common suffix>
+        prefix = os.path.commonprefix(files)
+        suffix = os.path.commonprefix([file[len(prefix):][::-1] for file in files])[::-1]
+        self._put(f'{prefix}*{suffix}', stream)
+
+        return [os.path.basename(file) for file in files]
+
+    def _put(self, file, stream) -> None:
+        """Upload the files matching a path by a PUT command, logs the size of every file and the upload time"""
         normfile = os.path.normpath(file).replace('\\', '/')
 
-        compression = '' if self.connection_config.get('no_compression', '') else "SOURCE_COMPRESSION=GZIP"
+        # Compressed files don't need to be compressed again by the connector
+        compression_option = compression.put_compression_option(normfile)
+        if compression_option:
+            compression_option = f'{compression_option} AUTO_COMPRESS=FALSE'
+        parallel = self.connection_config.get('put_parallel') or DEFAULT_PUT_PARALLEL
         stage = self.dblink.get_stage_name(stream)
 
-        self.logger.info('Target internal stage: %s, local file: %s, key: %s', stage, normfile, key)
-        cmd = f"PUT 'file://{normfile}' '@{stage}' {compression}"
+        self.logger.info('Target internal stage: %s, local file: %s, key: %s', stage, normfile, os.path.basename(file))
+        cmd = f"PUT 'file://{normfile}' '@{stage}' PARALLEL={parallel} {compression_option}".rstrip()
         self.logger.info(cmd)
 
+        start = time.perf_counter()
         with self.dblink.open_connection() as connection:
-            connection.cursor().execute(cmd)
+            with connection.cursor(snowflake.connector.DictCursor) as cur:
+                cur.execute(cmd)
+                results = cur.fetchall()
+        elapsed = time.perf_counter() - start
 
-        return key
+        # Files of a PUT command are uploaded in parallel, only the whole command has an upload time
+        for result in results:
+            self.logger.info('Uploaded %s to internal stage: %d bytes, status: %s',
+                             result.get('target'), result.get('target_size') or 0, result.get('status'))
+
+        size_bytes = sum(result.get('target_size') or 0 for result in results)
+        self.logger.info('Uploaded %d files to internal stage: %d bytes in %.3f seconds, %.2f MB/s',
+                         len(results), size_bytes, elapsed, size_bytes / MB / elapsed if elapsed > 0 else 0)
 
     def delete_object(self, stream: str, key: str) -> None:
         """Delete object form internal snowflake stage"""
@@ -39,6 +80,23 @@ class SnowflakeUploadClient(BaseUploadClient):
         with self.dblink.open_connection() as connection:
             connection.cursor().execute(f"REMOVE '@{stage}/{key}'")
 
+    def delete_objects(self, stream: str, keys: List[str]) -> None:
+        """Delete objects from internal snowflake stage by one REMOVE command matching every key"""
+        self.logger.info('Deleting %d objects from internal snowflake stage', len(keys))
+        stage = self.dblink.get_stage_name(stream)
+        pattern = '|'.join(_key_pattern(key) for key in keys)
+
+        # PATTERN matches the whole listed path that can start with the stage name and folders,
+        # keys are prefixes like in REMOVE '@stage/key', files compressed by PUT get a .gz suffix
+        with self.dblink.open_connection() as connection:
+            connection.cursor().execute(f"REMOVE '@{stage}' PATTERN='(.*/)?({pattern}).*'")
+
     def copy_object(self, copy_source: str, target_bucket: str, target_key: str, target_metadata: dict) -> None:
         raise NotImplementedError(
             "Copying objects is not supported with a Snowflake upload client.")
+
+
+def _key_pattern(key: str) -> str:
+    """Regular expression matching a key, special characters are matched by a bracket expression
+    instead of a backslash that would need escaping in the SQL string literal as well"""
+    return ''.join(char if char.isalnum() or char in '_-/' else f'[{char}]' for char in key)
@@ -0,0 +1,431 @@
+"""Compiled JSON schema validators
+
+Validation code is generated once per stream schema, in the style of fastjsonschema,
+and follows the Draft 7 rules of jsonschema.Draft7Validator. Schemas using keywords
+that are not compiled are validated by Draft7Validator.
+"""
+import hashlib
+import json
+import numbers
+import re
+import threading
+
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List
+from urllib.parse import unquote
+
+from jsonschema import Draft7Validator, FormatChecker
+from jsonschema.exceptions import FormatError, ValidationError
+from singer import get_logger
+
+LOGGER = get_logger('target_snowflake')
+
+# Max number of compiled validators kept in memory
+VALIDATOR_CACHE_SIZE = 128
+
+# Draft 7 keywords not supported by the generated code
+UNSUPPORTED_KEYWORDS = {'additionalItems', 'contains', 'dependencies', 'if', 'then', 'else', 'maxProperties',
+                        'minProperties', 'patternProperties', 'propertyNames', 'uniqueItems', '$id'}
+
+# Draft 7 type checks, {v} is replaced by the name of the validated variable
+TYPE_CHECKS = {
+    'array': 'isinstance({v}, list)',
+    'boolean': 'isinstance({v}, bool)',
+    'integer': '(isinstance({v}, int) and not isinstance({v}, bool) or isinstance({v}, float) and {v}.is_integer())',
+    'null': '{v} is None',
+    'number': '(isinstance({v}, Number) and not isinstance({v}, bool))',
+    'object': 'isinstance({v}, dict)',
+    'string': 'isinstance({v}, str)',
+}
+
+FORMAT_CHECKER = FormatChecker()
+
+
+class UnsupportedSchemaException(Exception):
+    """Raised when a schema cannot be compiled"""
+
+
+def _unbool(element, true=object(), false=object()):
+    """Distinguish booleans from 0 and 1 like jsonschema does"""
+    if element is True:
+        return true
+    if element is False:
+        return false
+    return element
+
+
+def _in_enum(instance, enums) -> bool:
+    if instance in (0, 1):
+        unbooled = _unbool(instance)
+        return any(unbooled == _unbool(each) for each in enums)
+    return instance in enums
+
+
+def _equal(one, two) -> bool:
+    return _unbool(one) == _unbool(two)
+
+
+def _extras_msg(extras) -> str:
+    verb = 'was' if len(extras) == 1 else 'were'
+    return f"{', '.join(repr(extra) for extra in extras)} {verb}"
+
+
+def _check_format(instance, format_name) -> None:
+    try:
+        FORMAT_CHECKER.check(instance, format_name)
+    except FormatError as error:
+        raise ValidationError(error.message, cause=error.cause) from error
+
+
+# pylint: disable=too-few-public-methods
+class _ValidatorCompiler:
+    """Generates the source code of a validator function"""
+
+    def __init__(self, schema: Dict):
+        self._root = schema
+        self._lines: List[str] = []
+        self._namespace: Dict[str, Any] = {
+            'Number': numbers.Number,
+            'ValidationError': ValidationError,
+            '_in_enum': _in_enum,
+            '_equal': _equal,
+            '_extras_msg': _extras_msg,
+            '_check_format': _check_format,
+        }
+        self._ref_functions: Dict[str, str] = {}
+        self._pending_functions: List = []
+        self._counter = 0
+        # Generators of the supported keywords, other keywords like title or description are ignored
+        self._keyword_generators: Dict[str, Callable[[Any, str, int], None]] = {
+            'type': self._keyword_type,
+            'properties': self._keyword_properties,
+            'required': self._keyword_required,
+            'items': self._keyword_items,
+            'minItems': self._keyword_min_items,
+            'maxItems': self._keyword_max_items,
+            'enum': self._keyword_enum,
+            'const': self._keyword_const,
+            'minimum': self._keyword_minimum,
+            'maximum': self._keyword_maximum,
+            'exclusiveMinimum': self._keyword_exclusive_minimum,
+            'exclusiveMaximum': self._keyword_exclusive_maximum,
+            'multipleOf': self._keyword_multiple_of,
+            'minLength': self._keyword_min_length,
+            'maxLength': self._keyword_max_length,
+            'pattern': self._keyword_pattern,
+            'format': self._keyword_format,
+            'allOf': self._keyword_all_of,
+            'anyOf': self._keyword_any_of,
+            'oneOf': self._keyword_one_of,
+            'not': self._keyword_not,
+        }
+
+    def compile(self) -> Callable[[Any], None]:
+        """Generate and compile the validator function of the schema"""
+        self._function('validate', self._root)
+        while self._pending_functions:
+            self._function(*self._pending_functions.pop())
+
+        exec(compile('\n'.join(self._lines), '<compiled validator>', 'exec'), self._namespace)  # pylint: disable=exec-used
+        return self._namespace['validate']
+
+    def _name(self, prefix: str) -> str:
+        self._counter += 1
+        return f'{prefix}_{self._counter}'
+
+    def _constant(self, value) -> str:
+        name = self._name('CONSTANT')
+        self._namespace[name] = value
+        return name
+
+    def _emit(self, indent: int, line: str) -> None:
+        self._lines.append('    ' * indent + line)
+
+    def _block(self, indent: int, header: str, generate_body: Callable[[], None]) -> None:
+        self._emit(indent, header)
+        n_lines = len(self._lines)
+        generate_body()
+        if len(self._lines) == n_lines:
+            self._emit(indent + 1, 'pass')
+
+    def _raise(self, indent: int, message: str, *args: str) -> None:
+        self._emit(indent, f"raise ValidationError({message!r} % ({', '.join(args)},))")
+
+    def _function(self, name: str, schema) -> None:
+        self._block(0, f'def {name}(data):', lambda: self._generate(schema, 'data', 1))
+        self._emit(0, '')
+
+    def _subschema_function(self, schema) -> str:
+        name = self._name('validate_subschema')
+        self._pending_functions.append((name, schema))
+        return name
+
+    def _ref_function(self, ref: str) -> str:
+        if ref not in self._ref_functions:
+            self._ref_functions[ref] = self._name('validate_ref')
+            self._pending_functions.append((self._ref_functions[ref], self._resolve(ref)))
+        return self._ref_functions[ref]
+
+    def _resolve(self, ref: str):
+        """Resolve a JSON pointer reference in the same schema"""
+        if not ref.startswith('#'):
+            raise UnsupportedSchemaException(f'Remote reference {ref} is not supported')
+
+        resolved = self._root
+        for part in [p for p in unquote(ref[1:]).split('/') if p]:
+            part = part.replace('~1', '/').replace('~0', '~')
+            try:
+                resolved = resolved[int(part)] if isinstance(resolved, list) else resolved[part]
+            except (KeyError, IndexError, ValueError) as exc:
+                raise UnsupportedSchemaException(f'Unresolvable reference {ref}') from exc
+
+        return resolved
+
+    # pylint: disable=too-many-branches
+    def _generate(self, schema, var: str, indent: int) -> None:
+        """Generate the validation of the var variable against the schema"""
+        if schema is True:
+            return
+        if schema is False:
+            self._raise(indent, 'False schema does not allow %r', var)
+            return
+        if not isinstance(schema, dict):
+            raise UnsupportedSchemaException(f'Invalid schema {schema!r}')
+
+        # $ref overrides any other keyword in draft 7
+        if '$ref' in schema:
+            self._emit(indent, f"{self._ref_function(schema['$ref'])}({var})")
+            return
+
+        unsupported = UNSUPPORTED_KEYWORDS.intersection(schema)
+        if unsupported:
+            raise UnsupportedSchemaException(f'Unsupported keywords {sorted(unsupported)}')
+
+        # type is checked first, the other keywords are checked only if the value has the right type
+        for keyword, value in sorted(schema.items(), key=lambda item: item[0] != 'type'):
+            if keyword == 'additionalProperties':
+                self._keyword_additional_properties(value, schema.get('properties', {}), var, indent)
+            elif keyword in self._keyword_generators:
+                self._keyword_generators[keyword](value, var, indent)
+
+    def _keyword_type(self, value, var, indent):
+        types = [value] if isinstance(value, str) else value
+        if any(type_name not in TYPE_CHECKS for type_name in types):
+            raise UnsupportedSchemaException(f'Unsupported type {value!r}')
+
+        condition = ' or '.join(TYPE_CHECKS[type_name].format(v=var) for type_name in types)
+        self._emit(indent, f'if not ({condition}):')
+        self._raise(indent + 1, f"%r is not of type {', '.join(repr(type_name) for type_name in types)}", var)
+
+    def _keyword_properties(self, value, var, indent):
+        def generate_properties():
+            for name, subschema in value.items():
+                item = self._name('data')
+                self._emit(indent + 1, f'if {name!r} in {var}:')
+                self._emit(indent + 2, f'{item} = {var}[{name!r}]')
+                self._generate(subschema, item, indent + 2)
+
+        self._block(indent, f'if isinstance({var}, dict):', generate_properties)
+
+    def _keyword_required(self, value, var, indent):
+        name = self._name('name')
+        self._emit(indent, f'if isinstance({var}, dict):')
+        self._emit(indent + 1, f'for {name} in {self._constant(value)}:')
+        self._emit(indent + 2, f'if {name} not in {var}:')
+        self._raise(indent + 3, '%r is a required property', name)
+
+    def _keyword_additional_properties(self, value, properties, var, indent):
+        """additionalProperties depends on the properties keyword of the same schema"""
+        if value is True:
+            return
+
+        properties = self._constant(set(properties))
+        if isinstance(value, dict):
+            key, item = self._name('key'), self._name('data')
+            self._emit(indent, f'if isinstance({var}, dict):')
+            self._emit(indent + 1, f'for {key}, {item} in {var}.items():')
+            self._block(indent + 2, f'if {key} not in {properties}:', lambda: self._generate(value, item, indent + 3))
+        elif not value:
+            extras = self._name('extras')
+            self._emit(indent, f'if isinstance({var}, dict):')
+            self._emit(indent + 1, f'{extras} = [key for key in {var} if key not in {properties}]')
+            self._emit(indent + 1, f'if {extras}:')
+            self._raise(indent + 2, 'Additional properties are not allowed (%s unexpected)', f'_extras_msg({extras})')
+
+    def _keyword_items(self, value, var, indent):
+        item = self._name('data')
+        if isinstance(value, list):
+            def generate_items():
+                for position, subschema in enumerate(value):
+                    self._emit(indent + 1, f'if len({var}) > {position}:')
+                    self._emit(indent + 2, f'{item} = {var}[{position}]')
+                    self._generate(subschema, item, indent + 2)
+
+            self._block(indent, f'if isinstance({var}, list):', generate_items)
+        else:
+            self._emit(indent, f'if isinstance({var}, list):')
+            self._block(indent + 1, f'for {item} in {var}:', lambda: self._generate(value, item, indent + 2))
+
+    def _keyword_min_items(self, value, var, indent):
+        self._emit(indent, f'if isinstance({var}, list) and len({var}) < {self._constant(value)}:')
+        self._raise(indent + 1, '%r is too short', var)
+
+    def _keyword_max_items(self, value, var, indent):
+        self._emit(indent, f'if isinstance({var}, list) and len({var}) > {self._constant(value)}:')
+        self._raise(indent + 1, '%r is too long', var)
+
+    def _keyword_enum(self, value, var, indent):
+        enums = self._constant(value)
+        self._emit(indent, f'if not _in_enum({var}, {enums}):')
+        self._raise(indent + 1, '%r is not one of %r', var, enums)
+
+    def _keyword_const(self, value, var, indent):
+        const = self._constant(value)
+        self._emit(indent, f'if not _equal({var}, {const}):')
+        self._raise(indent + 1, '%r was expected', const)
+
+    def _numeric_keyword(self, value, var, indent, operator, message):
+        limit = self._constant(value)
+        self._emit(indent, f"if {TYPE_CHECKS['number'].format(v=var)} and {var} {operator} {limit}:")
+        self._raise(indent + 1, message, var, limit)
+
+    def _keyword_minimum(self, value, var, indent):
+        self._numeric_keyword(value, var, indent, '<', '%r is less than the minimum of %r')
+
+    def _keyword_maximum(self, value, var, indent):
+        self._numeric_keyword(value, var, indent, '>', '%r is greater than the maximum of %r')
+
+    def _keyword_exclusive_minimum(self, value, var, indent):
+        self._numeric_keyword(value, var, indent, '<=', '%r is less than or equal to the minimum of %r')
+
+    def _keyword_exclusive_maximum(self, value, var, indent):
+        self._numeric_keyword(value, var, indent, '>=', '%r is greater than or equal to the maximum of %r')
+
+    def _keyword_multiple_of(self, value, var, indent):
+        multiple_of = self._constant(value)
+        self._emit(indent, f"if {TYPE_CHECKS['number'].format(v=var)}:")
+        if isinstance(value, float):
+            quotient = self._name('quotient')
+            self._emit(indent + 1, f'{quotient} = {var} / {multiple_of}')
+            self._emit(indent + 1, f'if int({quotient}) != {quotient}:')
+        else:
+            self._emit(indent + 1, f'if {var} % {multiple_of}:')
+        self._raise(indent + 2, '%r is not a multiple of %r', var, multiple_of)
+
+    def _keyword_min_length(self, value, var, indent):
+        self._emit(indent, f'if isinstance({var}, str) and len({var}) < {self._constant(value)}:')
+        self._raise(indent + 1, '%r is too short', var)
+
+    def _keyword_max_length(self, value, var, indent):
+        self._emit(indent, f'if isinstance({var}, str) and len({var}) > {self._constant(value)}:')
+        self._raise(indent + 1, '%r is too long', var)
+
+    def _keyword_pattern(self, value, var, indent):
+        pattern = self._constant(re.compile(value))
+        self._emit(indent, f'if isinstance({var}, str) and not {pattern}.search({var}):')
+        self._raise(indent + 1, '%r does not match %r', var, self._constant(value))
+
+    def _keyword_format(self, value, var, indent):
+        self._emit(indent, f'_check_format({var}, {self._constant(value)})')
+
+    def _keyword_all_of(self, value, var, indent):
+        for subschema in value:
+            self._generate(subschema, var, indent)
+
+    def _keyword_any_of(self, value, var, indent):
+        function = self._name('function')
+        functions = ', '.join(self._subschema_function(subschema) for subschema in value)
+        self._emit(indent, f'for {function} in ({functions},):')
+        self._emit(indent + 1, 'try:')
+        self._emit(indent + 2, f'{function}({var})')
+        self._emit(indent + 2, 'break')
+        self._emit(indent + 1, 'except ValidationError:')
+        self._emit(indent + 2, 'pass')
+        self._emit(indent, 'else:')
+        self._raise(indent + 1, '%r is not valid under any of the given schemas', var)
+
+    def _keyword_one_of(self, value, var, indent):
+        function, subschema, valid = self._name('function'), self._name('subschema'), self._name('valid')
+        functions = ', '.join(f'({self._subschema_function(s)}, {self._constant(s)})' for s in value)
+        self._emit(indent, f'{valid} = []')
+        self._emit(indent, f'for {function}, {subschema} in ({functions},):')
+        self._emit(indent + 1, 'try:')
+        self._emit(indent + 2, f'{function}({var})')
+        self._emit(indent + 2, f'{valid}.append({subschema})')
+        self._emit(indent + 1, 'except ValidationError:')
+        self._emit(indent + 2, 'pass')
+        self._emit(indent, f'if not {valid}:')
+        self._raise(indent + 1, '%r is not valid under any of the given schemas', var)
+        self._emit(indent, f'if len({valid}) > 1:')
+        self._raise(indent + 1, '%r is valid under each of %s', var,
+                    f"', '.join(repr(s) for s in {valid}[1:] + {valid}[:1])")
+
+    def _keyword_not(self, value, var, indent):
+        self._emit(indent, 'try:')
+        self._emit(indent + 1, f'{self._subschema_function(value)}({var})')
+        self._emit(indent, 'except ValidationError:')
+        self._emit(indent + 1, 'pass')
+        self._emit(indent, 'else:')
+        self._raise(indent + 1, '%r is not allowed for %r', self._constant(value), var)
+
+
+# pylint: disable=too-few-public-methods
+class CompiledValidator:
+    """Validator of a compiled schema with the same validate interface as Draft7Validator"""
+
+    def __init__(self, schema: Dict):
+        self.schema = schema
+        self._validate = _ValidatorCompiler(schema).compile()
+
+    def validate(self, instance) -> None:
+        """Raise jsonschema.ValidationError if the instance is not valid"""
+        self._validate(instance)
+
+
+def schema_fingerprint(schema: Dict) -> str:
+    """Hash of the schema, Decimal values are hashed by their string representation"""
+    return hashlib.sha1(json.dumps(schema, sort_keys=True, default=repr).encode('utf-8')).hexdigest()
+
+
+# pylint: disable=too-few-public-methods
+class _ValidatorCache:
+    """Thread safe LRU cache of validators by schema fingerprint"""
+
+    def __init__(self, max_size: int):
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._validators = OrderedDict()
+
+    def get_validator(self, schema: Dict):
+        """Get the cached validator of the schema or build a new one"""
+        fingerprint = schema_fingerprint(schema)
+        with self._lock:
+            if fingerprint in self._validators:
+                self._validators.move_to_end(fingerprint)
+                return self._validators[fingerprint]
+
+        try:
+            validator = CompiledValidator(schema)
+        except (UnsupportedSchemaException, SyntaxError, RecursionError) as exc:
+            # Deeply nested schemas exceed the indentation limit of the compiler or the recursion limit
+            LOGGER.debug('Schema cannot be compiled, using Draft7Validator: %r', exc)
+            validator = Draft7Validator(schema, format_checker=FORMAT_CHECKER)
+
+        with self._lock:
+            self._validators[fingerprint] = validator
+            while len(self._validators) > self._max_size:
+                self._validators.popitem(last=False)
+
+        return validator
+
+
+_CACHE = _ValidatorCache(VALIDATOR_CACHE_SIZE)
+
+
+def get_validator(schema: Dict):
+    """Compiled validator of the schema, or Draft7Validator if the schema uses unsupported keywords
+
+    Validators are cached by the fingerprint of the schema, streams with the same schema
+    share the same validator.
+    """
+    return _CACHE.get_validator(schema)
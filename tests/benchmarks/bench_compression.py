@@ -0,0 +1,62 @@
+"""Throughput and file size of the load file compression codecs and levels
+
+Usage:
+    python tests/benchmarks/bench_compression.py [--records N]
+"""
+import argparse
+import os
+import time
+
+from target_snowflake.file_formats import csv
+from target_snowflake.file_formats import parquet
+
+CSV_CODECS = [('none', None, 1), ('gzip', 1, 1), ('gzip', 6, 1), ('gzip', 9, 1), ('gzip', 6, 4), ('gzip', 9, 4),
+              ('zstd', 1, 1), ('zstd', 3, 1), ('zstd', 10, 1), ('zstd', 10, 4)]
+PARQUET_CODECS = [('none', None, 1), ('snappy', None, 1), ('lz4', None, 1), ('zstd', None, 1), ('gzip', None, 1)]
+
+
+def generate_schema(n_columns: int) -> dict:
+    """Flattened schema with string, integer and number columns"""
+    column_types = ['string', 'integer', 'number']
+    return {f'column_{i}': {'type': ['null', column_types[i % len(column_types)]]} for i in range(n_columns)}
+
+
+def generate_records(n_records: int, n_columns: int) -> dict:
+    """Flattened records matching generate_schema, keyed by primary key"""
+    values = [lambda i: f'value_{i % 1000}', lambda i: i, lambda i: i / 7]
+    return {str(i): {f'column_{c}': values[c % len(values)](i) for c in range(n_columns)} for i in range(n_records)}
+
+
+def measure(records_to_file_fn, records, schema, codec, level, threads) -> tuple:
+    """Write one load file and return the records/sec and the file size in bytes"""
+    start = time.perf_counter()
+    filename = records_to_file_fn(records, schema, compression=codec, compression_level=level,
+                                  compression_threads=threads, flattened=True)
+    elapsed = time.perf_counter() - start
+    size = os.path.getsize(filename)
+    os.remove(filename)
+
+    return len(records) / elapsed, size
+
+
+def main():
+    """Run the benchmark and print records/sec and file size per codec"""
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--records', type=int, default=50000)
+    arg_parser.add_argument('--columns', type=int, default=20)
+    args = arg_parser.parse_args()
+
+    schema = generate_schema(args.columns)
+    records = generate_records(args.records, args.columns)
+
+    print(f'{"format":>8} {"codec":>8} {"level":>6} {"threads":>8} {"records/sec":>12} {"size (KB)":>10}')
+    for file_format, records_to_file_fn, codecs in [('csv', csv.records_to_file, CSV_CODECS),
+                                                    ('parquet', parquet.records_to_file, PARQUET_CODECS)]:
+        for codec, level, threads in codecs:
+            throughput, size = measure(records_to_file_fn, records, schema, codec, level, threads)
+            print(f'{file_format:>8} {codec:>8} {str(level or "-"):>6} {threads:>8} '
+                  f'{throughput:>12,.0f} {size / 1024:>10,.0f}')
+
+
+if __name__ == '__main__':
+    main()
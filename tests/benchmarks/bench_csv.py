@@ -0,0 +1,63 @@
+"""Records/sec of the json.dumps based CSV line transformer compared to CsvRowEncoder
+
+Usage:
+    python tests/benchmarks/bench_csv.py [--records N]
+"""
+import argparse
+import json
+import time
+
+from target_snowflake.file_formats import csv
+
+
+def generate_schema(n_columns: int) -> dict:
+    """Flattened schema with string, integer, number, boolean and variant columns"""
+    column_types = ['string', 'integer', 'number', 'boolean', 'object']
+    return {f'column_{i}': {'type': ['null', column_types[i % len(column_types)]]} for i in range(n_columns)}
+
+
+def generate_records(n_records: int, n_columns: int) -> list:
+    """Flattened records matching generate_schema"""
+    values = [lambda i: f'value "{i}"', lambda i: i, lambda i: i / 3, lambda i: i % 2 == 0, lambda i: {'id': i}]
+    return [{f'column_{c}': values[c % len(values)](i) for c in range(n_columns)} for i in range(n_records)]
+
+
+def json_dumps_csv_line(flatten_record: dict, schema: dict) -> str:
+    """The CSV line transformer calling json.dumps on every value"""
+    return ','.join(
+        [
+            json.dumps(flatten_record[column], ensure_ascii=False) if column in flatten_record and (
+                    flatten_record[column] == 0 or flatten_record[column]) else ''
+            for column in schema
+        ]
+    )
+
+
+def records_per_second(encode_fn, records) -> float:
+    """Encode every record and return the throughput"""
+    start = time.perf_counter()
+    for record in records:
+        encode_fn(record)
+
+    return len(records) / (time.perf_counter() - start)
+
+
+def main():
+    """Run the benchmark and print records/sec"""
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--records', type=int, default=20000)
+    arg_parser.add_argument('--columns', type=int, default=50)
+    args = arg_parser.parse_args()
+
+    schema = generate_schema(args.columns)
+    records = generate_records(args.records, args.columns)
+
+    before = records_per_second(lambda record: json_dumps_csv_line(record, schema), records)
+    after = records_per_second(csv.CsvRowEncoder(schema).encode, records)
+
+    print(f'{"json.dumps":>16} {"CsvRowEncoder":>16} {"speedup":>8}')
+    print(f'{before:>16,.0f} {after:>16,.0f} {after / before:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""Records/sec of flattening.flatten_record compared to the compiled RecordFlattener
+
+Usage:
+    python tests/benchmarks/bench_flattening.py [--records N]
+"""
+import argparse
+import time
+
+from target_snowflake import flattening
+
+
+def generate_schema(n_columns: int) -> dict:
+    """Stream schema with plain, nested and long named properties"""
+    properties = {f'column_{i}': {'type': ['null', 'string']} for i in range(n_columns)}
+    properties['nested'] = {
+        'type': ['null', 'object'],
+        'properties': {
+            'prop_1': {'type': ['null', 'integer']},
+            'prop_2': {'type': ['null', 'object'], 'properties': {'deep': {'type': ['null', 'string']}}},
+        }
+    }
+    properties['array_or_object'] = {'type': ['null', 'object', 'array']}
+    properties['a_very_long_property_name_' * 10] = {'type': ['null', 'string']}
+
+    return {'type': 'object', 'properties': properties}
+
+
+def generate_records(n_records: int, n_columns: int) -> list:
+    """Records matching generate_schema"""
+    records = []
+    for i in range(n_records):
+        record = {f'column_{c}': f'value_{i}_{c}' for c in range(n_columns)}
+        record['nested'] = {'prop_1': i, 'prop_2': {'deep': 'value'}}
+        record['array_or_object'] = [i, i + 1]
+        record['a_very_long_property_name_' * 10] = 'long'
+        records.append(record)
+
+    return records
+
+
+def records_per_second(flatten_fn, records) -> float:
+    """Flatten every record and return the throughput"""
+    start = time.perf_counter()
+    for record in records:
+        flatten_fn(record)
+
+    return len(records) / (time.perf_counter() - start)
+
+
+def main():
+    """Run the benchmark and print records/sec per flattening level"""
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--records', type=int, default=20000)
+    arg_parser.add_argument('--columns', type=int, default=50)
+    args = arg_parser.parse_args()
+
+    schema = generate_schema(args.columns)
+    records = generate_records(args.records, args.columns)
+
+    print(f'{"max_level":>9} {"flatten_record":>16} {"RecordFlattener":>16} {"speedup":>8}')
+    for max_level in [0, 1, 10]:
+        flatten_schema = flattening.flatten_schema(schema, max_level=max_level)
+        flattener = flattening.RecordFlattener(flatten_schema, max_level=max_level)
+
+        before = records_per_second(
+            lambda record: flattening.flatten_record(record, flatten_schema, max_level=max_level), records)
+        after = records_per_second(flattener.flatten, records)
+
+        print(f'{max_level:>9} {before:>16,.0f} {after:>16,.0f} {after / before:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
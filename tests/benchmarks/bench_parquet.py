@@ -0,0 +1,83 @@
+"""Records/sec and peak memory of the pandas based parquet writer compared to the arrow table writer
+
+Usage:
+    python tests/benchmarks/bench_parquet.py [--records N]
+"""
+import argparse
+import json
+import os
+import time
+import tracemalloc
+
+import pandas
+
+from target_snowflake.file_formats import parquet
+
+
+def generate_schema(n_columns: int) -> dict:
+    """Flattened schema with string, integer, number, boolean, date-time and variant columns"""
+    column_types = [{'type': ['null', 'string']},
+                    {'type': ['null', 'integer']},
+                    {'type': ['null', 'number']},
+                    {'type': ['null', 'boolean']},
+                    {'type': ['null', 'string'], 'format': 'date-time'},
+                    {'type': ['null', 'object']}]
+    return {f'column_{i}': column_types[i % len(column_types)] for i in range(n_columns)}
+
+
+def generate_records(n_records: int, n_columns: int) -> dict:
+    """Flattened records matching generate_schema, keyed by primary key"""
+    values = [lambda i: f'value_{i % 1000}', lambda i: i, lambda i: i / 7, lambda i: i % 2 == 0,
+              lambda i: f'2021-01-01T10:00:{i % 60:02d}.123456Z', lambda i: {'id': i}]
+    return {str(i): {f'column_{c}': values[c % len(values)](i) for c in range(n_columns)} for i in range(n_records)}
+
+
+def dataframe_to_parquet(records: dict, schema: dict) -> str:
+    """The pandas based writer"""
+    filename = f'/tmp/bench_dataframe_{os.getpid()}.parquet'
+    dataframe = pandas.DataFrame(data=list(records.values()))
+    # Variants are written as JSON strings, pandas would store the dicts as structs
+    for column, column_schema in schema.items():
+        if parquet.column_kind(column_schema) == parquet.VARIANT:
+            dataframe[column] = dataframe[column].map(lambda value: json.dumps(value, ensure_ascii=False))
+    dataframe.to_parquet(filename, compression='snappy')
+    return filename
+
+
+def table_to_parquet(records: dict, schema: dict) -> str:
+    """The arrow table writer"""
+    return parquet.records_to_file(records, schema, compression='snappy', flattened=True)
+
+
+def measure(write_fn, records, schema) -> tuple:
+    """Write the file twice, return records/sec of the first run and the peak traced memory in MB of the second"""
+    start = time.perf_counter()
+    os.remove(write_fn(records, schema))
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    os.remove(write_fn(records, schema))
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return len(records) / elapsed, peak / 1024 / 1024
+
+
+def main():
+    """Run the benchmark and print records/sec and peak memory"""
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--records', type=int, default=50000)
+    arg_parser.add_argument('--columns', type=int, default=30)
+    args = arg_parser.parse_args()
+
+    schema = generate_schema(args.columns)
+    records = generate_records(args.records, args.columns)
+
+    print(f'{"writer":>10} {"records/sec":>12} {"peak MB":>8}')
+    for name, write_fn in [('pandas', dataframe_to_parquet), ('arrow', table_to_parquet)]:
+        throughput, peak = measure(write_fn, records, schema)
+        print(f'{name:>10} {throughput:>12,.0f} {peak:>8,.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,19 @@
 import unittest
 import os
 import gzip
+import csv as stdlib_csv
+import json
 import tempfile
 
+from unittest.mock import patch
+
+import zstandard
+
 import target_snowflake.file_formats.csv as csv
 
+from target_snowflake import flattening
+from target_snowflake.exceptions import InvalidFileFormatException
+
 
 def _mock_record_to_csv_line(record, schema, data_flattening_max_level=0):
     return record
@@ -96,6 +105,175 @@ class TestCsv(unittest.TestCase):
         self.assertEqual(csv.record_to_csv_line(record, schema),
                          '"1","2030-01-22","10000-01-22 12:04:22","25:01:01","I\'m good",')
 
+    def test_records_to_file_with_flattened_records(self):
+        schema = {
+            'c_pk': {'type': ['null', 'integer']},
+            'c_obj__nested': {'type': ['null', 'string']},
+            'c_bool': {'type': ['null', 'boolean']},
+        }
+        flattener = flattening.RecordFlattener(schema, max_level=1)
+        records = {
+            '1': {'c_pk': 1, 'c_obj': {'nested': 'a'}, 'c_bool': False},
+            '2': {'c_pk': 2, 'c_obj': {'nested': None}, 'c_bool': True},
+        }
+        flattened_records = {pk: flattener.flatten(record) for pk, record in records.items()}
+
+        raw_file = csv.records_to_file(records, schema, data_flattening_max_level=1)
+        flattened_file = csv.records_to_file(flattened_records, schema, flattened=True)
+
+        with open(raw_file, 'rt') as raw, open(flattened_file, 'rt') as flattened:
+            flattened_lines = flattened.readlines()
+            self.assertEqual(flattened_lines, ['1,"a",false\n', '2,,true\n'])
+            self.assertEqual(raw.readlines(), flattened_lines)
+
+        os.remove(raw_file)
+        os.remove(flattened_file)
+
+    def test_row_encoder_matches_json_dumps(self):
+        values = [None, 0, 1, -5, 10 ** 30, 0.0, -0.0, 1.5, 1e300, float('nan'), float('inf'), True, False,
+                  '', 'a', '"quoted"\n\\ é', [], {}, [1, 'a'], {'a': 'é'}]
+        column_types = [['null', 'string'], ['null', 'integer'], ['null', 'number'], ['null', 'boolean'],
+                        ['null', 'object'], ['null', 'array'], ['null', 'object', 'array'], 'string', []]
+
+        for column_type in column_types:
+            schema = {'c_col': {'type': column_type}, 'c_missing': {'type': column_type}}
+            row_encoder = csv.CsvRowEncoder(schema)
+            for value in values:
+                if column_type == ['null', 'object', 'array']:
+                    # Every value is JSON encoded, None is a JSON null and strings are VARIANT strings
+                    expected = json.dumps(json.dumps(value), ensure_ascii=False)
+                elif isinstance(value, (dict, list)) or \
+                        (('object' in column_type or 'array' in column_type) and not isinstance(value, str)):
+                    # Quoted JSON text, the value is loaded by parse_json. Nested values are quoted in any column
+                    expected = json.dumps(json.dumps(value), ensure_ascii=False) if value is not None else ''
+                else:
+                    expected = json.dumps(value, ensure_ascii=False) if value == 0 or value else ''
+                self.assertEqual(row_encoder.encode({'c_col': value}), f'{expected},',
+                                 f'Type: {column_type}, value: {value!r}')
+
+    def test_variant_columns_are_json_encoded_once(self):
+        schema = {'c_pk': {'type': ['null', 'integer']}, 'c_obj': {'type': ['null', 'object', 'array']}}
+        values = [{'a': 'quote " and \\ é', 'b': [1, None]}, [], 'string', 0, False, None]
+
+        filename = csv.records_to_file({i: {'c_pk': i, 'c_obj': value} for i, value in enumerate(values)}, schema)
+
+        # Read the file like snowflake with the ESCAPE='\\' FIELD_OPTIONALLY_ENCLOSED_BY='"' file format
+        with open(filename, 'rt', newline='') as f:
+            rows = list(stdlib_csv.reader(f, escapechar='\\', doublequote=False))
+
+        self.assertListEqual([json.loads(row[1]) for row in rows], values)
+        os.remove(filename)
+
+    def test_variant_columns_match_flatten_record_output(self):
+        schema = {'c_pk': {'type': ['null', 'integer']},
+                  'c_obj_arr': {'type': ['null', 'object', 'array']},
+                  'c_obj': {'type': ['null', 'object']}}
+        records = [{'c_pk': 1, 'c_obj_arr': None, 'c_obj': None},
+                   {'c_pk': 2, 'c_obj_arr': 'x', 'c_obj': '[{"rule": "é"}]'},
+                   {'c_pk': 3, 'c_obj_arr': {'a': 'é ü'}, 'c_obj': {'a': ['é', None]}},
+                   {'c_pk': 4, 'c_obj_arr': 'é', 'c_obj': 'é'},
+                   {'c_pk': 5}]
+
+        # CSV lines of json dumped flatten_record values, like before the typed column encoders
+        expected = [','.join(json.dumps(flatten_record[column], ensure_ascii=False)
+                             if column in flatten_record and (flatten_record[column] == 0 or flatten_record[column])
+                             else '' for column in schema)
+                    for flatten_record in [flattening.flatten_record(record, schema) for record in records]]
+
+        self.assertListEqual([csv.record_to_csv_line(record, schema) for record in records], expected)
+        self.assertListEqual(expected[:2], ['1,"null",', '2,"\\"x\\"","[{\\"rule\\": \\"é\\"}]"'])
+
+    def test_nested_values_in_not_variant_columns_are_quoted(self):
+        schema = {'c_pk': {'type': ['null', 'integer']},
+                  'c_num': {'type': ['null', 'number']},
+                  'c_str': {'type': ['null', 'string']},
+                  'c_any': {'anyOf': [{'type': ['null', 'string']}, {'type': ['null', 'object']}]}}
+        record = {'c_pk': 1, 'c_num': [1, 2], 'c_str': {'a': 1, 'b': [1, 2]}, 'c_any': {'a': '"'}}
+
+        self.assertEqual(csv.record_to_csv_line(record, schema),
+                         '1,"[1, 2]","{\\"a\\": 1, \\"b\\": [1, 2]}","{\\"a\\": \\"\\\\\\"\\"}"')
+
+        filename = csv.records_to_file({'1': record}, schema)
+        with open(filename, 'rt', newline='') as f:
+            rows = list(stdlib_csv.reader(f, escapechar='\\', doublequote=False))
+        os.remove(filename)
+
+        self.assertListEqual([json.loads(value) for value in rows[0][1:]], [[1, 2], {'a': 1, 'b': [1, 2]}, {'a': '"'}])
+
+    @patch('target_snowflake.file_formats.csv.WRITE_CHUNK_ROWS', 2)
+    def test_write_records_to_file_in_chunks(self):
+        records = {f'pk_{i}': f'data{i}' for i in range(5)}
+
+        csv_file = tempfile.NamedTemporaryFile(delete=False)
+        with open(csv_file.name, 'wb') as f:
+            with patch.object(f, 'write', wraps=f.write) as write_mock:
+                csv.write_records_to_file(f, records, {}, _mock_record_to_csv_line)
+                self.assertEqual(write_mock.call_count, 3)
+
+        with open(csv_file.name, 'rt') as f:
+            self.assertEqual(f.readlines(), [f'data{i}\n' for i in range(5)])
+
+        os.remove(csv_file.name)
+
+    def test_records_to_file_with_compression_codecs(self):
+        schema = {'c_pk': {'type': ['null', 'integer']}, 'c_str': {'type': ['null', 'string']}}
+        records = {str(i): {'c_pk': i, 'c_str': 'x' * 100} for i in range(100)}
+        expected_lines = ''.join(f'{i},"{"x" * 100}"\n' for i in range(100))
+
+        gzip_file = csv.records_to_file(records, schema, compression='gzip', compression_level=1)
+        self.assertTrue(gzip_file.endswith('.csv.gz'))
+        with gzip.open(gzip_file, 'rt') as f:
+            self.assertEqual(f.read(), expected_lines)
+
+        with patch('target_snowflake.compression.PARALLEL_GZIP_CHUNK_SIZE', 1000), \
+                patch('target_snowflake.file_formats.csv.WRITE_CHUNK_ROWS', 10):
+            parallel_gzip_file = csv.records_to_file(records, schema, compression='gzip', compression_threads=4)
+        with open(parallel_gzip_file, 'rb') as f:
+            self.assertGreater(f.read().count(b'\x1f\x8b\x08'), 1)
+        with gzip.open(parallel_gzip_file, 'rt') as f:
+            self.assertEqual(f.read(), expected_lines)
+
+        zstd_file = csv.records_to_file(records, schema, compression='zstd', compression_level=10)
+        self.assertTrue(zstd_file.endswith('.csv.zst'))
+        with open(zstd_file, 'rb') as f:
+            self.assertEqual(zstandard.ZstdDecompressor().stream_reader(f).read().decode('UTF-8'), expected_lines)
+
+        uncompressed_file = csv.records_to_file(records, schema, compression='none')
+        self.assertTrue(uncompressed_file.endswith('.csv'))
+        with open(uncompressed_file, 'rt') as f:
+            self.assertEqual(f.read(), expected_lines)
+
+        with self.assertRaises(InvalidFileFormatException):
+            csv.records_to_file(records, schema, compression='snappy')
+
+        for filename in [gzip_file, parallel_gzip_file, zstd_file, uncompressed_file]:
+            os.remove(filename)
+
+    @patch('target_snowflake.file_formats.csv.WRITE_CHUNK_ROWS', 10)
+    def test_records_to_files_splits_by_max_file_size(self):
+        schema = {'c_pk': {'type': ['null', 'integer']}, 'c_str': {'type': ['null', 'string']}}
+        records = {str(i): {'c_pk': i, 'c_str': 'x' * 100} for i in range(100)}
+        expected_lines = [f'{i},"{"x" * 100}"\n' for i in range(100)]
+
+        filenames = csv.records_to_files(records, schema, compression='none', max_file_size=3000)
+
+        self.assertEqual(len(filenames), 4)
+        base_filename = filenames[0][:-len('_0000.csv')]
+        self.assertListEqual(filenames, [f'{base_filename}_{i:04d}.csv' for i in range(4)])
+
+        lines = []
+        for filename in filenames:
+            with open(filename, 'rt') as f:
+                lines.extend(f.readlines())
+            os.remove(filename)
+        self.assertListEqual(lines, expected_lines)
+
+        # Compressed files are split by the compressed size
+        filenames = csv.records_to_files(records, schema, compression='gzip', max_file_size=3000)
+        self.assertEqual(len(filenames), 1)
+        self.assertTrue(filenames[0].endswith('_0000.csv.gz'))
+        os.remove(filenames[0])
+
     def test_create_copy_sql(self):
         self.assertEqual(csv.create_copy_sql(table_name='foo_table',
                                              stage_name='foo_stage',
@@ -126,6 +304,19 @@ class TestCsv(unittest.TestCase):
                          "FILE_FORMAT = (format_name='foo_file_format')"
                          "ON_ERROR = CONTINUE")
 
+    def test_create_copy_sql_purge(self):
+        self.assertEqual(csv.create_copy_sql(table_name='foo_table',
+                                             stage_name='foo_stage',
+                                             s3_key='foo_s3_key.csv',
+                                             file_format_name='foo_file_format',
+                                             columns=[{'name': 'COL_1'}],
+                                             purge=True),
+
+                         "COPY INTO foo_table (COL_1) FROM "
+                         "'@foo_stage/foo_s3_key.csv' "
+                         "FILE_FORMAT = (format_name='foo_file_format') "
+                         "PURGE = TRUE")
+
     def test_create_merge_sql(self):
         self.assertEqual(csv.create_merge_sql(table_name='foo_table',
                                               stage_name='foo_stage',
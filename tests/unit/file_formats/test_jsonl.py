@@ -0,0 +1,107 @@
+import unittest
+import os
+import gzip
+import json
+
+from unittest.mock import patch
+
+import zstandard
+
+import target_snowflake.file_formats.jsonl as jsonl
+
+from target_snowflake.exceptions import InvalidFileFormatException
+
+
+class TestJsonl(unittest.TestCase):
+
+    def setUp(self):
+        self.maxDiff = None
+        self.schema = {
+            'c_pk': {'type': ['null', 'integer']},
+            'c_str': {'type': ['null', 'string']},
+            'c_obj': {'type': ['null', 'object']},
+        }
+        self.records = {
+            '1': {'c_pk': 1, 'c_str': 'é', 'c_obj': {'nested': [1, {'deep': None}]}},
+            '2': {'c_pk': 2, 'c_str': None, 'c_obj': None},
+        }
+
+    def test_records_to_file_keeps_nested_values(self):
+        for compression, open_fn in [(False, open),
+                                     ('gzip', gzip.open),
+                                     ('zstd', lambda filename, mode: zstandard.open(filename, mode))]:
+            filename = jsonl.records_to_file(self.records, self.schema, compression=compression)
+
+            with open_fn(filename, 'rb') as f:
+                lines = f.read().decode('UTF-8').splitlines()
+
+            self.assertListEqual([json.loads(line) for line in lines], list(self.records.values()))
+            self.assertIn('"é"', lines[0])
+            os.remove(filename)
+
+    def test_records_to_file_flattens_records(self):
+        filename = jsonl.records_to_file({'1': {'c_pk': 1, 'c_obj': {'nested': [1]}}}, self.schema,
+                                         data_flattening_max_level=1)
+        self.assertTrue(filename.endswith('.json'))
+
+        with open(filename, 'rt') as f:
+            self.assertEqual(json.loads(f.readline()), {'c_pk': 1, 'c_obj__nested': [1]})
+        os.remove(filename)
+
+    def test_records_to_file_with_not_supported_compression(self):
+        with self.assertRaises(InvalidFileFormatException):
+            jsonl.records_to_file(self.records, self.schema, compression='snappy')
+
+    @patch('target_snowflake.file_formats.jsonl.WRITE_CHUNK_ROWS', 1)
+    def test_records_to_files_splits_by_max_file_size(self):
+        filenames = jsonl.records_to_files(self.records, self.schema, compression='gzip', max_file_size=1)
+
+        self.assertEqual(len(filenames), 2)
+        self.assertTrue(filenames[0].endswith('_0000.json.gz'))
+        self.assertTrue(filenames[1].endswith('_0001.json.gz'))
+
+        for filename, record in zip(filenames, self.records.values()):
+            with gzip.open(filename, 'rt') as f:
+                self.assertEqual(json.loads(f.read()), record)
+            os.remove(filename)
+
+    def test_create_copy_sql(self):
+        self.assertEqual(jsonl.create_copy_sql(table_name='foo_table',
+                                               stage_name='foo_stage',
+                                               s3_key='foo_s3_key.json.gz',
+                                               file_format_name='foo_file_format',
+                                               columns=[{'name': 'COL_1', 'json_element_name': '"col_1"',
+                                                         'trans': ''},
+                                                        {'name': 'COL_2', 'json_element_name': '"col_2"',
+                                                         'trans': 'parse_json'},
+                                                        {'name': 'COL_3', 'json_element_name': '"col_3"',
+                                                         'trans': 'to_binary'}],
+                                               on_error='CONTINUE'),
+
+                         'COPY INTO foo_table (COL_1, COL_2, COL_3) FROM ('
+                         'SELECT ($1:"col_1") COL_1, $1:"col_2" COL_2, to_binary($1:"col_3") COL_3 '
+                         "FROM '@foo_stage/foo_s3_key.json.gz'"
+                         ') '
+                         "FILE_FORMAT = (format_name='foo_file_format')"
+                         'ON_ERROR = CONTINUE')
+
+    def test_create_merge_sql(self):
+        self.assertEqual(jsonl.create_merge_sql(table_name='foo_table',
+                                                stage_name='foo_stage',
+                                                s3_key='foo_s3_key.json.gz',
+                                                file_format_name='foo_file_format',
+                                                columns=[{'name': 'COL_1', 'json_element_name': '"col_1"',
+                                                          'trans': ''},
+                                                         {'name': 'COL_2', 'json_element_name': '"col_2"',
+                                                          'trans': 'parse_json'}],
+                                                pk_merge_condition='s.COL_1 = t.COL_1'),
+
+                         'MERGE INTO foo_table t USING ('
+                         'SELECT ($1:"col_1") COL_1, $1:"col_2" COL_2 '
+                         "FROM '@foo_stage/foo_s3_key.json.gz' "
+                         "(FILE_FORMAT => 'foo_file_format')) s "
+                         'ON s.COL_1 = t.COL_1 '
+                         'WHEN MATCHED THEN UPDATE SET COL_1=s.COL_1, COL_2=s.COL_2 '
+                         'WHEN NOT MATCHED THEN '
+                         'INSERT (COL_1, COL_2) '
+                         'VALUES (s.COL_1, s.COL_2)')
@@ -1,7 +1,11 @@
+import json
+import os
 import unittest
 
-from pandas._testing import assert_frame_equal
-from pandas import DataFrame
+from datetime import datetime
+
+import pyarrow
+import pyarrow.parquet
 
 import target_snowflake.file_formats.parquet as parquet
 
@@ -12,43 +16,235 @@ class TestParquet(unittest.TestCase):
         self.maxDiff = None
         self.config = {}
 
-    def test_records_to_dataframe(self):
+    def test_records_to_table(self):
+        schema = {
+            'c_int': {'type': ['null', 'integer']},
+            'c_big_int': {'type': ['null', 'integer']},
+            'c_number': {'type': ['null', 'number']},
+            'c_bool': {'type': ['null', 'boolean']},
+            'c_str': {'type': ['null', 'string']},
+            'c_int_or_str': {'type': ['null', 'integer', 'string']},
+            'c_date': {'type': ['null', 'string'], 'format': 'date'},
+            'c_datetime': {'type': ['null', 'string'], 'format': 'date-time'},
+            'c_datetime_tz': {'type': ['null', 'string'], 'format': 'date-time'},
+            'c_obj': {'type': ['null', 'object']},
+            'c_arr': {'type': ['null', 'array']},
+        }
         records = {
-            '1': {
-                'key1': 1,
-                'key2': '2031-01-22',
-                'key3': '10000-01-22 12:04:22',
-                'key4': '12:01:01',
-                'key5': 'I\'m good',
-                'key6': None,
-            },
-            '2': {
-                'key1': 2,
-                'key2': '2032-01-22',
-                'key3': '10000-01-22 12:04:22',
-                'key4': '13:01:01',
-                'key5': 'I\'m good too',
-                'key6': None,
-            },
-            '3': {
-                'key1': 3,
-                'key2': '2033-01-22',
-                'key3': '10000-01-22 12:04:22',
-                'key4': '14:01:01',
-                'key5': 'I want to be good',
-                'key6': None,
-            }
+            '1': {'c_int': 1, 'c_big_int': 1, 'c_number': 1, 'c_bool': True, 'c_str': 'a', 'c_int_or_str': 1,
+                  'c_date': '2021-01-01', 'c_datetime': '2021-01-01T10:00:00.123456Z',
+                  'c_datetime_tz': '2021-01-01T10:00:00+02:00', 'c_obj': {'a': 'é'}, 'c_arr': [1, 2]},
+            '2': {'c_int': None, 'c_big_int': 10 ** 30, 'c_number': 1.5, 'c_bool': False, 'c_int_or_str': 'b',
+                  'c_datetime': '2021-01-02 10:00:00', 'c_datetime_tz': '2021-01-02T10:00:00Z', 'c_arr': []},
         }
 
-        schema = {}
-        assert_frame_equal(parquet.records_to_dataframe(records=records, schema=schema),
-                           DataFrame({
-                               'key1': [1, 2, 3],
-                               'key2': ['2031-01-22', '2032-01-22', '2033-01-22'],
-                               'key3': ['10000-01-22 12:04:22', '10000-01-22 12:04:22', '10000-01-22 12:04:22'],
-                               'key4': ['12:01:01', '13:01:01', '14:01:01'],
-                               'key5': ['I\'m good', 'I\'m good too', 'I want to be good'],
-                               'key6': [None, None, None]}))
+        table = parquet.records_to_table(records, schema, flattened=True)
+
+        self.assertEqual(table.schema, pyarrow.schema([
+            ('c_int', pyarrow.int64()),
+            ('c_big_int', pyarrow.string()),
+            ('c_number', pyarrow.float64()),
+            ('c_bool', pyarrow.bool_()),
+            ('c_str', pyarrow.string()),
+            ('c_int_or_str', pyarrow.string()),
+            ('c_date', pyarrow.string()),
+            ('c_datetime', pyarrow.timestamp('us')),
+            ('c_datetime_tz', pyarrow.timestamp('us')),
+            ('c_obj', pyarrow.struct([('a', pyarrow.string())])),
+            ('c_arr', pyarrow.list_(pyarrow.int64())),
+        ]))
+        self.assertDictEqual(table.to_pydict(), {
+            'c_int': [1, None],
+            'c_big_int': ['1', str(10 ** 30)],
+            'c_number': [1.0, 1.5],
+            'c_bool': [True, False],
+            'c_str': ['a', None],
+            'c_int_or_str': ['1', 'b'],
+            'c_date': ['2021-01-01', None],
+            'c_datetime': [datetime(2021, 1, 1, 10, 0, 0, 123456), datetime(2021, 1, 2, 10, 0, 0)],
+            'c_datetime_tz': [datetime(2021, 1, 1, 10, 0, 0), datetime(2021, 1, 2, 10, 0, 0)],
+            'c_obj': [{'a': 'é'}, None],
+            'c_arr': [[1, 2], []],
+        })
+
+    def test_records_to_table_with_not_nested_type_objects_and_arrays(self):
+        # Objects with different keys, empty objects and mixed types, even integers and floats, don't fit
+        # a nested parquet type
+        for values in [[{'a': 1}, {'b': 1}],
+                       [{}, None],
+                       [[1, 'x']],
+                       [{'a': 1}, [1]],
+                       [1, 2],
+                       [[1, 2.5]],
+                       [{'a': 1}, {'a': 1.5}],
+                       [[True, 1]]]:
+            table = parquet.records_to_table({i: {'c_variant': value} for i, value in enumerate(values)},
+                                             {'c_variant': {'type': ['null', 'object', 'array']}}, flattened=True)
+
+            self.assertEqual(table.schema.field('c_variant').type, pyarrow.string())
+            self.assertListEqual(table.to_pydict()['c_variant'],
+                                 [json.dumps(value, ensure_ascii=False) if value is not None else None
+                                  for value in values])
+
+    def test_records_to_table_keeps_json_text_strings_of_variant_columns(self):
+        # Strings are JSON texts already, they are not encoded again next to the JSON encoded objects
+        values = ['[{"rule": 1}]', {'a': 1}, None]
+        table = parquet.records_to_table({i: {'c_variant': value} for i, value in enumerate(values)},
+                                         {'c_variant': {'type': ['null', 'object']}}, flattened=True)
+
+        self.assertEqual(table.schema.field('c_variant').type, pyarrow.string())
+        self.assertListEqual(table.to_pydict()['c_variant'], ['[{"rule": 1}]', '{"a": 1}', None])
+        self.assertListEqual([json.loads(value) for value in table.to_pydict()['c_variant'][:2]],
+                             [[{'rule': 1}], {'a': 1}])
+
+    def test_records_to_file_keeps_nested_columns(self):
+        schema = {'c_pk': {'type': ['integer']}, 'c_obj': {'type': ['null', 'object']}}
+        records = {'1': {'c_pk': 1, 'c_obj': {'nested': {'list': [{'x': 1.5}]}}},
+                   '2': {'c_pk': 2, 'c_obj': {'nested': {'list': []}}}}
+
+        filename = parquet.records_to_file(records, schema)
+        self.assertListEqual(pyarrow.parquet.read_table(filename).to_pydict()['c_obj'],
+                             [records['1']['c_obj'], records['2']['c_obj']])
+        os.remove(filename)
+
+    def test_records_to_table_with_off_type_values_falls_back_to_strings(self):
+        # Only the column of the off-type value is a string column, snowflake casts the strings when loading
+        for column_schema, values, expected in [
+                ({'type': ['null', 'integer']}, [1, 'Non Numeric PK'], ['1', 'Non Numeric PK']),
+                ({'type': ['null', 'integer']}, [1, 1.5], ['1', '1.5']),
+                ({'type': ['null', 'number']}, [1.5, 'x'], ['1.5', 'x']),
+                ({'type': ['null', 'boolean']}, [True, 1], ['true', '1']),
+                ({'type': ['null', 'string']}, ['a', 1], ['a', '1']),
+                ({'type': ['null', 'string'], 'format': 'date-time'}, ['2021-01-01T10:00:00Z', 'x'],
+                 ['2021-01-01T10:00:00Z', 'x'])]:
+            table = parquet.records_to_table({str(i): {'c_pk': i, 'c_col': value}
+                                              for i, value in enumerate(values + [None])},
+                                             {'c_pk': {'type': ['integer']}, 'c_col': column_schema}, flattened=True)
+
+            self.assertEqual(table.schema.field('c_pk').type, pyarrow.int64())
+            self.assertEqual(table.schema.field('c_col').type, pyarrow.string())
+            self.assertListEqual(table.to_pydict()['c_col'], expected + [None])
+
+    def test_records_to_file_with_row_group_size_and_dictionary(self):
+        schema = {'c_pk': {'type': ['null', 'integer']}, 'c_str': {'type': ['null', 'string']}}
+        records = {str(i): {'c_pk': i, 'c_str': 'x'} for i in range(100)}
+
+        filename = parquet.records_to_file(records, schema, row_group_size=30, use_dictionary=False)
+        metadata = pyarrow.parquet.ParquetFile(filename).metadata
+        self.assertEqual(metadata.num_row_groups, 4)
+        self.assertNotIn('RLE_DICTIONARY', metadata.row_group(0).column(1).encodings)
+        os.remove(filename)
+
+        filename = parquet.records_to_file(records, schema)
+        metadata = pyarrow.parquet.ParquetFile(filename).metadata
+        self.assertEqual(metadata.num_row_groups, 1)
+        self.assertIn('RLE_DICTIONARY', metadata.row_group(0).column(1).encodings)
+        os.remove(filename)
+
+    def test_records_to_file_with_compression_codecs(self):
+        schema = {'c_pk': {'type': ['null', 'integer']}, 'c_str': {'type': ['null', 'string']}}
+        records = {str(i): {'c_pk': i, 'c_str': 'x' * 100} for i in range(100)}
+
+        for compression, suffix, parquet_codec in [(True, '.parquet.gz', 'GZIP'),
+                                                   ('snappy', '.parquet', 'SNAPPY'),
+                                                   ('zstd', '.parquet', 'ZSTD'),
+                                                   ('lz4', '.parquet', 'LZ4'),
+                                                   ('none', '.parquet', 'UNCOMPRESSED')]:
+            filename = parquet.records_to_file(records, schema, compression=compression)
+            self.assertTrue(filename.endswith(suffix))
+
+            parquet_file = pyarrow.parquet.ParquetFile(filename)
+            self.assertEqual(parquet_file.metadata.row_group(0).column(0).compression, parquet_codec)
+            self.assertEqual(parquet_file.read().to_pydict()['c_pk'], list(range(100)))
+            os.remove(filename)
+
+    def test_compression_level_is_not_passed_for_codecs_without_levels(self):
+        schema = {'c_pk': {'type': ['null', 'integer']}}
+
+        for compression in ['snappy', 'lz4', 'none']:
+            filename = parquet.records_to_file({'1': {'c_pk': 1}}, schema, compression=compression, compression_level=5)
+            self.assertEqual(pyarrow.parquet.read_table(filename).to_pydict()['c_pk'], [1])
+            os.remove(filename)
+
+            records = parquet.StreamingRecords(schema, compression=compression, compression_level=5)
+            records['1'] = {'c_pk': 1}
+            for filename in records.close():
+                self.assertEqual(pyarrow.parquet.read_table(filename).to_pydict()['c_pk'], [1])
+                os.remove(filename)
+
+    def test_records_to_files_splits_by_max_file_size(self):
+        schema = {'c_pk': {'type': ['null', 'integer']}, 'c_str': {'type': ['null', 'string']}}
+        records = {str(i): {'c_pk': i, 'c_str': 'x' * 100} for i in range(100)}
+
+        filenames = parquet.records_to_files(records, schema, compression='snappy', max_file_size=5000)
+
+        self.assertGreater(len(filenames), 1)
+        base_filename = filenames[0][:-len('_0000.parquet')]
+        self.assertListEqual(filenames, [f'{base_filename}_{i:04d}.parquet' for i in range(len(filenames))])
+
+        c_pk = []
+        for filename in filenames:
+            c_pk.extend(pyarrow.parquet.read_table(filename).to_pydict()['c_pk'])
+            os.remove(filename)
+        self.assertListEqual(c_pk, list(range(100)))
+
+    def test_streaming_records_writes_row_groups_as_records_arrive(self):
+        schema = {'c_pk': {'type': ['null', 'integer']}, 'c_str': {'type': ['null', 'string']}}
+        records = parquet.StreamingRecords(schema, compression='snappy', row_group_size=10)
+
+        for i in range(35):
+            records[f'RID-{i}'] = {'c_pk': i, 'c_str': f'value {i}'}
+            # Only the records of the current row group are kept in memory
+            self.assertLess(len(records._rows), 10)
+
+        self.assertEqual(len(records), 35)
+        self.assertNotIn('RID-1', records)
+
+        filenames = parquet.records_to_files(records, schema)
+        self.assertEqual(len(filenames), 1)
+        self.assertTrue(filenames[0].endswith('_0000.parquet'))
+
+        parquet_file = pyarrow.parquet.ParquetFile(filenames[0])
+        self.assertEqual(parquet_file.metadata.num_row_groups, 4)
+        self.assertListEqual(parquet_file.read().to_pydict()['c_pk'], list(range(35)))
+        os.remove(filenames[0])
+
+    def test_streaming_records_starts_new_file_if_row_group_schema_changes(self):
+        schema = {'c_pk': {'type': ['null', 'integer']},
+                  'c_datetime': {'type': ['null', 'string'], 'format': 'date-time'}}
+        records = parquet.StreamingRecords(schema, row_group_size=2)
+
+        records['RID-0'] = {'c_pk': 0, 'c_datetime': '2021-01-01T00:00:00Z'}
+        records['RID-1'] = {'c_pk': 1, 'c_datetime': None}
+        # Not ISO-8601 date-times are written as strings, that doesn't fit the schema of the first file
+        records['RID-2'] = {'c_pk': 2, 'c_datetime': '2021-01-01 at noon'}
+
+        filenames = records.close()
+        self.assertEqual(len(filenames), 2)
+        self.assertTrue(filenames[1].endswith('_0001.parquet'))
+        self.assertEqual(pyarrow.parquet.read_table(filenames[0]).schema.field('c_datetime').type,
+                         pyarrow.timestamp('us'))
+        self.assertDictEqual(pyarrow.parquet.read_table(filenames[1]).to_pydict(),
+                             {'c_pk': [2], 'c_datetime': ['2021-01-01 at noon']})
+
+        for filename in filenames:
+            os.remove(filename)
+
+    def test_streaming_records_splits_by_max_file_size(self):
+        schema = {'c_pk': {'type': ['null', 'integer']}, 'c_str': {'type': ['null', 'string']}}
+        records = parquet.StreamingRecords(schema, row_group_size=10, max_file_size=1)
+
+        for i in range(25):
+            records[f'RID-{i}'] = {'c_pk': i, 'c_str': 'x'}
+
+        filenames = records.close()
+        self.assertEqual(len(filenames), 3)
+
+        c_pk = []
+        for filename in filenames:
+            c_pk.extend(pyarrow.parquet.read_table(filename).to_pydict()['c_pk'])
+            os.remove(filename)
+        self.assertListEqual(c_pk, list(range(25)))
 
     def test_create_copy_sql(self):
         self.assertEqual(parquet.create_copy_sql(table_name='foo_table',
@@ -62,11 +258,41 @@ class TestParquet(unittest.TestCase):
                                                            'trans': 'parse_json'}]),
 
                          "COPY INTO foo_table (COL_1, COL_2, COL_3) FROM ("
-                         "SELECT ($1:col_1) COL_1, ($1:colTwo) COL_2, parse_json($1:col_3) COL_3 "
+                         "SELECT ($1:col_1) COL_1, ($1:colTwo) COL_2, "
+                         "IFF(IS_VARCHAR($1:col_3), PARSE_JSON($1:col_3::VARCHAR), $1:col_3) COL_3 "
                          "FROM '@foo_stage/foo_s3_key.parquet'"
                          ") "
                          "FILE_FORMAT = (format_name='foo_file_format')")
 
+    def test_create_copy_sql_by_column_names(self):
+        self.assertEqual(parquet.create_copy_sql(table_name='foo_table',
+                                                 stage_name='foo_stage',
+                                                 s3_key='foo_s3_key.parquet',
+                                                 file_format_name='foo_file_format',
+                                                 columns=[{'name': 'COL_1', 'json_element_name': 'col_1', 'trans': ''},
+                                                          {'name': 'COL_2',
+                                                              'json_element_name': 'colTwo', 'trans': ''}],
+                                                 on_error="CONTINUE"),
+
+                         "COPY INTO foo_table "
+                         "FROM '@foo_stage/foo_s3_key.parquet' "
+                         "FILE_FORMAT = (format_name='foo_file_format') "
+                         "MATCH_BY_COLUMN_NAME = CASE_INSENSITIVE ON_ERROR = CONTINUE")
+
+    def test_create_copy_sql_purge(self):
+        self.assertEqual(parquet.create_copy_sql(table_name='foo_table',
+                                                 stage_name='foo_stage',
+                                                 s3_key='foo_s3_key.parquet',
+                                                 file_format_name='foo_file_format',
+                                                 columns=[{'name': 'COL_1', 'json_element_name': 'col_1', 'trans': ''}],
+                                                 on_error="CONTINUE",
+                                                 purge=True),
+
+                         "COPY INTO foo_table "
+                         "FROM '@foo_stage/foo_s3_key.parquet' "
+                         "FILE_FORMAT = (format_name='foo_file_format') "
+                         "MATCH_BY_COLUMN_NAME = CASE_INSENSITIVE ON_ERROR = CONTINUE PURGE = TRUE")
+
     def test_create_copy_sql_on_error(self):
         self.assertEqual(parquet.create_copy_sql(table_name='foo_table',
                                                  stage_name='foo_stage',
@@ -80,7 +306,8 @@ class TestParquet(unittest.TestCase):
                                                  on_error="CONTINUE"),
 
                          "COPY INTO foo_table (COL_1, COL_2, COL_3) FROM ("
-                         "SELECT ($1:col_1) COL_1, ($1:colTwo) COL_2, parse_json($1:col_3) COL_3 "
+                         "SELECT ($1:col_1) COL_1, ($1:colTwo) COL_2, "
+                         "IFF(IS_VARCHAR($1:col_3), PARSE_JSON($1:col_3::VARCHAR), $1:col_3) COL_3 "
                          "FROM '@foo_stage/foo_s3_key.parquet'"
                          ") "
                          "FILE_FORMAT = (format_name='foo_file_format')"
@@ -102,7 +329,8 @@ class TestParquet(unittest.TestCase):
                                                   pk_merge_condition='s.COL_1 = t.COL_1'),
 
                          "MERGE INTO foo_table t USING ("
-                         "SELECT ($1:col_1) COL_1, ($1:colTwo) COL_2, parse_json($1:col_3) COL_3 "
+                         "SELECT ($1:col_1) COL_1, ($1:colTwo) COL_2, "
+                         "IFF(IS_VARCHAR($1:col_3), PARSE_JSON($1:col_3::VARCHAR), $1:col_3) COL_3 "
                          "FROM '@foo_stage/foo_s3_key.parquet' "
                          "(FILE_FORMAT => 'foo_file_format')) s "
                          "ON s.COL_1 = t.COL_1 "
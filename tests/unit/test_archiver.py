@@ -0,0 +1,47 @@
+import threading
+import unittest
+
+from target_snowflake.archiver import Archiver
+
+
+class TestArchiver(unittest.TestCase):
+
+    def setUp(self):
+        self.archiver = Archiver(max_workers=1, max_queued=1)
+
+    def tearDown(self):
+        self.archiver.shutdown()
+
+    def test_submit_blocks_while_queue_is_full(self):
+        release = threading.Event()
+        copied = []
+
+        def copy_fn(key):
+            release.wait(5)
+            copied.append(key)
+
+        self.archiver.submit(copy_fn, 'key_1')
+        self.archiver.submit(copy_fn, 'key_2')
+
+        # One copy is running, one is queued, the next submit waits for a free slot
+        third_submitted = threading.Event()
+        submitter = threading.Thread(target=lambda: (self.archiver.submit(copy_fn, 'key_3'), third_submitted.set()))
+        submitter.start()
+        self.assertFalse(third_submitted.wait(0.2))
+
+        release.set()
+        self.assertTrue(third_submitted.wait(5))
+        submitter.join()
+        self.archiver.shutdown()
+        self.assertListEqual(copied, ['key_1', 'key_2', 'key_3'])
+
+    def test_errors_raised_by_the_future(self):
+        def copy_fn():
+            raise ValueError('Failed to copy')
+
+        future = self.archiver.submit(copy_fn)
+        with self.assertRaises(ValueError):
+            future.result()
+
+        # The slot of the failed copy is released
+        self.assertEqual(self.archiver.submit(lambda: 'copied').result(), 'copied')
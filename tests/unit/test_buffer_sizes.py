@@ -0,0 +1,56 @@
+import unittest
+
+from target_snowflake.buffer_sizes import BufferSizes
+
+
+class TestBufferSizes(unittest.TestCase):
+
+    def test_total_is_updated_incrementally(self):
+        sizes = BufferSizes()
+        sizes.add('stream_1', 100)
+        sizes.add('stream_1', 50)
+        sizes.add('stream_2', 10)
+
+        self.assertEqual(sizes.get('stream_1'), 150)
+        self.assertEqual(sizes.total, 160)
+
+        sizes.reset('stream_1')
+        self.assertEqual(sizes.get('stream_1'), 0)
+        self.assertEqual(sizes.total, 10)
+
+        # Resetting unknown streams is safe
+        sizes.reset('stream_3')
+        self.assertEqual(sizes.total, 10)
+
+    def test_largest_streams(self):
+        sizes = BufferSizes()
+        sizes.add('small', 10)
+        sizes.add('medium', 100)
+        sizes.add('big', 1000)
+
+        self.assertListEqual(sizes.largest_streams(1110), [])
+        self.assertListEqual(sizes.largest_streams(500), ['big'])
+        self.assertListEqual(sizes.largest_streams(50), ['big', 'medium'])
+        self.assertListEqual(sizes.largest_streams(0), ['big', 'medium', 'small'])
+
+        # Streams without buffered records are never selected
+        sizes.reset('small')
+        self.assertListEqual(sizes.largest_streams(0), ['big', 'medium'])
+
+    def test_batches_in_flight_count_until_released(self):
+        sizes = BufferSizes()
+        sizes.add('stream_1', 100)
+        sizes.add('stream_2', 10)
+
+        in_flight_size = sizes.hand_off('stream_1')
+        self.assertEqual(in_flight_size, 100)
+        self.assertEqual(sizes.get('stream_1'), 0)
+        self.assertEqual(sizes.in_flight, 100)
+        self.assertEqual(sizes.total, 110)
+
+        # Batches in flight can't be flushed again
+        self.assertListEqual(sizes.largest_streams(0), ['stream_2'])
+
+        sizes.release(in_flight_size)
+        self.assertEqual(sizes.in_flight, 0)
+        self.assertEqual(sizes.total, 10)
@@ -0,0 +1,72 @@
+import gzip
+import tempfile
+import unittest
+
+from target_snowflake import compression
+
+
+class TestCompression(unittest.TestCase):
+
+    def test_get_compression(self):
+        self.assertEqual(compression.get_compression({}), 'gzip')
+        self.assertEqual(compression.get_compression({'compression': 'ZSTD'}), 'zstd')
+        self.assertEqual(compression.get_compression({'compression': 'zstd', 'no_compression': True}), 'none')
+
+    def test_to_codec(self):
+        self.assertEqual(compression.to_codec(True), 'gzip')
+        self.assertEqual(compression.to_codec(False), 'none')
+        self.assertEqual(compression.to_codec('Snappy'), 'snappy')
+
+    def test_validate_config_by_file_format_type(self):
+        self.assertEqual(compression.validate_config({'compression': 'snappy'}), [])
+        self.assertEqual(compression.validate_config({'compression': 'snappy'}, 'parquet'), [])
+        self.assertEqual(compression.validate_config({'compression': 'gzip'}, 'json'), [])
+        self.assertEqual(len(compression.validate_config({'compression': 'snappy'}, 'csv')), 1)
+        self.assertEqual(len(compression.validate_config({'compression': 'lz4'}, 'json')), 1)
+        self.assertEqual(len(compression.validate_config({'compression': 'bz2'}, 'csv')), 1)
+
+    def test_validate_config_compression_level(self):
+        self.assertEqual(compression.validate_config({'compression': 'gzip', 'compression_level': 9}), [])
+        self.assertEqual(compression.validate_config({'compression': 'zstd', 'compression_level': 22}), [])
+        self.assertEqual(compression.validate_config({'compression_level': 1}, 'parquet'), [])
+
+        # Out of the range of the codec
+        self.assertEqual(len(compression.validate_config({'compression': 'gzip', 'compression_level': 0})), 1)
+        self.assertEqual(len(compression.validate_config({'compression': 'gzip', 'compression_level': 10})), 1)
+        self.assertEqual(len(compression.validate_config({'compression': 'zstd', 'compression_level': 23})), 1)
+        self.assertEqual(len(compression.validate_config({'compression': 'zstd', 'compression_level': True})), 1)
+
+        # Codecs without compression levels
+        self.assertEqual(len(compression.validate_config({'compression': 'snappy', 'compression_level': 1},
+                                                         'parquet')), 1)
+        self.assertEqual(len(compression.validate_config({'compression': 'lz4', 'compression_level': 1})), 1)
+        self.assertEqual(len(compression.validate_config({'compression': 'none', 'compression_level': 1})), 1)
+        self.assertEqual(len(compression.validate_config({'no_compression': True, 'compression_level': 1})), 1)
+
+    def test_put_compression_option(self):
+        self.assertEqual(compression.put_compression_option('/tmp/batch_x.csv.gz'), 'SOURCE_COMPRESSION=GZIP')
+        self.assertEqual(compression.put_compression_option('/tmp/batch_x.csv.zst'), 'SOURCE_COMPRESSION=ZSTD')
+        self.assertEqual(compression.put_compression_option('/tmp/batch_x.parquet.gz'), 'SOURCE_COMPRESSION=GZIP')
+        self.assertEqual(compression.put_compression_option('/tmp/batch_x.csv'), '')
+        self.assertEqual(compression.put_compression_option('/tmp/batch_x.parquet'), '')
+
+    def test_parallel_gzip_file_writes_multi_member_gzip(self):
+        data = [f'line {i}\n'.encode('UTF-8') for i in range(10000)]
+
+        with tempfile.TemporaryFile() as outfile:
+            with compression.ParallelGzipFile(outfile, compresslevel=1, threads=3, chunk_size=1000) as gzipfile:
+                for line in data:
+                    gzipfile.write(line)
+
+            outfile.seek(0)
+            compressed = outfile.read()
+
+        # Every chunk is an independent gzip member
+        self.assertGreater(compressed.count(b'\x1f\x8b\x08'), 10)
+        self.assertEqual(gzip.decompress(compressed), b''.join(data))
+
+    def test_open_compressed_file_with_threads(self):
+        with tempfile.TemporaryFile() as outfile:
+            self.assertIsInstance(compression.open_compressed_file(outfile, 'gzip', threads=4),
+                                  compression.ParallelGzipFile)
+            self.assertIsInstance(compression.open_compressed_file(outfile, 'gzip', threads=1), gzip.GzipFile)
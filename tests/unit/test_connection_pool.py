@@ -0,0 +1,176 @@
+import unittest
+
+from unittest.mock import patch, MagicMock
+
+from target_snowflake import connection_pool
+
+
+def _connection_params(query_tag=None):
+    return {
+        'user': 'dummy-user',
+        'account': 'dummy-account',
+        'private_key': b'dummy-key',
+        'autocommit': True,
+        'session_parameters': {
+            'QUOTED_IDENTIFIERS_IGNORE_CASE': 'FALSE',
+            'QUERY_TAG': query_tag
+        }
+    }
+
+
+def _new_connection(*args, **kwargs):
+    connection = MagicMock()
+    connection.is_closed.return_value = False
+    return connection
+
+
+@patch('target_snowflake.connection_pool.snowflake.connector.connect', side_effect=_new_connection)
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = connection_pool.ConnectionPool()
+
+    def test_reuse_connection(self, connect_mock):
+        with self.pool.connection(_connection_params()) as first:
+            pass
+        with self.pool.connection(_connection_params()) as second:
+            pass
+
+        self.assertIs(first, second)
+        self.assertEqual(connect_mock.call_count, 1)
+        first.close.assert_not_called()
+
+    def test_concurrent_checkouts_get_different_connections(self, connect_mock):
+        with self.pool.connection(_connection_params()) as first:
+            with self.pool.connection(_connection_params()) as second:
+                self.assertIsNot(first, second)
+
+        self.assertEqual(connect_mock.call_count, 2)
+
+    def test_session_parameters_are_part_of_the_key(self, connect_mock):
+        with self.pool.connection(_connection_params('tag_1')) as first:
+            pass
+        with self.pool.connection(_connection_params('tag_2')) as second:
+            pass
+
+        self.assertIsNot(first, second)
+        self.assertEqual(connect_mock.call_count, 2)
+
+    def test_pool_size_zero_disables_pooling(self, connect_mock):
+        with self.pool.connection(_connection_params(), pool_size=0) as first:
+            pass
+        with self.pool.connection(_connection_params(), pool_size=0) as second:
+            pass
+
+        self.assertIsNot(first, second)
+        first.close.assert_called_once()
+        second.close.assert_called_once()
+
+    def test_pool_size_limits_idle_connections(self, connect_mock):
+        with self.pool.connection(_connection_params(), pool_size=1) as first:
+            with self.pool.connection(_connection_params(), pool_size=1) as second:
+                pass
+
+        # Second connection returned first and evicted when the first one is returned to the full pool
+        second.close.assert_called_once()
+        first.close.assert_not_called()
+
+        with self.pool.connection(_connection_params(), pool_size=1) as third:
+            pass
+        self.assertIs(third, first)
+
+    @patch('target_snowflake.connection_pool.time.monotonic')
+    def test_idle_connections_are_evicted(self, monotonic_mock, connect_mock):
+        monotonic_mock.return_value = 1000
+        with self.pool.connection(_connection_params(), idle_timeout=600) as first:
+            pass
+
+        monotonic_mock.return_value = 1601
+        with self.pool.connection(_connection_params(), idle_timeout=600) as second:
+            pass
+
+        self.assertIsNot(first, second)
+        first.close.assert_called_once()
+
+    @patch('target_snowflake.connection_pool.time.monotonic')
+    def test_idle_connections_of_every_key_are_evicted_on_checkout(self, monotonic_mock, connect_mock):
+        monotonic_mock.return_value = 1000
+        with self.pool.connection(_connection_params('tag_1'), idle_timeout=600) as first:
+            pass
+
+        monotonic_mock.return_value = 1601
+        with self.pool.connection(_connection_params('tag_2'), idle_timeout=600):
+            # The idle connection of the other query tag is closed without checking it out
+            first.close.assert_called_once()
+
+        self.assertEqual(list(self.pool._idle_connections), [connection_pool.pool_key(_connection_params('tag_2'))])
+
+    @patch('target_snowflake.connection_pool.time.monotonic')
+    def test_max_idle_connections_of_every_key(self, monotonic_mock, connect_mock):
+        pool = connection_pool.ConnectionPool(max_idle_connections=2)
+        connections = []
+        for i in range(3):
+            monotonic_mock.return_value = 1000 + i
+            with pool.connection(_connection_params(f'tag_{i}')) as connection:
+                connections.append(connection)
+
+        # The least recently used connection is closed once the pool holds too many idle connections
+        connections[0].close.assert_called_once()
+        connections[1].close.assert_not_called()
+        connections[2].close.assert_not_called()
+
+        with pool.connection(_connection_params('tag_1')) as reused:
+            self.assertIs(reused, connections[1])
+
+    @patch('target_snowflake.connection_pool.time.monotonic')
+    def test_unhealthy_connections_are_discarded(self, monotonic_mock, connect_mock):
+        monotonic_mock.return_value = 1000
+        with self.pool.connection(_connection_params()) as first:
+            pass
+
+        # Ping fails after longer idle period
+        first.cursor.return_value.__enter__.return_value.execute.side_effect = Exception('Session expired')
+        monotonic_mock.return_value = 1000 + connection_pool.HEALTH_CHECK_AFTER_SECONDS + 1
+        with self.pool.connection(_connection_params()) as second:
+            pass
+
+        self.assertIsNot(first, second)
+        first.close.assert_called_once()
+
+        # Closed connections are discarded without ping
+        second.is_closed.return_value = True
+        with self.pool.connection(_connection_params()) as third:
+            pass
+        self.assertIsNot(second, third)
+
+    def test_failed_connection_is_rolled_back(self, connect_mock):
+        with self.assertRaises(ValueError):
+            with self.pool.connection(_connection_params()) as first:
+                raise ValueError('Query failed')
+
+        first.rollback.assert_called_once()
+        with self.pool.connection(_connection_params()) as second:
+            pass
+        self.assertIs(first, second)
+
+        # Connection is dropped if it cannot be rolled back
+        second.rollback.side_effect = Exception('Connection lost')
+        with self.assertRaises(ValueError):
+            with self.pool.connection(_connection_params()):
+                raise ValueError('Query failed')
+
+        second.close.assert_called_once()
+        with self.pool.connection(_connection_params()) as third:
+            pass
+        self.assertIsNot(second, third)
+
+    def test_close_all(self, connect_mock):
+        with self.pool.connection(_connection_params('tag_1')) as first:
+            pass
+        with self.pool.connection(_connection_params('tag_2')) as second:
+            pass
+
+        self.pool.close_all()
+
+        first.close.assert_called_once()
+        second.close.assert_called_once()
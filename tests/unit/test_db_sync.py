@@ -1,4 +1,5 @@
 import json
+import tempfile
 import unittest
 import os
 import pytest
@@ -97,6 +98,35 @@ class TestDBSync(unittest.TestCase):
         config_with_archive_load_files['archive_load_files'] = True
         self.assertGreater(len(validator(config_with_external_stage)), 0)
 
+        # Configuration with supported and not supported compression codecs
+        for codec in ['gzip', 'zstd', 'GZIP']:
+            self.assertEqual(len(validator({**minimal_config, 'compression': codec, 'compression_level': 1})), 0)
+        for codec in ['snappy', 'lz4', 'none']:
+            self.assertEqual(len(validator({**minimal_config, 'compression': codec})), 0)
+            self.assertGreater(len(validator({**minimal_config, 'compression': codec, 'compression_level': 1})), 0)
+        self.assertGreater(len(validator({**minimal_config, 'compression': 'bz2'})), 0)
+        self.assertGreater(len(validator({**minimal_config, 'compression_level': 'fast'})), 0)
+
+        # Configuration with valid and invalid S3 multipart upload settings
+        s3_transfer_config = {'s3_multipart_threshold_mb': 16, 's3_multipart_chunksize_mb': 16, 's3_max_concurrency': 1}
+        self.assertEqual(len(validator({**minimal_config, **s3_transfer_config})), 0)
+        self.assertGreater(len(validator({**minimal_config, 's3_multipart_chunksize_mb': 0})), 0)
+        self.assertGreater(len(validator({**minimal_config, 's3_multipart_chunksize_mb': 4})), 0)
+        self.assertGreater(len(validator({**minimal_config, 's3_max_concurrency': '10'})), 0)
+
+        # Archived files can't be purged by the COPY command
+        self.assertEqual(len(validator({**minimal_config, 'purge_load_files': True})), 0)
+        self.assertGreater(len(validator({**minimal_config, 'purge_load_files': True, 'archive_load_files': True})),
+                           0)
+
+        # Configuration with valid and invalid number of archiving threads
+        self.assertEqual(len(validator({**minimal_config, 'archive_load_files_threads': 2})), 0)
+        self.assertGreater(len(validator({**minimal_config, 'archive_load_files_threads': 0})), 0)
+
+        # Configuration with valid and invalid PUT parallelism
+        self.assertEqual(len(validator({**minimal_config, 'put_parallel': 99})), 0)
+        self.assertGreater(len(validator({**minimal_config, 'put_parallel': 100})), 0)
+
     def test_column_type_mapping(self):
         """Test JSON type to Snowflake column type mappings"""
         mapper = db_sync.column_type
@@ -235,6 +265,62 @@ class TestDBSync(unittest.TestCase):
         self.assertEqual(db_sync.DbSync({**minimal_config,
                                          **table_stage_with_parallel}).connection_config['parallelism'], 5)
 
+    @patch('target_snowflake.db_sync.DbSync.query')
+    def test_can_stream_to_stage(self, query_patch):
+        minimal_config = {
+            'account': "dummy-value",
+            'dbname': "dummy-value",
+            'user': "dummy-value",
+            'password': "dummy-value",
+            'warehouse': "dummy-value",
+            'default_target_schema': "dummy-value",
+            'file_format': "dummy-value",
+            's3_bucket': 'dummy-bucket',
+            'stage': 'dummy_schema.dummy_stage',
+            's3_streaming_upload': True
+        }
+
+        # CSV and JSON files can be streamed to external stages, encrypted on the fly
+        for file_format_type in ['CSV', 'JSON']:
+            query_patch.return_value = [{'type': file_format_type}]
+            self.assertTrue(db_sync.DbSync(minimal_config).can_stream_to_stage())
+            self.assertTrue(db_sync.DbSync({**minimal_config,
+                                            'client_side_encryption_master_key': 'key'}).can_stream_to_stage())
+
+        # Parquet files and table stages need local files
+        query_patch.return_value = [{'type': 'PARQUET'}]
+        self.assertFalse(db_sync.DbSync(minimal_config).can_stream_to_stage())
+
+        query_patch.return_value = [{'type': 'CSV'}]
+        self.assertFalse(db_sync.DbSync({**minimal_config, 's3_streaming_upload': False}).can_stream_to_stage())
+
+        table_stage_config = {**minimal_config}
+        table_stage_config.pop('s3_bucket')
+        table_stage_config.pop('stage')
+        self.assertFalse(db_sync.DbSync(table_stage_config).can_stream_to_stage())
+
+    @patch('target_snowflake.db_sync.DbSync.query')
+    def test_upload_client_shared_by_streams(self, query_patch):
+        query_patch.return_value = [{'type': 'CSV'}]
+        minimal_config = {
+            'account': "dummy-value",
+            'dbname': "dummy-value",
+            'user': "dummy-value",
+            'password': "dummy-value",
+            'warehouse': "dummy-value",
+            'default_target_schema': "dummy-value",
+            'file_format': "dummy-value",
+            's3_bucket': 'dummy-bucket',
+            'stage': 'dummy_schema.dummy_stage'
+        }
+        stream_schema_message = {'stream': 'public-foo', 'schema': {'properties': {}}, 'key_properties': []}
+
+        # S3 upload clients are reused by the same S3 config, even if other config keys differ
+        upload_client = db_sync.DbSync(minimal_config).upload_client
+        self.assertIs(db_sync.DbSync(minimal_config, stream_schema_message).upload_client, upload_client)
+        self.assertIs(db_sync.DbSync({**minimal_config, 'batch_size_rows': 10}).upload_client, upload_client)
+        self.assertIsNot(db_sync.DbSync({**minimal_config, 's3_key_prefix': 'foo/'}).upload_client, upload_client)
+
     @patch('target_snowflake.upload_clients.s3_upload_client.S3UploadClient.copy_object')
     @patch('target_snowflake.db_sync.DbSync.query')
     def test_copy_to_archive(self, query_patch, copy_object_patch):
@@ -335,6 +421,10 @@ class TestDBSync(unittest.TestCase):
         dbsync = db_sync.DbSync(minimal_config, stream_schema_message)
         self.assertEqual(dbsync.record_primary_key_string({'id': 1, 'c_bool': False, 'c_str': 'xyz'}), '1,False')
 
+        # PK of an already flattened record
+        flatten_record = dbsync.flattener.flatten({'id': 1, 'c_bool': True, 'c_str': 'xyz'})
+        self.assertEqual(dbsync.primary_key_string(flatten_record), '1,True')
+
     @patch('target_snowflake.db_sync.DbSync.query')
     @patch('target_snowflake.db_sync.DbSync._load_file_merge')
     def test_merge_failure_message(self, load_file_merge_patch, query_patch):
@@ -709,3 +799,33 @@ class TestDBSync(unittest.TestCase):
             with pytest.raises(SystemExit, match='1'):
                 DbSync_obj.validate_stage_bucket(s3_bucket=dummy_s3_bucket, stage=dummy_stage)
             self.assertIn(expected_msg, captured_logs.output)
+
+    @patch('target_snowflake.db_sync.DbSync.query')
+    def test_compression_not_supported_by_the_file_format(self, query_patch):
+        """Parquet only codecs are rejected once the file format is detected"""
+        query_patch.return_value = [{'type': 'CSV'}]
+        minimal_config = {
+            'account': "dummy-value",
+            'dbname': "dummy-value",
+            'user': "dummy-value",
+            'password': "dummy-value",
+            'warehouse': "dummy-value",
+            'default_target_schema': "dummy-target-schema",
+            'file_format': "dummy-value",
+        }
+
+        db_sync.DbSync({**minimal_config, 'compression': 'zstd'})
+        with self.assertLogs(logger='target_snowflake', level='ERROR') as captured_logs:
+            with pytest.raises(SystemExit, match='1'):
+                db_sync.DbSync({**minimal_config, 'compression': 'snappy'})
+        self.assertIn("Not supported compression for CSV files: 'snappy'", captured_logs.output[0])
+
+    @patch('target_snowflake.db_sync.load_pem_private_key')
+    def test_load_private_key_is_cached(self, load_pem_private_key_patch):
+        """Private key is read and serialized only once per key file"""
+        load_pem_private_key_patch.return_value.private_bytes.return_value = b'dummy-der-key'
+        with tempfile.NamedTemporaryFile() as key_file:
+            for _ in range(3):
+                self.assertEqual(db_sync.load_private_key(key_file.name, None, db_sync.Encoding.DER), b'dummy-der-key')
+
+        load_pem_private_key_patch.assert_called_once()
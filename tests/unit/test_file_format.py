@@ -3,7 +3,7 @@ from unittest.mock import patch
 
 from target_snowflake.exceptions import InvalidFileFormatException, FileFormatNotFoundException
 from target_snowflake.file_format import FileFormat, FileFormatTypes
-from target_snowflake.file_formats import csv, parquet
+from target_snowflake.file_formats import csv, jsonl, parquet
 
 
 class TestFileFormat(unittest.TestCase):
@@ -14,6 +14,7 @@ class TestFileFormat(unittest.TestCase):
     def test_get_formatter(self):
         self.assertEqual(FileFormat._get_formatter(FileFormatTypes.CSV), csv)
         self.assertEqual(FileFormat._get_formatter(FileFormatTypes.PARQUET), parquet)
+        self.assertEqual(FileFormat._get_formatter(FileFormatTypes.JSON), jsonl)
         with self.assertRaises(InvalidFileFormatException):
             FileFormat._get_formatter('UNKNOWN')
 
@@ -33,7 +34,7 @@ class TestFileFormat(unittest.TestCase):
         }
 
         # List method should return values as list
-        self.assertEqual(FileFormatTypes.list(), ['csv', 'parquet'])
+        self.assertEqual(FileFormatTypes.list(), ['csv', 'parquet', 'json'])
 
         # CSV should be supported
         query_patch.return_value = [{ 'type': 'CSV' }]
@@ -55,6 +56,16 @@ class TestFileFormat(unittest.TestCase):
         self.assertEqual(file_format.formatter.create_merge_sql.__module__, parquet.create_merge_sql.__module__)
         self.assertEqual(file_format.formatter.create_copy_sql.__module__, parquet.create_copy_sql.__module__)
 
+        # JSON should be supported
+        query_patch.return_value = [{ 'type': 'JSON' }]
+        file_format = FileFormat('foo', query_patch)
+        self.assertEqual(file_format.file_format_type, FileFormatTypes.JSON)
+
+        # File format functions should be mapped to jsonl module
+        self.assertEqual(file_format.formatter.records_to_file.__module__, jsonl.records_to_file.__module__)
+        self.assertEqual(file_format.formatter.create_merge_sql.__module__, jsonl.create_merge_sql.__module__)
+        self.assertEqual(file_format.formatter.create_copy_sql.__module__, jsonl.create_copy_sql.__module__)
+
         # Empty result should raise exception
         query_patch.return_value = []
         with self.assertRaises(FileFormatNotFoundException):
@@ -1,5 +1,7 @@
 import unittest
 
+from unittest.mock import patch
+
 import target_snowflake.flattening as flattening
 
 
@@ -212,3 +214,62 @@ class TestFlattening(unittest.TestCase):
         for idx, (should_use_flatten_schema, record, expected_output) in enumerate(test_cases):
             output = flatten_record(record, flatten_schema if should_use_flatten_schema else None)
             self.assertEqual(output, expected_output, f"Test {idx} failed. Testcase: {test_cases[idx]}")
+
+    def test_record_flattener(self):
+        """Compiled flattener should produce the same records as flatten_record"""
+        long_key = 'a_very_long_property_name_' * 10
+        records = [
+            {},
+            {"c_pk": 1, "c_varchar": "1", "c_int": 1},
+            {
+                "c_pk": 1,
+                "c_obj": {
+                    "nested_prop1": "value_1",
+                    "nested_prop2": [1, 2],
+                    "nested_prop3": {
+                        "multi_nested_prop1": "multi_value_1",
+                        long_key: "multi_value_2",
+                    }}},
+            {"c_pk": 2, "c_obj": "not an object in this record", long_key: None},
+        ]
+        flatten_schema = {"c_pk": {"type": ["object", "array", "null"]}}
+
+        for max_level in [0, 1, 10]:
+            for schema in [None, flatten_schema]:
+                flattener = flattening.RecordFlattener(schema, max_level=max_level)
+                for record in records:
+                    # Flatten twice to use the cached column names as well
+                    for _ in range(2):
+                        self.assertEqual(flattener.flatten(record),
+                                         flattening.flatten_record(record, schema, max_level=max_level))
+
+    def test_record_flattener_caches_only_schema_columns(self):
+        """Keys missing from the flatten schema should not grow the cache of column names"""
+        flatten_schema = {"c_pk": {"type": ["integer"]}, "c_obj__nested_prop1": {"type": ["null", "string"]}}
+        flattener = flattening.RecordFlattener(flatten_schema, max_level=1)
+
+        for i in range(100):
+            record = {"c_pk": i, f"key_{i}": i, "c_obj": {"nested_prop1": "1", f"key_{i}": i}}
+            self.assertEqual(flattener.flatten(record),
+                             {"c_pk": i, f"key_{i}": i, "c_obj__nested_prop1": "1", f"c_obj__key_{i}": i})
+
+        self.assertEqual(flattener._cached_count, 2)
+
+    def test_record_flattener_without_schema_caches_limited_column_names(self):
+        flattener = flattening.RecordFlattener()
+
+        with patch('target_snowflake.flattening.MAX_CACHED_COLUMN_NAMES', 10):
+            for i in range(100):
+                self.assertEqual(flattener.flatten({f"key_{i}": i}), {f"key_{i}": i})
+
+        self.assertEqual(flattener._cached_count, 10)
+
+    def test_record_flattener_without_json_dumps(self):
+        """Not flattened objects and arrays should be kept as python objects if dump_json is False"""
+        record = {"c_pk": 1, "c_obj": {"nested_prop1": "value_1", "nested_prop2": [1, 2]}, "c_arr": [{"a": 1}]}
+        flatten_schema = {"c_arr": {"type": ["object", "array", "null"]}}
+
+        self.assertEqual(flattening.RecordFlattener(flatten_schema, dump_json=False).flatten(record), record)
+        self.assertEqual(flattening.RecordFlattener(flatten_schema, max_level=1, dump_json=False).flatten(record),
+                         {"c_pk": 1, "c_obj__nested_prop1": "value_1", "c_obj__nested_prop2": [1, 2],
+                          "c_arr": [{"a": 1}]})
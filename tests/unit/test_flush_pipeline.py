@@ -0,0 +1,99 @@
+import threading
+import unittest
+
+from target_snowflake.flush_pipeline import FlushPipeline
+
+
+class TestFlushPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.emitted_states = []
+        self.pipeline = FlushPipeline(4, self.emitted_states.append)
+
+    def tearDown(self):
+        self.pipeline.shutdown()
+
+    def test_batches_of_the_same_stream_are_loaded_in_order(self):
+        loaded = []
+        first_batch_can_finish = threading.Event()
+
+        def load(batch):
+            if batch == 1:
+                first_batch_can_finish.wait(5)
+            loaded.append(batch)
+
+        self.pipeline.submit('stream_1', load, {'batch': 1})
+        self.pipeline.submit('stream_1', load, {'batch': 2})
+        first_batch_can_finish.set()
+        self.pipeline.wait_for_stream('stream_1')
+
+        self.assertListEqual(loaded, [1, 2])
+
+    def test_state_is_emitted_after_the_batches_are_loaded(self):
+        batch_can_finish = threading.Event()
+        self.pipeline = FlushPipeline(4, self.emitted_states.append, max_pending_flushes=2)
+
+        future = self.pipeline.submit('stream_1', lambda: batch_can_finish.wait(5))
+        self.pipeline.checkpoint([future], {'bookmarks': {'stream_1': 1}})
+        self.assertListEqual(self.emitted_states, [])
+
+        batch_can_finish.set()
+        self.pipeline.wait_all()
+        self.assertListEqual(self.emitted_states, [{'bookmarks': {'stream_1': 1}}])
+
+    def test_states_are_emitted_in_checkpoint_order(self):
+        slow_batch_can_finish = threading.Event()
+        self.pipeline = FlushPipeline(4, self.emitted_states.append, max_pending_flushes=3)
+
+        slow = self.pipeline.submit('stream_1', lambda: slow_batch_can_finish.wait(5))
+        self.pipeline.checkpoint([slow], {'id': 1})
+        fast = self.pipeline.submit('stream_2', lambda: None)
+        fast.result()
+        self.pipeline.checkpoint([fast], {'id': 2})
+
+        # Second flush is done but its state cannot be emitted before the first one
+        self.assertListEqual(self.emitted_states, [])
+
+        slow_batch_can_finish.set()
+        self.pipeline.wait_all()
+        self.assertListEqual(self.emitted_states, [{'id': 1}, {'id': 2}])
+
+    def test_checkpoint_blocks_when_too_many_flushes_pending(self):
+        self.pipeline = FlushPipeline(4, self.emitted_states.append, max_pending_flushes=1)
+
+        first = self.pipeline.submit('stream_1', lambda: None)
+        self.pipeline.checkpoint([first], {'id': 1})
+        second = self.pipeline.submit('stream_1', lambda: None)
+        self.pipeline.checkpoint([second], {'id': 2})
+
+        # The first checkpoint had to complete before registering the second one
+        self.assertEqual(self.emitted_states[0], {'id': 1})
+
+    def test_state_is_copied_at_checkpoint(self):
+        batch_can_finish = threading.Event()
+        self.pipeline = FlushPipeline(4, self.emitted_states.append, max_pending_flushes=2)
+        state = {'bookmarks': {'stream_1': 1}}
+
+        future = self.pipeline.submit('stream_1', lambda: batch_can_finish.wait(5))
+        self.pipeline.checkpoint([future], state)
+        state['bookmarks']['stream_1'] = 2
+
+        batch_can_finish.set()
+        self.pipeline.wait_all()
+        self.assertListEqual(self.emitted_states, [{'bookmarks': {'stream_1': 1}}])
+
+    def test_failed_flush_is_raised_and_state_is_not_emitted(self):
+        def load():
+            raise ValueError('COPY failed')
+
+        future = self.pipeline.submit('stream_1', load)
+
+        with self.assertRaises(ValueError):
+            self.pipeline.checkpoint([future], {'id': 1})
+            self.pipeline.wait_all()
+
+        self.assertListEqual(self.emitted_states, [])
+
+        # Later batches of the failed stream fail too
+        with self.assertRaises(ValueError):
+            self.pipeline.submit('stream_1', lambda: None).result()
@@ -0,0 +1,278 @@
+import base64
+import io
+import os
+import tempfile
+import unittest
+
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+import boto3
+
+from moto import mock_s3
+from snowflake.connector.encryption_util import EncryptionMetadata, SnowflakeEncryptionUtil
+from snowflake.connector.storage_client import SnowflakeFileEncryptionMaterial
+
+from target_snowflake.upload_clients.encryption import EncryptingReader, StreamEncryptor
+from target_snowflake.upload_clients.s3_upload_client import S3MultipartWriter, S3UploadClient, \
+    S3UploadClientRegistry
+
+MASTER_KEY = base64.b64encode(b'0123456789abcdef0123456789abcdef').decode('utf-8')
+
+
+def decrypt(encrypted: bytes, metadata: dict) -> bytes:
+    """Decrypt by the snowflake connector with the key and iv of the S3 object metadata"""
+    encryption_material = SnowflakeFileEncryptionMaterial(query_stage_master_key=MASTER_KEY, query_id='', smk_id=0)
+    encryption_metadata = EncryptionMetadata(key=metadata['x-amz-key'], iv=metadata['x-amz-iv'], matdesc='')
+    out = io.BytesIO()
+    SnowflakeEncryptionUtil.decrypt_stream(encryption_metadata, encryption_material, io.BytesIO(encrypted), out)
+    return out.getvalue()
+
+
+@mock_s3
+class TestS3UploadClient(unittest.TestCase):
+    """
+    Unit Tests
+    """
+
+    def setUp(self):
+        self.config = {
+            's3_bucket': 'dummy-bucket',
+            's3_region_name': 'us-east-1',
+            'aws_access_key_id': 'dummy-key',
+            'aws_secret_access_key': 'dummy-secret',
+        }
+        boto3.client('s3', region_name='us-east-1').create_bucket(Bucket='dummy-bucket')
+
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            f.write(os.urandom(6 * 1024 * 1024))
+            self.file = f.name
+
+    def tearDown(self):
+        os.remove(self.file)
+
+    def test_default_transfer_config(self):
+        transfer_config = S3UploadClient(self.config).transfer_config
+
+        self.assertEqual(transfer_config.multipart_threshold, 8 * 1024 * 1024)
+        self.assertEqual(transfer_config.multipart_chunksize, 8 * 1024 * 1024)
+        self.assertEqual(transfer_config.max_concurrency, 10)
+        self.assertTrue(transfer_config.use_threads)
+
+    def test_upload_file_with_multipart_upload(self):
+        upload_client = S3UploadClient({**self.config,
+                                        's3_multipart_threshold_mb': 5,
+                                        's3_multipart_chunksize_mb': 5,
+                                        's3_max_concurrency': 4})
+        self.assertEqual(upload_client.transfer_config.max_concurrency, 4)
+
+        with self.assertLogs('target_snowflake', level='INFO') as logs:
+            s3_key = upload_client.upload_file(self.file, 'dummy_stream', timestamp='20210101-000000-000000')
+
+        self.assertEqual(s3_key, f'pipelinewise_dummy_stream_20210101-000000-000000_{os.path.basename(self.file)}')
+        self.assertTrue(any(f'Uploaded {s3_key} to S3: {6 * 1024 * 1024} bytes' in line for line in logs.output))
+
+        # Files above the threshold are uploaded in parts of multipart_chunksize
+        s3_object = upload_client.s3_client.head_object(Bucket='dummy-bucket', Key=s3_key, PartNumber=1)
+        self.assertEqual(s3_object['PartsCount'], 2)
+        self.assertEqual(s3_object['ContentLength'], 5 * 1024 * 1024)
+
+    def test_upload_file_without_threads(self):
+        upload_client = S3UploadClient({**self.config, 's3_max_concurrency': 1})
+        self.assertFalse(upload_client.transfer_config.use_threads)
+
+        with patch.object(upload_client.s3_client, 'upload_file',
+                          wraps=upload_client.s3_client.upload_file) as upload_file_mock:
+            s3_key = upload_client.upload_file(self.file, 'dummy_stream')
+
+        self.assertIs(upload_file_mock.call_args[1]['Config'], upload_client.transfer_config)
+        self.assertEqual(upload_client.s3_client.head_object(Bucket='dummy-bucket', Key=s3_key)['ContentLength'],
+                         6 * 1024 * 1024)
+
+    def test_multipart_writer_uploads_parts_while_writing(self):
+        upload_client = S3UploadClient(self.config)
+        with open(self.file, 'rb') as f:
+            data = f.read() * 2
+
+        with patch.object(upload_client.s3_client, 'upload_part',
+                          wraps=upload_client.s3_client.upload_part) as upload_part_mock:
+            with S3MultipartWriter(upload_client.s3_client, 'dummy-bucket', 'multipart',
+                                   part_size=5 * 1024 * 1024, max_concurrency=2) as writer:
+                for start in range(0, len(data), 1024 * 1024):
+                    writer.write(data[start:start + 1024 * 1024])
+                # Full parts are uploaded before closing the writer
+                self.assertEqual(upload_part_mock.call_count, 2)
+                self.assertEqual(writer.tell(), len(data))
+
+        self.assertEqual(upload_part_mock.call_count, 3)
+        self.assertEqual(upload_client.s3_client.get_object(Bucket='dummy-bucket', Key='multipart')['Body'].read(),
+                         data)
+
+    def test_multipart_writer_uploads_small_files_in_one_request(self):
+        upload_client = S3UploadClient(self.config)
+
+        with patch.object(upload_client.s3_client, 'create_multipart_upload') as create_multipart_upload_mock:
+            with S3MultipartWriter(upload_client.s3_client, 'dummy-bucket', 'small') as writer:
+                writer.write(b'small file')
+
+        create_multipart_upload_mock.assert_not_called()
+        self.assertEqual(upload_client.s3_client.get_object(Bucket='dummy-bucket', Key='small')['Body'].read(),
+                         b'small file')
+
+    def test_multipart_writer_parts_are_at_least_5_mb(self):
+        upload_client = S3UploadClient(self.config)
+
+        writer = S3MultipartWriter(upload_client.s3_client, 'dummy-bucket', 'min_part_size', part_size=1024 * 1024)
+        self.assertEqual(writer.part_size, 5 * 1024 * 1024)
+
+    def test_multipart_writer_aborts_upload_on_error(self):
+        upload_client = S3UploadClient(self.config)
+
+        with self.assertRaises(ValueError):
+            with S3MultipartWriter(upload_client.s3_client, 'dummy-bucket', 'aborted',
+                                   part_size=5 * 1024 * 1024) as writer:
+                writer.write(os.urandom(6 * 1024 * 1024))
+                raise ValueError('Failed to write the file')
+
+        self.assertNotIn('Uploads', upload_client.s3_client.list_multipart_uploads(Bucket='dummy-bucket'))
+        self.assertNotIn('Contents', upload_client.s3_client.list_objects_v2(Bucket='dummy-bucket'))
+
+    def test_multipart_writer_aborts_upload_on_failed_part(self):
+        upload_client = S3UploadClient(self.config)
+
+        with patch.object(upload_client.s3_client, 'abort_multipart_upload',
+                          wraps=upload_client.s3_client.abort_multipart_upload) as abort_mock, \
+                patch.object(upload_client.s3_client, 'upload_part', side_effect=ConnectionError('Part failed')):
+            with self.assertRaises(ConnectionError):
+                with S3MultipartWriter(upload_client.s3_client, 'dummy-bucket', 'failed_part',
+                                       part_size=5 * 1024 * 1024) as writer:
+                    writer.write(os.urandom(6 * 1024 * 1024))
+
+        abort_mock.assert_called_once()
+        self.assertTrue(writer.closed)
+        self.assertNotIn('Uploads', upload_client.s3_client.list_multipart_uploads(Bucket='dummy-bucket'))
+
+    def test_multipart_writer_aborts_upload_on_failed_complete(self):
+        upload_client = S3UploadClient(self.config)
+
+        with patch.object(upload_client.s3_client, 'complete_multipart_upload',
+                          side_effect=ConnectionError('Complete failed')):
+            with self.assertRaises(ConnectionError):
+                with S3MultipartWriter(upload_client.s3_client, 'dummy-bucket', 'failed_complete',
+                                       part_size=5 * 1024 * 1024) as writer:
+                    writer.write(os.urandom(6 * 1024 * 1024))
+
+        self.assertNotIn('Uploads', upload_client.s3_client.list_multipart_uploads(Bucket='dummy-bucket'))
+        self.assertNotIn('Contents', upload_client.s3_client.list_objects_v2(Bucket='dummy-bucket'))
+
+    def test_streaming_files_share_timestamp_and_base_name(self):
+        upload_client = S3UploadClient({**self.config, 's3_key_prefix': 'prefix/'})
+        streaming_files = upload_client.open_streaming_files('dummy_stream')
+
+        for part in range(2):
+            s3_key, writer = streaming_files(f'_{part:04d}.csv')
+            with writer:
+                writer.write(b'part')
+
+        self.assertListEqual(streaming_files.s3_keys, [
+            f'prefix/pipelinewise_dummy_stream_{streaming_files.timestamp}_{streaming_files.base_name}_0000.csv',
+            f'prefix/pipelinewise_dummy_stream_{streaming_files.timestamp}_{streaming_files.base_name}_0001.csv',
+        ])
+        self.assertEqual(streaming_files.size_bytes, 8)
+
+    def test_encrypting_reader_round_trip(self):
+        # Padding adds a full block to data aligned to the block size
+        for data in [b'', b'x' * 16, os.urandom(100 * 1024 + 5)]:
+            encryptor = StreamEncryptor(MASTER_KEY)
+            reader = EncryptingReader(io.BytesIO(data), encryptor)
+
+            encrypted = b''
+            chunk = reader.read(1000)
+            while chunk:
+                encrypted += chunk
+                chunk = reader.read(1000)
+
+            self.assertEqual(len(encrypted), (len(data) // 16 + 1) * 16)
+            self.assertEqual(decrypt(encrypted, encryptor.metadata), data)
+
+    def test_upload_file_with_client_side_encryption(self):
+        upload_client = S3UploadClient({**self.config,
+                                        'client_side_encryption_master_key': MASTER_KEY,
+                                        's3_multipart_threshold_mb': 5,
+                                        's3_multipart_chunksize_mb': 5})
+
+        # The file is encrypted while uploading, without writing an encrypted temp file
+        with tempfile.TemporaryDirectory() as temp_dir:
+            s3_key = upload_client.upload_file(self.file, 'dummy_stream', temp_dir=temp_dir)
+            self.assertListEqual(os.listdir(temp_dir), [])
+
+        s3_object = upload_client.s3_client.get_object(Bucket='dummy-bucket', Key=s3_key)
+        with open(self.file, 'rb') as f:
+            self.assertEqual(decrypt(s3_object['Body'].read(), s3_object['Metadata']), f.read())
+
+    def test_streaming_files_with_client_side_encryption(self):
+        upload_client = S3UploadClient({**self.config, 'client_side_encryption_master_key': MASTER_KEY})
+        streaming_files = upload_client.open_streaming_files('dummy_stream')
+        data = os.urandom(6 * 1024 * 1024)
+
+        s3_key, writer = streaming_files('.csv')
+        with writer:
+            for start in range(0, len(data), 1000 * 1000):
+                writer.write(data[start:start + 1000 * 1000])
+
+        s3_object = upload_client.s3_client.get_object(Bucket='dummy-bucket', Key=s3_key)
+        self.assertEqual(decrypt(s3_object['Body'].read(), s3_object['Metadata']), data)
+        self.assertEqual(streaming_files.size_bytes, s3_object['ContentLength'])
+
+    def test_registry_creates_one_upload_client_per_s3_config(self):
+        registry = S3UploadClientRegistry()
+
+        with patch.object(S3UploadClient, '_create_s3_client',
+                          wraps=S3UploadClient._create_s3_client, autospec=True) as create_s3_client_mock:
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                upload_clients = list(executor.map(registry.get, [{**self.config, 'batch_size_rows': n}
+                                                                  for n in range(32)]))
+            other_bucket_client = registry.get({**self.config, 's3_bucket': 'other-bucket'})
+            archiving_client = registry.get({**self.config, 'archive_load_files': True})
+
+        self.assertTrue(all(upload_client is upload_clients[0] for upload_client in upload_clients))
+        self.assertIsNot(other_bucket_client, upload_clients[0])
+        self.assertIsNot(archiving_client, upload_clients[0])
+        self.assertEqual(create_s3_client_mock.call_count, 3)
+
+        registry.clear()
+        self.assertIsNot(registry.get(self.config), upload_clients[0])
+
+    def test_delete_objects_in_batches(self):
+        upload_client = S3UploadClient(self.config)
+        keys = [f'batch_{i:04d}.csv' for i in range(1500)]
+        for key in keys:
+            upload_client.s3_client.put_object(Bucket='dummy-bucket', Key=key, Body=b'')
+
+        with patch.object(upload_client.s3_client, 'delete_objects',
+                          wraps=upload_client.s3_client.delete_objects) as delete_objects_mock:
+            upload_client.delete_objects('dummy_stream', keys)
+
+        self.assertListEqual([len(call[1]['Delete']['Objects']) for call in delete_objects_mock.call_args_list],
+                             [1000, 500])
+        self.assertNotIn('Contents', upload_client.s3_client.list_objects_v2(Bucket='dummy-bucket'))
+
+    def test_copy_object_with_uploaded_metadata(self):
+        upload_client = S3UploadClient({**self.config, 'archive_load_files': True,
+                                        'client_side_encryption_master_key': MASTER_KEY})
+        s3_key = upload_client.upload_file(self.file, 'dummy_stream')
+        upload_metadata = upload_client.s3_client.head_object(Bucket='dummy-bucket', Key=s3_key)['Metadata']
+
+        # Metadata of the uploaded file is known without a head_object
+        with patch.object(upload_client.s3_client, 'head_object') as head_object_mock:
+            upload_client.copy_object(f'dummy-bucket/{s3_key}', 'dummy-bucket', 'archive/file', {'tap': 'dummy'})
+        head_object_mock.assert_not_called()
+
+        archive_metadata = upload_client.s3_client.head_object(Bucket='dummy-bucket', Key='archive/file')['Metadata']
+        self.assertDictEqual(archive_metadata, {**upload_metadata, 'tap': 'dummy'})
+
+        # Metadata of other files is read from S3
+        with patch.object(upload_client.s3_client, 'head_object',
+                          wraps=upload_client.s3_client.head_object) as head_object_mock:
+            upload_client.copy_object('dummy-bucket/archive/file', 'dummy-bucket', 'archive/copy', {})
+        head_object_mock.assert_called_once()
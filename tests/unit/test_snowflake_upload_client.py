@@ -0,0 +1,67 @@
+import unittest
+
+from unittest.mock import MagicMock
+
+from target_snowflake.upload_clients.snowflake_upload_client import SnowflakeUploadClient
+
+
+class TestSnowflakeUploadClient(unittest.TestCase):
+    """
+    Unit Tests
+    """
+
+    def setUp(self):
+        self.dblink = MagicMock()
+        self.dblink.get_stage_name.return_value = 'dummy_schema.%dummy_table'
+        self.cursor = self.dblink.open_connection.return_value.__enter__.return_value \
+            .cursor.return_value.__enter__.return_value
+        self.cursor.fetchall.return_value = [{'target': 'batch_x.csv.gz', 'target_size': 1024, 'status': 'UPLOADED'}]
+
+    def test_upload_compressed_file(self):
+        upload_client = SnowflakeUploadClient({'put_parallel': 8}, self.dblink)
+
+        with self.assertLogs('target_snowflake', level='INFO') as logs:
+            key = upload_client.upload_file('/tmp/batch_x.csv.gz', 'dummy_stream')
+
+        self.assertEqual(key, 'batch_x.csv.gz')
+        self.cursor.execute.assert_called_once_with(
+            "PUT 'file:///tmp/batch_x.csv.gz' '@dummy_schema.%dummy_table' "
+            "PARALLEL=8 SOURCE_COMPRESSION=GZIP AUTO_COMPRESS=FALSE")
+        self.assertTrue(any('Uploaded batch_x.csv.gz to internal stage: 1024 bytes' in line for line in logs.output))
+
+    def test_upload_not_compressed_file(self):
+        SnowflakeUploadClient({}, self.dblink).upload_file('/tmp/batch_x.csv', 'dummy_stream')
+
+        self.cursor.execute.assert_called_once_with(
+            "PUT 'file:///tmp/batch_x.csv' '@dummy_schema.%dummy_table' PARALLEL=4")
+
+    def test_upload_files_by_one_wildcard_put(self):
+        files = [f'/tmp/batch_x_{i:04d}.csv.gz' for i in range(12)]
+
+        keys = SnowflakeUploadClient({}, self.dblink).upload_files(files, 'dummy_stream')
+
+        self.assertListEqual(keys, [f'batch_x_{i:04d}.csv.gz' for i in range(12)])
+        self.cursor.execute.assert_called_once_with(
+            "PUT 'file:///tmp/batch_x_00*.csv.gz' '@dummy_schema.%dummy_table' "
+            "PARALLEL=4 SOURCE_COMPRESSION=GZIP AUTO_COMPRESS=FALSE")
+
+    def test_upload_files_logs_the_time_of_the_put_command(self):
+        self.cursor.fetchall.return_value = [
+            {'target': 'batch_x_0000.csv.gz', 'target_size': 1024, 'status': 'UPLOADED'},
+            {'target': 'batch_x_0001.csv.gz', 'target_size': 2048, 'status': 'SKIPPED'}]
+
+        with self.assertLogs('target_snowflake', level='INFO') as logs:
+            SnowflakeUploadClient({}, self.dblink).upload_files(['/tmp/batch_x_0000.csv.gz',
+                                                                 '/tmp/batch_x_0001.csv.gz'], 'dummy_stream')
+
+        self.assertTrue(any('Uploaded batch_x_0001.csv.gz to internal stage: 2048 bytes, status: SKIPPED' in line
+                            for line in logs.output))
+        self.assertEqual(sum('seconds' in line for line in logs.output), 1)
+        self.assertTrue(any('Uploaded 2 files to internal stage: 3072 bytes in' in line for line in logs.output))
+
+    def test_upload_files_in_different_directories(self):
+        keys = SnowflakeUploadClient({}, self.dblink).upload_files(['/tmp/a/batch_0000.csv.gz',
+                                                                    '/tmp/b/batch_0001.csv.gz'], 'dummy_stream')
+
+        self.assertListEqual(keys, ['batch_0000.csv.gz', 'batch_0001.csv.gz'])
+        self.assertEqual(self.cursor.execute.call_count, 2)
@@ -0,0 +1,85 @@
+import re
+import unittest
+
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock
+
+from target_snowflake.stage_cleanup import StageCleanup
+from target_snowflake.upload_clients.snowflake_upload_client import SnowflakeUploadClient
+
+
+class TestStageCleanup(unittest.TestCase):
+
+    def setUp(self):
+        self.upload_client = MagicMock()
+        self.stage_cleanup = StageCleanup(batch_size=3)
+
+    def _deleted_batches(self):
+        return [(call[0][0], call[0][1]) for call in self.upload_client.delete_objects.call_args_list]
+
+    def test_delete_full_batches_right_away(self):
+        self.stage_cleanup.add(self.upload_client, 'stream', ['key_1', 'key_2'])
+        self.upload_client.delete_objects.assert_not_called()
+
+        self.stage_cleanup.add(self.upload_client, 'stream', ['key_3', 'key_4'])
+        self.assertListEqual(self._deleted_batches(), [('stream', ['key_1', 'key_2', 'key_3'])])
+
+        self.stage_cleanup.flush()
+        self.assertListEqual(self._deleted_batches(), [('stream', ['key_1', 'key_2', 'key_3']),
+                                                       ('stream', ['key_4'])])
+
+        # Nothing left to delete
+        self.stage_cleanup.flush()
+        self.assertEqual(self.upload_client.delete_objects.call_count, 2)
+
+    def test_keys_grouped_by_stream(self):
+        self.stage_cleanup.add(self.upload_client, 'stream_1', ['key_1', 'key_2'])
+        self.stage_cleanup.add(self.upload_client, 'stream_2', ['key_3'])
+        self.upload_client.delete_objects.assert_not_called()
+
+        self.stage_cleanup.flush()
+        self.assertListEqual(self._deleted_batches(), [('stream_1', ['key_1', 'key_2']),
+                                                       ('stream_2', ['key_3'])])
+
+    def test_add_from_multiple_threads(self):
+        stage_cleanup = StageCleanup(batch_size=10)
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(lambda i: stage_cleanup.add(self.upload_client, 'stream', [f'key_{i}']), range(95)))
+        stage_cleanup.flush()
+
+        deleted_keys = [key for _, keys in self._deleted_batches() for key in keys]
+        self.assertListEqual(sorted(deleted_keys), sorted(f'key_{i}' for i in range(95)))
+        self.assertEqual(self.upload_client.delete_objects.call_count, 10)
+
+    def test_table_stage_files_removed_by_one_command(self):
+        dblink = MagicMock()
+        dblink.get_stage_name.return_value = 'dummy_schema.%dummy_table'
+        cursor = dblink.open_connection.return_value.__enter__.return_value.cursor.return_value
+
+        SnowflakeUploadClient({}, dblink).delete_objects('stream', ['batch_a1.csv.gz', 'batch_b2_0000.csv.gz'])
+
+        cursor.execute.assert_called_once_with(
+            "REMOVE '@dummy_schema.%dummy_table' "
+            "PATTERN='(.*/)?(batch_a1[.]csv[.]gz|batch_b2_0000[.]csv[.]gz).*'")
+
+    def test_remove_pattern_matches_listed_paths(self):
+        dblink = MagicMock()
+        dblink.get_stage_name.return_value = 'dummy_schema.dummy_stage'
+        cursor = dblink.open_connection.return_value.__enter__.return_value.cursor.return_value
+
+        SnowflakeUploadClient({}, dblink).delete_objects('stream', ['folder/batch_a1.csv', 'batch_b2 (1).csv'])
+        pattern = re.search(r"PATTERN='(.*)'$", cursor.execute.call_args[0][0]).group(1)
+
+        # LIST output of the stage, PATTERN needs to match the whole path
+        matched = [path for path in ['dummy_stage/folder/batch_a1.csv.gz',
+                                     'folder/batch_a1.csv.gz',
+                                     'dummy_stage/batch_b2 (1).csv.gz',
+                                     'batch_b2 (1).csv',
+                                     'dummy_stage/folder/batch_a12.csv.gz',
+                                     'dummy_stage/other_folder/batch_a1.csv.gz',
+                                     'dummy_stage/xbatch_b2 (1).csv.gz']
+                   if re.fullmatch(pattern, path)]
+        self.assertListEqual(matched, ['dummy_stage/folder/batch_a1.csv.gz',
+                                       'folder/batch_a1.csv.gz',
+                                       'dummy_stage/batch_b2 (1).csv.gz',
+                                       'batch_b2 (1).csv'])
@@ -116,6 +116,138 @@ class TestSchemaUtils(unittest.TestCase):
         with self.assertRaises(UnexpectedValueTypeException):
             stream_utils.adjust_timestamps_in_record(record, schema)
 
+    def test_get_datetime_fields(self):
+        """Test finding the date, date-time and time properties of a schema"""
+        schema = {
+            'properties': {
+                'c_str': {'type': ['null', 'string']},
+                'c_int': {'type': ['null', 'integer'], 'format': 'date'},
+                'c_date': {'type': ['null', 'string'], 'format': 'date'},
+                'c_datetime': {'type': 'string', 'format': 'date-time'},
+                'c_time': {
+                    'anyOf': [
+                        {'type': ['null', 'string'], 'format': 'time'},
+                        {'type': ['null', 'string']}
+                    ]
+                },
+                'c_no_type': {'format': 'date-time'},
+            }
+        }
+
+        self.assertDictEqual(stream_utils.get_datetime_fields(schema), {
+            'c_date': 'date',
+            'c_datetime': 'date-time',
+            'c_time': 'time',
+        })
+
+    def test_adjust_timestamps_in_record_with_precomputed_datetime_fields(self):
+        """Test that only the precomputed fields are checked and non ISO-8601 values fall back to dateutil"""
+        schema = {
+            'properties': {
+                'key1': {'type': ['null', 'string'], 'format': 'date-time'},
+                'key2': {'type': ['null', 'string'], 'format': 'date-time'},
+                'key3': {'type': ['null', 'string'], 'format': 'date-time'},
+                'key4': {'type': ['null', 'string'], 'format': 'date'},
+                'key5': {'type': ['null', 'string'], 'format': 'time'},
+                'key6': {'type': ['null', 'string'], 'format': 'date-time'},
+            }
+        }
+        datetime_fields = stream_utils.get_datetime_fields(schema)
+
+        record = {
+            'key1': '2021-03-04T05:06:07.123456+01:00',
+            'key2': 'March 4 2021 5:06 PM',
+            'key3': '2021-02-30T00:00:00Z',
+            'key4': '2021-03-04',
+            'key5': '12:30:00.5',
+        }
+        stream_utils.adjust_timestamps_in_record(record, schema, datetime_fields)
+
+        self.assertEqual(record, {
+            'key1': '2021-03-04T05:06:07.123456+01:00',
+            'key2': 'March 4 2021 5:06 PM',
+            'key3': '9999-12-31 23:59:59.999999',
+            'key4': '2021-03-04',
+            'key5': '12:30:00.5',
+        })
+
+        # Fields not in the precomputed index are left untouched
+        record = {'key3': 'not a date'}
+        stream_utils.adjust_timestamps_in_record(record, schema, {})
+        self.assertEqual(record, {'key3': 'not a date'})
+
+    def test_get_decimal_paths(self):
+        """Test finding the values that need Decimal semantics"""
+        # No multipleOf, nothing to convert
+        self.assertIsNone(stream_utils.get_decimal_paths({
+            'properties': {
+                'c_int': {'type': ['null', 'integer'], 'minimum': -2147483648, 'maximum': 2147483647},
+                'c_number': {'type': ['null', 'number']},
+                'c_array': {'type': ['null', 'array'], 'items': {'$ref': '#/definitions/recursive_array'}},
+            },
+            'definitions': {
+                'recursive_array': {'type': ['null', 'number', 'array'],
+                                    'items': {'$ref': '#/definitions/recursive_array'}}
+            }
+        }))
+
+        # Only the properties with multipleOf
+        self.assertEqual(stream_utils.get_decimal_paths({
+            'properties': {
+                'c_int': {'type': ['null', 'integer']},
+                'c_decimal': {'type': ['null', 'number'], 'multipleOf': Decimal('0.01')},
+                'c_obj': {'properties': {
+                    'c_str': {'type': 'string'},
+                    'c_enum': {'enum': [Decimal('0.5'), Decimal('1.5')]}
+                }},
+                'c_array': {'items': {'properties': {'c_decimal': {'multipleOf': Decimal('0.01')}}}},
+            }
+        }), {
+            'c_decimal': True,
+            'c_obj': {'c_enum': True},
+            'c_array': {stream_utils.DECIMAL_PATH_ITEMS: {'c_decimal': True}},
+        })
+
+        # Whole value of combined or referenced schemas
+        self.assertEqual(stream_utils.get_decimal_paths({
+            'properties': {
+                'c_any': {'anyOf': [{'type': 'null'}, {'multipleOf': Decimal('0.01')}]},
+                'c_ref': {'$ref': '#/definitions/decimal'},
+            },
+            'definitions': {'decimal': {'multipleOf': Decimal('0.01')}}
+        }), {'c_any': True, 'c_ref': True})
+
+    def test_float_to_decimal_paths(self):
+        """Test converting float values to Decimal only on the given paths"""
+        record = {
+            'c_float': 1.5,
+            'c_decimal': 1.123,
+            'c_obj': {'c_float': 1.5, 'c_decimal': 2.234},
+            'c_array': [{'c_float': 1.5, 'c_decimal': 3.345}, 'not an object'],
+        }
+        paths = {
+            'c_decimal': True,
+            'c_obj': {'c_decimal': True},
+            'c_array': {stream_utils.DECIMAL_PATH_ITEMS: {'c_decimal': True}},
+        }
+
+        self.assertEqual(stream_utils.float_to_decimal_paths(record, paths), {
+            'c_float': 1.5,
+            'c_decimal': Decimal('1.123'),
+            'c_obj': {'c_float': 1.5, 'c_decimal': Decimal('2.234')},
+            'c_array': [{'c_float': 1.5, 'c_decimal': Decimal('3.345')}, 'not an object'],
+        })
+
+        # Original record is not modified
+        self.assertEqual(record['c_obj']['c_decimal'], 2.234)
+
+        # Nothing to convert returns the same record
+        self.assertIs(stream_utils.float_to_decimal_paths(record, None), record)
+        self.assertIs(stream_utils.float_to_decimal_paths(record, {'c_missing': True}), record)
+
+        # Convert everything
+        self.assertEqual(stream_utils.float_to_decimal_paths(record, True), stream_utils.float_to_decimal(record))
+
     def test_float_to_decimal(self):
         """Test if float values are converted to singer compatible Decimal types"""
         # Simple numeric value
@@ -5,6 +5,7 @@ import unittest
 import os
 import gzip
 import tempfile
+import threading
 from unittest import mock
 import itertools
 
@@ -12,14 +13,31 @@ from contextlib import redirect_stdout
 from datetime import datetime, timedelta
 from unittest.mock import patch, MagicMock
 
+import boto3
+
+from moto import mock_s3
+
 import target_snowflake
 from target_snowflake import db_sync
+from target_snowflake.stage_cleanup import StageCleanup
+from target_snowflake.archiver import Archiver
+from target_snowflake.upload_clients.s3_upload_client import S3UploadClient
 
 
 def _mock_record_to_csv_line(record):
     return record
 
 
+def _db_sync_mock(flatten_schema=None):
+    """DbSync mock writing CSV files of a stream with an integer id column, staged as prefix/batch_x.csv"""
+    db_sync_mock = MagicMock()
+    db_sync_mock.file_format.formatter = target_snowflake.csv
+    db_sync_mock.flatten_schema = flatten_schema or {'id': {'type': ['integer']}}
+    db_sync_mock.data_flattening_max_level = 0
+    db_sync_mock.put_to_stage.return_value = 'prefix/batch_x.csv'
+    return db_sync_mock
+
+
 class TestTargetSnowflake(unittest.TestCase):
 
     def setUp(self):
@@ -180,6 +198,353 @@ class TestTargetSnowflake(unittest.TestCase):
             '{"bookmarks": {"tap_mysql_test-test_simple_table": {"replication_key": "id", '
             '"replication_key_value": 100, "version": 1}}}')
 
+    @patch('target_snowflake.stream_utils.float_to_decimal', wraps=target_snowflake.stream_utils.float_to_decimal)
+    @patch('target_snowflake.flush_streams')
+    @patch('target_snowflake.DbSync')
+    def test_validate_records_without_multiple_of_skips_decimal_conversion(self, dbSync_mock, flush_streams_mock,
+                                                                           float_to_decimal_mock):
+        self.config['validate_records'] = True
+
+        with open(f'{os.path.dirname(__file__)}/resources/messages-simple-table.json', 'r') as f:
+            lines = f.readlines()
+
+        flush_streams_mock.return_value = '{"currently_syncing": null}'
+
+        # Converting the SCHEMA message only
+        target_snowflake.persist_lines(self.config, lines[:1])
+        schema_call_count = float_to_decimal_mock.call_count
+
+        # Records are validated without converting them
+        float_to_decimal_mock.reset_mock()
+        target_snowflake.persist_lines(self.config, lines)
+        self.assertEqual(float_to_decimal_mock.call_count, schema_call_count)
+
+    @patch('target_snowflake.DbSync')
+    @patch('target_snowflake.os.remove')
+    def test_persist_lines_with_batch_size_bytes(self, os_remove_mock, dbSync_mock):
+        self.config['batch_size_bytes'] = 1
+
+        with open(f'{os.path.dirname(__file__)}/resources/messages-simple-table.json', 'r') as f:
+            lines = f.readlines()
+
+        instance = dbSync_mock.return_value
+        instance.create_schema_if_not_exists.return_value = None
+        instance.sync_table.return_value = None
+        instance.put_to_stage.return_value = 'some-s3-folder/some-name_date_batch_hash.csg.gz'
+        instance.flattener.flatten.side_effect = lambda record: record
+        instance.primary_key_string.side_effect = lambda record: str(record['id'])
+
+        # Every record reaches the byte threshold
+        target_snowflake.persist_lines(self.config, lines)
+        self.assertEqual(instance.load_file.call_count, 5)
+
+        # Per stream threshold overrides the global one, records of two messages fit into a batch
+        instance.load_file.reset_mock()
+        record_line_length = len(lines[3])
+        self.config['stream_batch_size_bytes'] = {'tap_mysql_test-test_simple_table': 2 * record_line_length}
+        target_snowflake.persist_lines(self.config, lines)
+        self.assertEqual(instance.load_file.call_count, 3)
+
+    @patch('target_snowflake.DbSync')
+    @patch('target_snowflake.os.remove')
+    def test_persist_lines_with_max_buffer_memory_flushes_biggest_stream(self, os_remove_mock, dbSync_mock):
+        self.config['max_buffer_memory_mb'] = 1
+
+        schema = {'properties': {'id': {'type': ['integer']}, 'payload': {'type': ['null', 'string']}}}
+        lines = [json.dumps({'type': 'SCHEMA', 'stream': stream, 'schema': schema, 'key_properties': ['id']})
+                 for stream in ['tap-big_table', 'tap-small_table']]
+        for i in range(20):
+            lines.append(json.dumps({'type': 'RECORD', 'stream': 'tap-big_table',
+                                     'record': {'id': i, 'payload': 'x' * 100000}}))
+            lines.append(json.dumps({'type': 'RECORD', 'stream': 'tap-small_table',
+                                     'record': {'id': i, 'payload': 'x'}}))
+
+        instance = dbSync_mock.return_value
+        instance.create_schema_if_not_exists.return_value = None
+        instance.sync_table.return_value = None
+        instance.put_to_stage.return_value = 'some-s3-folder/some-name_date_batch_hash.csg.gz'
+        instance.flattener.flatten.side_effect = lambda record: record
+        instance.primary_key_string.side_effect = lambda record: str(record['id'])
+
+        target_snowflake.persist_lines(self.config, lines)
+
+        flushed_streams = [put_args[0][1] for put_args in instance.put_to_stage.call_args_list]
+        # Only the big stream is flushed when the budget is exceeded, the small one once at the end
+        self.assertGreater(flushed_streams.count('tap-big_table'), 1)
+        self.assertEqual(flushed_streams.count('tap-small_table'), 1)
+        self.assertEqual(flushed_streams[-2:].count('tap-small_table'), 1)
+
+    @patch('target_snowflake.DbSync')
+    @patch('target_snowflake.os.remove')
+    def test_persist_lines_with_pipelined_flush(self, os_remove_mock, dbSync_mock):
+        """
+        Batches loaded in the background should emit the same states as the sequential flushing
+        """
+        self.config['batch_size_rows'] = 2
+
+        with open(f'{os.path.dirname(__file__)}/resources/messages-simple-table.json', 'r') as f:
+            lines = f.readlines()
+
+        instance = dbSync_mock.return_value
+        instance.create_schema_if_not_exists.return_value = None
+        instance.sync_table.return_value = None
+        instance.put_to_stage.return_value = 'some-s3-folder/some-name_date_batch_hash.csg.gz'
+        instance.flattener.flatten.side_effect = lambda record: record
+        instance.primary_key_string.side_effect = lambda record: str(record['id'])
+
+        sequential_buf = io.StringIO()
+        with redirect_stdout(sequential_buf):
+            target_snowflake.persist_lines(self.config, lines)
+        sequential_load_count = instance.load_file.call_count
+
+        instance.load_file.reset_mock()
+        self.config['pipelined_flush'] = True
+        pipelined_buf = io.StringIO()
+        with redirect_stdout(pipelined_buf):
+            target_snowflake.persist_lines(self.config, lines)
+
+        self.assertEqual(sequential_load_count, 3)
+        self.assertEqual(instance.load_file.call_count, sequential_load_count)
+        self.assertEqual(pipelined_buf.getvalue(), sequential_buf.getvalue())
+
+        # The final state is emitted even if the flush pipeline emitted the same state last
+        for last_line in [len(lines) - 1, len(lines) - 2]:
+            buffers = []
+            for pipelined_flush in [False, True]:
+                self.config['pipelined_flush'] = pipelined_flush
+                buffers.append(io.StringIO())
+                with redirect_stdout(buffers[-1]):
+                    target_snowflake.persist_lines(self.config, lines[:last_line])
+
+            self.assertEqual(buffers[1].getvalue(), buffers[0].getvalue())
+
+    @patch('target_snowflake.load_stream_batch')
+    def test_flush_streams_counts_batches_in_flight_against_the_buffer_budget(self, load_stream_batch_mock):
+        """
+        Batches loading in the background should stay in the buffer sizes until they are loaded
+        """
+        loading = threading.Event()
+        loaded = threading.Event()
+
+        def load_stream_batch(**kwargs):
+            loading.set()
+            loaded.wait(10)
+
+        load_stream_batch_mock.side_effect = load_stream_batch
+        buffer_sizes = target_snowflake.BufferSizes()
+        buffer_sizes.add('stream', 1000)
+        flush_pipeline = target_snowflake.FlushPipeline(1, lambda state: None)
+
+        try:
+            target_snowflake.flush_streams(streams={'stream': {'1': {'id': 1}}},
+                                           row_count={'stream': 1},
+                                           stream_to_sync={'stream': MagicMock()},
+                                           config=self.config,
+                                           state=None,
+                                           flushed_state=None,
+                                           archive_load_files_data={},
+                                           flush_pipeline=flush_pipeline,
+                                           buffer_sizes=buffer_sizes)
+
+            self.assertTrue(loading.wait(10))
+            self.assertEqual(buffer_sizes.get('stream'), 0)
+            self.assertEqual(buffer_sizes.total, 1000)
+
+            loaded.set()
+            flush_pipeline.wait_all()
+            self.assertEqual(buffer_sizes.total, 0)
+        finally:
+            loaded.set()
+            flush_pipeline.shutdown()
+
+    @patch('target_snowflake.StageCleanup')
+    @patch('target_snowflake._persist_lines')
+    def test_persist_lines_failing_cleanup_does_not_mask_the_load_error(self, persist_lines_mock, stage_cleanup_mock):
+        self.config['pipelined_flush'] = True
+        self.config['deferred_stage_cleanup'] = True
+        persist_lines_mock.side_effect = ValueError('load failed')
+        stage_cleanup_mock.return_value.flush.side_effect = RuntimeError('cleanup failed')
+
+        with self.assertLogs('target_snowflake', level='ERROR') as logs:
+            with self.assertRaisesRegex(ValueError, 'load failed'):
+                target_snowflake.persist_lines(self.config, [])
+
+        self.assertTrue(any('cleanup failed' in line for line in logs.output))
+
+        # Without an earlier error the cleanup error is raised
+        persist_lines_mock.side_effect = None
+        with self.assertRaisesRegex(RuntimeError, 'cleanup failed'):
+            target_snowflake.persist_lines(self.config, [])
+
+    @patch('target_snowflake.DbSync')
+    def test_persist_lines_with_parquet_streaming_writer(self, dbSync_mock):
+        """
+        Records of append only parquet streams should be written to row groups as they arrive
+        """
+        self.config['parquet_streaming_writer'] = True
+        self.config['parquet_row_group_size'] = 2
+        self.config['primary_key_required'] = False
+        self.config['batch_size_rows'] = 5
+
+        lines = [json.dumps({'type': 'SCHEMA', 'stream': 'tap-append_only', 'key_properties': [],
+                             'schema': {'properties': {'id': {'type': ['integer']}}}})]
+        lines.extend(json.dumps({'type': 'RECORD', 'stream': 'tap-append_only', 'record': {'id': i}})
+                     for i in range(7))
+
+        loaded_ids = []
+        row_groups = []
+
+        def _put_to_stage(filepath, *args, **kwargs):
+            parquet_file = target_snowflake.parquet.pyarrow.parquet.ParquetFile(filepath)
+            loaded_ids.extend(parquet_file.read().to_pydict()['id'])
+            row_groups.append(parquet_file.metadata.num_row_groups)
+            return 'some-s3-folder/some-name_date_batch_hash.parquet'
+
+        instance = dbSync_mock.return_value
+        instance.create_schema_if_not_exists.return_value = None
+        instance.sync_table.return_value = None
+        instance.stream_schema_message = {'key_properties': []}
+        instance.flatten_schema = {'id': {'type': ['integer']}}
+        instance.file_format.file_format_type = target_snowflake.FileFormatTypes.PARQUET
+        instance.file_format.formatter = target_snowflake.parquet
+        instance.flattener.flatten.side_effect = lambda record: record
+        instance.primary_key_string.return_value = None
+        instance.put_to_stage.side_effect = _put_to_stage
+
+        with redirect_stdout(io.StringIO()):
+            target_snowflake.persist_lines(self.config, lines)
+
+        # Every batch is written to a single file with row groups of parquet_row_group_size records
+        self.assertListEqual(row_groups, [3, 1])
+        self.assertEqual(instance.load_file.call_count, 2)
+        self.assertListEqual(loaded_ids, list(range(7)))
+
+    def test_flush_records_with_max_file_size_loads_files_by_common_prefix(self):
+        """
+        A batch split into multiple files should be loaded in one statement and every file cleaned up
+        """
+        db_sync_mock = _db_sync_mock({'id': {'type': ['integer']}, 'value': {'type': ['string']}})
+        db_sync_mock.put_files_to_stage.side_effect = \
+            lambda files, *args, **kwargs: [f'prefix/batch_x_{i:04d}.csv' for i in range(len(files))]
+        records = {str(i): {'id': i, 'value': 'x' * 100} for i in range(1000)}
+
+        with patch('target_snowflake.file_formats.csv.WRITE_CHUNK_ROWS', 100):
+            target_snowflake.flush_records('stream', records, db_sync_mock, compression='none',
+                                           max_file_size=10 * 1024)
+
+        files = db_sync_mock.put_files_to_stage.call_args[0][0]
+        self.assertGreater(len(files), 1)
+        self.assertFalse(any(os.path.exists(file) for file in files))
+        db_sync_mock.put_to_stage.assert_not_called()
+        db_sync_mock.load_file.assert_called_once()
+        self.assertEqual(db_sync_mock.load_file.call_args[0][:2], ('prefix/batch_x_000', 1000))
+        self.assertListEqual([call[0][1] for call in db_sync_mock.delete_from_stage.call_args_list],
+                             [f'prefix/batch_x_{i:04d}.csv' for i in range(len(files))])
+
+    def test_flush_records_with_stage_cleanup_queues_loaded_files(self):
+        """
+        Loaded files should be queued to delete them in batches instead of deleting them one by one
+        """
+        db_sync_mock = _db_sync_mock()
+        stage_cleanup = StageCleanup()
+
+        with patch.object(stage_cleanup, 'add') as add_mock:
+            target_snowflake.flush_records('stream', {'1': {'id': 1}}, db_sync_mock, stage_cleanup=stage_cleanup)
+
+        add_mock.assert_called_once_with(db_sync_mock.upload_client, 'stream', ['prefix/batch_x.csv'])
+        db_sync_mock.delete_from_stage.assert_not_called()
+
+    def test_flush_records_with_purge_load_files(self):
+        """
+        Files removed from the stage by the COPY command should not be deleted again
+        """
+        db_sync_mock = _db_sync_mock()
+        db_sync_mock.load_file.return_value = True
+        target_snowflake.flush_records('stream', {'1': {'id': 1}}, db_sync_mock, purge_load_files=True)
+        self.assertTrue(db_sync_mock.load_file.call_args[1]['purge'])
+        db_sync_mock.delete_from_stage.assert_not_called()
+
+        # MERGE commands don't purge the loaded files
+        db_sync_mock.load_file.return_value = False
+        target_snowflake.flush_records('stream', {'1': {'id': 1}}, db_sync_mock, purge_load_files=True)
+        db_sync_mock.delete_from_stage.assert_called_once_with('stream', 'prefix/batch_x.csv')
+
+    def test_flush_records_archives_in_parallel_with_loading(self):
+        """
+        Load files should be archived in the background while loading them and deleted only after both
+        """
+        db_sync_mock = _db_sync_mock()
+        events = []
+        loading = threading.Event()
+
+        def copy_to_archive(*args):
+            # The copy starts before the load is finished
+            self.assertTrue(loading.wait(5))
+            events.append('archived')
+
+        def load_file(*args, **kwargs):
+            loading.set()
+            events.append('loaded')
+
+        db_sync_mock.copy_to_archive.side_effect = copy_to_archive
+        db_sync_mock.load_file.side_effect = load_file
+        db_sync_mock.delete_from_stage.side_effect = lambda *args: events.append('deleted')
+
+        archiver = Archiver()
+        try:
+            target_snowflake.flush_records('public-foo', {'1': {'id': 1}}, db_sync_mock,
+                                           archive_load_files={'tap': 'tap_id'}, archiver=archiver)
+        finally:
+            archiver.shutdown()
+
+        self.assertListEqual(events, ['loaded', 'archived', 'deleted'])
+        self.assertEqual(db_sync_mock.copy_to_archive.call_args[0][:2],
+                         ('prefix/batch_x.csv', 'tap_id/foo/batch_x.csv'))
+
+    def test_flush_records_keeps_staged_files_if_archiving_fails(self):
+        db_sync_mock = _db_sync_mock()
+        db_sync_mock.copy_to_archive.side_effect = Exception('Failed to copy')
+
+        archiver = Archiver()
+        try:
+            with self.assertRaises(Exception):
+                target_snowflake.flush_records('public-foo', {'1': {'id': 1}}, db_sync_mock,
+                                               archive_load_files={'tap': 'tap_id'}, archiver=archiver)
+        finally:
+            archiver.shutdown()
+
+        db_sync_mock.load_file.assert_called_once()
+        db_sync_mock.delete_from_stage.assert_not_called()
+
+    @mock_s3
+    def test_flush_records_with_streaming_upload_writes_files_to_s3(self):
+        """
+        Load files should be written straight to the external stage without local files
+        """
+        boto3.client('s3', region_name='us-east-1').create_bucket(Bucket='dummy-bucket')
+        upload_client = S3UploadClient({'s3_bucket': 'dummy-bucket', 's3_region_name': 'us-east-1',
+                                        'aws_access_key_id': 'dummy-key', 'aws_secret_access_key': 'dummy-secret'})
+
+        db_sync_mock = _db_sync_mock({'id': {'type': ['integer']}, 'value': {'type': ['string']}})
+        db_sync_mock.can_stream_to_stage.return_value = True
+        db_sync_mock.open_stage_files.side_effect = lambda stream, count: upload_client.open_streaming_files(stream)
+        records = {str(i): {'id': i, 'value': 'x' * 100} for i in range(1000)}
+
+        with patch('target_snowflake.file_formats.csv.WRITE_CHUNK_ROWS', 100):
+            target_snowflake.flush_records('stream', records, db_sync_mock, compression='none',
+                                           max_file_size=10 * 1024, streaming_upload=True)
+
+        db_sync_mock.put_to_stage.assert_not_called()
+        db_sync_mock.put_files_to_stage.assert_not_called()
+        s3_keys = [call[0][1] for call in db_sync_mock.delete_from_stage.call_args_list]
+        self.assertGreater(len(s3_keys), 1)
+        self.assertEqual(db_sync_mock.load_file.call_args[0][:2], (os.path.commonprefix(s3_keys), 1000))
+
+        lines = []
+        for s3_key in s3_keys:
+            body = upload_client.s3_client.get_object(Bucket='dummy-bucket', Key=s3_key)['Body'].read()
+            lines.extend(body.decode('UTF-8').splitlines())
+        self.assertListEqual(lines, [f'{i},"{"x" * 100}"' for i in range(1000)])
 
     @patch('target_snowflake.flush_streams')
     @patch('target_snowflake.DbSync')
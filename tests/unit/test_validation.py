@@ -0,0 +1,184 @@
+import json
+import os
+import unittest
+
+from decimal import Decimal, InvalidOperation
+
+from jsonschema import Draft7Validator, FormatChecker
+from jsonschema.exceptions import ValidationError
+
+from target_snowflake import stream_utils
+from target_snowflake import validation
+
+
+def _draft7_error(schema, instance):
+    try:
+        Draft7Validator(schema, format_checker=FormatChecker()).validate(instance)
+    except ValidationError as exc:
+        return exc.message
+    return None
+
+
+def _compiled_error(schema, instance):
+    try:
+        validation.CompiledValidator(schema).validate(instance)
+    except ValidationError as exc:
+        return exc.message
+    return None
+
+
+class TestValidation(unittest.TestCase):
+
+    def assertSameAsDraft7(self, schema, instances):
+        for instance in instances:
+            self.assertEqual(_compiled_error(schema, instance), _draft7_error(schema, instance),
+                             f'Instance: {instance!r}')
+
+    def test_types(self):
+        schema = {'type': 'object', 'properties': {
+            'c_int': {'type': ['null', 'integer']},
+            'c_number': {'type': ['number']},
+            'c_str': {'type': 'string'},
+            'c_bool': {'type': ['boolean', 'null']},
+            'c_obj': {'type': ['object']},
+            'c_arr': {'type': ['array'], 'items': {'type': ['integer']}},
+        }}
+
+        self.assertSameAsDraft7(schema, [
+            {},
+            {'c_int': 1, 'c_number': 1.5, 'c_str': 'a', 'c_bool': True, 'c_obj': {}, 'c_arr': [1, 2]},
+            {'c_int': 1.0},
+            {'c_int': True},
+            {'c_int': Decimal('1')},
+            {'c_int': '1'},
+            {'c_number': Decimal('1.5')},
+            {'c_number': False},
+            {'c_str': 1},
+            {'c_bool': 0},
+            {'c_obj': []},
+            {'c_arr': [1, 'x']},
+            [],
+        ])
+
+    def test_keywords(self):
+        schema = {
+            'type': 'object',
+            'required': ['id'],
+            'additionalProperties': False,
+            'properties': {
+                'id': {'type': 'integer', 'minimum': 1, 'maximum': 10},
+                'exclusive': {'exclusiveMinimum': 0, 'exclusiveMaximum': 1},
+                'multiple_int': {'multipleOf': 5},
+                'multiple_float': {'multipleOf': 0.5},
+                'multiple_decimal': {'multipleOf': Decimal('0.01')},
+                'length': {'type': 'string', 'minLength': 2, 'maxLength': 3, 'pattern': '^a'},
+                'items': {'minItems': 1, 'maxItems': 2},
+                'enum': {'enum': [1, 'a', None]},
+                'const': {'const': False},
+                'date': {'format': 'date'},
+            }}
+
+        self.assertSameAsDraft7(schema, [
+            {'id': 1},
+            {},
+            {'id': 1, 'unknown': 1},
+            {'id': 0},
+            {'id': 11},
+            {'id': 1, 'exclusive': 0},
+            {'id': 1, 'exclusive': 1},
+            {'id': 1, 'exclusive': 0.5},
+            {'id': 1, 'multiple_int': 10},
+            {'id': 1, 'multiple_int': 11},
+            {'id': 1, 'multiple_float': 1.5},
+            {'id': 1, 'multiple_float': 1.2},
+            {'id': 1, 'multiple_decimal': Decimal('1.23')},
+            {'id': 1, 'multiple_decimal': Decimal('1.234')},
+            {'id': 1, 'length': 'abc'},
+            {'id': 1, 'length': 'a'},
+            {'id': 1, 'length': 'abcd'},
+            {'id': 1, 'length': 'bcd'},
+            {'id': 1, 'items': []},
+            {'id': 1, 'items': [1, 2, 3]},
+            {'id': 1, 'enum': 'a'},
+            {'id': 1, 'enum': True},
+            {'id': 1, 'enum': 'b'},
+            {'id': 1, 'const': 0},
+            {'id': 1, 'const': False},
+            {'id': 1, 'date': '2021-01-01'},
+            {'id': 1, 'date': '2021-13-01'},
+        ])
+
+    def test_combinators_and_refs(self):
+        schema = {
+            'definitions': {
+                'recursive': {'anyOf': [
+                    {'type': ['null', 'integer']},
+                    {'type': 'array', 'items': {'$ref': '#/definitions/recursive'}},
+                ]},
+            },
+            'properties': {
+                'any': {'anyOf': [{'type': 'string', 'format': 'date-time'}, {'type': ['null', 'string']}]},
+                'one': {'oneOf': [{'type': 'integer'}, {'minimum': 5}]},
+                'all': {'allOf': [{'type': 'integer'}, {'minimum': 5}]},
+                'not': {'not': {'type': 'string'}},
+                'nested': {'$ref': '#/definitions/recursive'},
+                'tuple': {'items': [{'type': 'integer'}, {'type': 'string'}]},
+                'additional': {'additionalProperties': {'type': 'integer'}},
+                'never': False,
+            }}
+
+        self.assertSameAsDraft7(schema, [
+            {'any': 'abc', 'one': 1, 'all': 6, 'not': 1, 'nested': [1, [2, None]]},
+            {'any': 1},
+            {'one': 6},
+            {'one': 1.5},
+            {'all': 4},
+            {'not': 'x'},
+            {'nested': [1, ['x']]},
+            {'tuple': [1, 'a', 'anything']},
+            {'tuple': ['a']},
+            {'additional': {'a': 1}},
+            {'additional': {'a': 'x'}},
+            {'never': None},
+        ])
+
+    def test_singer_schema(self):
+        with open(f'{os.path.dirname(__file__)}/resources/messages-simple-table.json', 'r') as f:
+            schema = stream_utils.float_to_decimal(json.loads(f.readline())['schema'])
+
+        self.assertIsInstance(validation.get_validator(schema), validation.CompiledValidator)
+        self.assertSameAsDraft7(schema, [
+            {'id': 1, 'results': 'xyz1', 'time_created': 'not-formatted-time-1'},
+            {'id': 'x'},
+            {'results': 1},
+        ])
+
+    def test_long_precision_multiple_of_raises_invalid_operation(self):
+        schema = {'properties': {'c_number': {'multipleOf': Decimal('1e-38')}}}
+
+        with self.assertRaises(InvalidOperation):
+            validation.CompiledValidator(schema).validate({'c_number': Decimal('1e200')})
+
+    def test_unsupported_schema_falls_back_to_draft7_validator(self):
+        self.assertIsInstance(validation.get_validator({'properties': {'a': {'uniqueItems': True}}}),
+                              Draft7Validator)
+        self.assertIsInstance(validation.get_validator({'properties': {'a': {'$ref': 'http://remote/schema'}}}),
+                              Draft7Validator)
+
+    def test_deeply_nested_schema_falls_back_to_draft7_validator(self):
+        schema = {'type': 'integer'}
+        instance = 1
+        for _ in range(60):
+            schema = {'type': 'object', 'properties': {'a': schema}}
+            instance = {'a': instance}
+
+        validator = validation.get_validator(schema)
+        self.assertIsInstance(validator, Draft7Validator)
+        validator.validate(instance)
+
+    def test_validators_are_cached_by_schema_fingerprint(self):
+        schema = {'properties': {'a': {'type': ['null', 'string']}}}
+
+        validator = validation.get_validator(schema)
+        self.assertIs(validation.get_validator(json.loads(json.dumps(schema))), validator)
+        self.assertIsNot(validation.get_validator({'properties': {'a': {'type': ['string']}}}), validator)